@@ -675,7 +675,7 @@ OverviewPage {
 		var name = service.name
 		if (service.type === DBusService.DBUS_SERVICE_TANK) {
 //////// SeeLevel - add to hide the service for the physical sensor
-            if (name !== seeLevelServiceName) // hide N2K SeeLevel dBus object
+            if (seeLevelServiceName.split(",").indexOf(name) === -1) // hide N2K SeeLevel dBus objects
 //////// SeeLevel - end add
                 tanksModel.append({serviceName: service.name})
 		}
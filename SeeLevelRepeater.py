@@ -7,21 +7,23 @@
 # To avoid this, individual dBus "repeater' services for each tank are created
 # data for each tank is extracted from the SeeLevel dBus service and published to a separate repeater service
 # 
-# This module handles all 6 defined tanks. 
+# This module handles all defined tanks. 
 # The SeeLevel N2K sensor system supports at most 3 tanks (1 = fresh, 2 = gray, 5 = black)
-# Other N2K systems may report more and this repeater should be able to handle them as long as
-# the tank number is unique
+# Other N2K systems may report more and this repeater creates a repeater for each
+# source, fluid type and fluid instance combination (see RepeaterRegistry)
 
 # The SeeLevel service is identified by its product ID stored in non-volatile settings at
 # dbus com.victron.settings /Settings/Devices/TankRepeater/SeeLevelProdId
 # When this process first starts, it creates the setting with a default value of 41312
+# Additional multiplexed tank services can be handled by adding their product IDs
+# (separated by commas) to /Settings/Devices/TankRepeater/SeeLevelProductIdList
 # If the ProcessId for the service of interest is different dbus-spy can be used to change it
 # Use dbus-spy to inspect the SeeLevel tank service for the proper value to enter
 # Setting ProcessId to -1 disables the repeater. Venus may need to be restarted to purge any repeaters
 # that have already been created
 
 # dbus com.victron.settings /Settings/Devices/TankRepeater/SeeLevelService is set by the repeater program
-# so that the GUI can hide the appropirate service
+# so that the GUI can hide the appropirate service (multiple service names are separated by commas)
 
 # Limitation: Only one repeater program is permitted since a second one would attempt to create duplicate dBus services
 
@@ -57,11 +59,12 @@
 # But this also is tricky since a signal for a level or capacity change may not be issued for every tank.
 # For example, if all tanks are empty, the level signal handler is never called! 
 # The same would be true for /FluidLevel if there was only one tank.
-# The signal handlers for /FluidType, /Level and /Capacity store the values received.
-# On the next /FluidType signal, the combination of /FluidType, /Level and /Capacity previuosly stored are consistent.
-# Those values are sent to the appropriate repeater which stores the values for later.
+# The signal handlers for /FluidType, /Level and /Capacity pass the values received to a frame assembler
+# which keeps the current value of each for every sender and groups them into one frame per tank report.
+# A frame is complete on the next /FluidType signal or after a short timeout.
+# Complete frames are sent to the appropriate repeater which stores the values for later.
 # The repeater's background task validates values, creates the dBus service if necessary then updates the dBus service witb new values.
-# The background task also polls for SeeLevel information to be used in the absence of signals.
+# The background task also polls for SeeLevel information so tanks whose values never change are still reported.
 # The signal handlers are called from another thread/process so the amount of time spent in these routines is kept to a minimum.
 
 import gobject
@@ -72,11 +75,19 @@ import sys
 import os
 import dbus
 import time
+import collections
+import heapq
+import mmap
+import struct
+import json
+import dbus.service
 
 # add the path to our own packages for import
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), './ext/velib_python'))
 from vedbus import VeDbusService
 from settingsdevice import SettingsDevice
+from ve_utils import unwrap_dbus_value
+from n2kfluidlevel import FluidLevelDecoder, SocketCanReader, ReadCandump
 
 # RepeaterServiceName is the name of the dBus service where data is sent
 # tank number is appended when the service is created
@@ -84,27 +95,258 @@ from settingsdevice import SettingsDevice
 RepeaterServiceName = 'com.victronenergy.tank.repeater'
 ProductName = 'SeeLevel Tank %d Repeater'
 
+# NMEA2000 fluid types (and instances) are 4 bit values
+MaxFluidTypes = 16
+
 # timer periods and watchdog timeout are defined here for convenience
 
 # If a repater service is not updated at least every 8 seconds
 # (approximately twice the SeeLevel reporting period)
 # it is marked as disconnected so the GUI can alert the user that
 # the level should not be trusted
+# the time of the last update is kept for each tank and checked at a deadline
+# so the timeout does not depend on how often the repeater's update loop runs
 
 RepeaterTimeoutInSeconds = 8.0
 
-# the update loop in the Repeater only manages timeouts so runs infrequently
-RepeaterTimerPeriodInSeconds = 1.0
+# the timeout adapts to the reporting cadence of each tank
+# each repeater keeps exponentially weighted averages of the time between updates and its deviation
+# (the same estimator TCP uses for round trip times)
+# once RepeaterIntervalSamples intervals have been seen, the timeout becomes the larger of
+# RepeaterTimeoutFactor times the mean and the mean plus RepeaterTimeoutDeviations deviations,
+# limited to RepeaterMinTimeoutInSeconds .. RepeaterMaxTimeoutInSeconds
+# so a fast sender is flagged quickly and a slow or bursty one does not flap
+
+RepeaterIntervalSamples = 8
+RepeaterIntervalGain = 0.125
+RepeaterJitterGain = 0.25
+RepeaterTimeoutFactor = 2.0
+RepeaterTimeoutDeviations = 4.0
+RepeaterMinTimeoutInSeconds = 2.0
+RepeaterMaxTimeoutInSeconds = 60.0
+
+# the first values are published this long after a repeater's dBus service is created
+RepeaterStartupDelayInSeconds = 1.0
+
+# the values of each update are published as one ItemsChanged signal
+# the Venus versions this package targets only listen to PropertiesChanged (GUI tank tiles, VRM logging, dbus-mqtt)
+# so a PropertiesChanged signal is also sent for each changed path
+# set this to False on systems that handle ItemsChanged to send only the one signal per update
+RepeaterPerPathSignals = True
+
+# sloshing makes the level reported for a tank on a moving boat jitter by a percent or more on every report
+# rather than passing every report on to the GUI, VRM logging and MQTT,
+# each repeater smooths the level over the last few reports kept in a small ring buffer
+# (median or exponential moving average)
+# then publishes a value only when it moves outside a deadband around the last published value
+# but not more often than the minimum publish interval
+# changes inside the deadband are still published once the maximum publish interval has passed
+# the deadband is the larger of the absolute (percent) and relative (percent of last published value) settings
+# these defaults are used until the tank's settings are read from /Settings/Devices/TankRepeater/Tank<suffix>
+
+FilterNone = 0
+FilterMedian = 1
+FilterEma = 2
+MaxFilterLength = 15
+
+DefaultLevelDeadband = 0.5
+DefaultRelativeDeadband = 0.0
+DefaultMinPublishInterval = 1.0
+DefaultMaxPublishInterval = 60.0
+DefaultFilterLength = 5
+DefaultFilterType = FilterMedian
+
+# the published values of each tank are kept in fixed size ring files
+# so history survives restarts without growing on disk or keeping lists in memory
+# the raw tier records every published value
+# the minute and hour tiers record the average of the published values in each minute or hour
+# files are memory mapped and appending a record only touches one record and the header
+# so the kernel writes dirty pages back in the background rather than rewriting the file
+#
+# each file starts with a header: magic, record size, capacity, index of the next record, record count
+# followed by capacity records: time (seconds since the epoch), level (%), capacity (m3)
+# GetHistory returns records in the same format, oldest first
+#
+# tiers are (name, averaging period in seconds (0 for raw), number of records)
+# HistoryDirectory and TankStateFile are under DataDirectory, which --data replaces (e.g. for tests off the Venus device)
+
+DataDirectory = '/data/TankRepeater'
+HistoryDirectory = os.path.join (DataDirectory, 'history')
+HistoryMagic = 'TRH1'
+HistoryHeaderFormat = '<4sIIII'
+HistoryRecordFormat = '<Iff'
+HistoryTiers = [ ('raw', 0, 4096), ('minute', 60, 10080), ('hour', 3600, 8760) ]
+HistoryInterface = 'com.victronenergy.TankHistory'
+
+# the fill or drain rate of each tank is estimated by a least squares fit
+# of the remaining volume against time over the last RateWindowInSeconds
+# running sums are kept so adding a sample and dropping the oldest one are O(1)
+# no rate is published until the window holds RateMinSamples spanning at least RateMinSpanInSeconds
+# rates smaller than RateMinimum (m3/h) are treated as steady
+# /Rate is published in m3/h (negative while draining)
+# /TimeToEmpty (while draining) and /TimeToFull (while filling) are published in seconds
+
+RateWindowInSeconds = 900.0
+RateMinSamples = 5
+RateMinSpanInSeconds = 60.0
+RateMinimum = 0.001
+
+# the last known state of every tank (source rank, fluid type and instance, level, capacity, custom name and time)
+# is saved in TankStateFile so after a restart the repeater services are created with those values
+# (after the usual start-up delay) instead of waiting for the SeeLevel service to be found
+# restored values are published with /Connected = 0 and /Stale = 1 until the first live update for the tank
+# the file is written at most every TankStateSaveIntervalInSeconds to limit flash writes
+# (to a temporary file that is then renamed so a power loss never leaves a partial file)
+# tanks not updated for TankStateMaxAgeInSeconds are not restored
+
+TankStateFile = os.path.join (DataDirectory, 'tankState.json')
+TankStateSaveIntervalInSeconds = 60.0
+TankStateMaxAgeInSeconds = 7 * 24 * 3600
 
 # This period defines how often the SeeLevel dBus object is checked
 # for existence and to pull /Capacity values for each tank
 # 1 second is frequent enough for these tasks 
+# the check only runs while at least one SeeLevel service has been found
 
 SeeLevelScanPeriodInSeconds = 1.0
 
-SeeLevelScanPeriod = int (SeeLevelScanPeriodInSeconds * 1000)		# in timer ticks
-RepeaterTimerPeriod = int (RepeaterTimerPeriodInSeconds * 1000)		# in timer ticks
-RepeaterTimeout = int (RepeaterTimeoutInSeconds / RepeaterTimerPeriodInSeconds)	# in passes through update loop
+# dBus requests to the SeeLevel service are made asynchronously (see AsyncPoller below)
+# so a stalled SeeLevel producer can't hold up the main loop
+# at most SeeLevelMaxRequestsInFlight requests are outstanding at any one time
+# and each request fails if no reply is received within SeeLevelRequestTimeoutInSeconds
+# (the default dBus timeout is about 25 seconds)
+
+SeeLevelMaxRequestsInFlight = 4
+SeeLevelRequestTimeoutInSeconds = 2.0
+
+# a snapshot that fails (e.g. times out while the GUI is busy) is only retried by the next check
+# signals from the service are still handled in the meantime
+# the service is treated as lost when it leaves the dBus or after SeeLevelMaxSnapshotFailures failures in a row
+
+SeeLevelMaxSnapshotFailures = 5
+
+
+# monotonic clock (in seconds) used for all deadlines so they are not upset when the system time is set
+# python 2 has no time.monotonic so clock_gettime is called directly
+
+try:
+	MonotonicTime = time.monotonic
+except AttributeError:
+	import ctypes
+	import ctypes.util
+
+	class Timespec (ctypes.Structure):
+		_fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+
+	CLOCK_MONOTONIC = 1
+	librt = ctypes.CDLL (ctypes.util.find_library ('rt') or 'librt.so.1', use_errno = True)
+
+	def MonotonicTime ():
+		t = Timespec ()
+		if librt.clock_gettime (CLOCK_MONOTONIC, ctypes.byref (t)) != 0:
+			errno = ctypes.get_errno ()
+			raise OSError (errno, os.strerror (errno))
+		return t.tv_sec + t.tv_nsec * 1e-9
+
+
+# DeadlineScheduler runs callbacks at deadlines from a single GLib timer
+# pending calls are kept in a heap ordered by deadline and the GLib timer is only armed
+# for the earliest one, so the process doesn't wake at all when nothing is pending
+# and the number of wakeups depends on activity rather than the number of tanks
+#
+# Schedule returns a ScheduledCall that can be cancelled
+# cancelled calls stay in the heap and are discarded when they reach the top
+# a callback that raises an exception is logged so it can't stop the calls after it
+
+class ScheduledCall:
+
+	def __init__ (self, deadline, callback, args):
+
+		self.Deadline = deadline
+		self.Callback = callback
+		self.Args = args
+
+	def Cancel (self):
+
+		self.Callback = None
+		self.Args = None
+
+# True until the call has been made or cancelled
+	def Pending (self):
+
+		return self.Callback != None
+
+
+class DeadlineScheduler:
+
+	def __init__ (self):
+
+		self.Heap = []
+		self.Sequence = 0
+		self.TimerId = None
+		self.TimerDeadline = None
+
+
+# call callback (*args) delay seconds from now
+
+	def Schedule (self, delay, callback, *args):
+
+		call = ScheduledCall (MonotonicTime () + delay, callback, args)
+# the sequence number keeps calls with the same deadline in order
+		self.Sequence += 1
+		heapq.heappush (self.Heap, (call.Deadline, self.Sequence, call))
+		if self.TimerDeadline == None or call.Deadline < self.TimerDeadline:
+			self._arm ()
+		return call
+
+
+# schedule a call unless the pending call (handle) is already due no later than the new deadline
+# returns the handle for the pending call
+
+	def Reschedule (self, handle, delay, callback, *args):
+
+		if handle != None and handle.Pending ():
+			if handle.Deadline <= MonotonicTime () + delay:
+				return handle
+			handle.Cancel ()
+		return self.Schedule (delay, callback, *args)
+
+
+	def _arm (self):
+
+		while len (self.Heap) > 0 and not self.Heap[0][2].Pending ():
+			heapq.heappop (self.Heap)
+
+		if self.TimerId != None:
+			gobject.source_remove (self.TimerId)
+			self.TimerId = None
+			self.TimerDeadline = None
+		if len (self.Heap) == 0:
+			return
+
+		self.TimerDeadline = self.Heap[0][0]
+# gobject.timeout_add uses a 1 mS timer (1000 ticks per second) - round up so the deadline has passed
+		delay = int ((self.TimerDeadline - MonotonicTime ()) * 1000 + 0.999)
+		self.TimerId = gobject.timeout_add (max (delay, 0), self._run)
+
+
+	def _run (self):
+
+		self.TimerId = None
+		self.TimerDeadline = None
+		now = MonotonicTime ()
+		while len (self.Heap) > 0 and self.Heap[0][0] <= now:
+			call = heapq.heappop (self.Heap)[2]
+			if call.Pending ():
+				callback = call.Callback
+				args = call.Args
+				call.Cancel ()
+				try:
+					callback (*args)
+				except Exception:
+					logging.exception ("scheduled call %s failed", getattr (callback, '__name__', callback))
+		self._arm ()
+		return False
 
 
 # These methods permit creation of a separate connection for each Repeater
@@ -125,21 +367,314 @@ def dbusconnection():
 
 
 # repeater bus services are created from this class
-# one Repeater instance is created for each tank (aka fluid type)
-# a corresponding dBus service is created when the Repeater is instantiated.
+# one Repeater instance is created by the RepeaterRegistry for each tank
+# (source service, fluid type and fluid instance)
+# a corresponding dBus service is created when the first update for the tank is received.
+
+# LevelFilter smooths the values for one tank
+# the last few values are kept in a ring buffer (deque with maxlen)
+# Add () returns the filtered value including the new one
+
+class LevelFilter:
+
+    def __init__(self, filterType, length):
+
+	self.FilterType = filterType
+	self.Samples = collections.deque (maxlen = min (max (length, 1), MaxFilterLength))
+	self.Average = None
+
+
+    def Add (self, value):
+
+	self.Samples.append (value)
+	if self.FilterType == FilterMedian:
+		ordered = sorted (self.Samples)
+		return ordered[len (ordered) // 2]
+	elif self.FilterType == FilterEma:
+		if self.Average == None:
+			self.Average = float (value)
+		else:
+			self.Average += 2.0 / (self.Samples.maxlen + 1) * (value - self.Average)
+		return self.Average
+	else:
+		return value
+
+
+# PublishFilter decides when a new value for one path is published (see DefaultLevelDeadband)
+# Due () returns 0 if the value should be published now,
+# the number of seconds to wait before it should be published
+# or None if the value is already published
+
+class PublishFilter:
+
+    def __init__(self, deadband, relativeDeadband, minInterval, maxInterval):
+
+	self.Deadband = deadband
+	self.RelativeDeadband = relativeDeadband
+	self.MinInterval = minInterval
+	self.MaxInterval = maxInterval
+	self.Value = None
+	self.Time = None
+
+
+    def Due (self, value, now):
+
+	if self.Time == None:
+		return 0
+	if value == self.Value:
+		return None
+	elapsed = now - self.Time
+	deadband = max (self.Deadband, self.RelativeDeadband * abs (self.Value) / 100)
+	if abs (value - self.Value) > deadband:
+		wait = self.MinInterval - elapsed
+	else:
+		wait = self.MaxInterval - elapsed
+	return max (wait, 0)
+
+
+    def Published (self, value, now):
+
+	self.Value = value
+	self.Time = now
+
+
+# RateEstimator fits a line through the (time, remaining) samples in the window (see RateWindowInSeconds)
+# times are kept relative to the first sample since the window was last empty
+# so the running sums don't lose precision
+
+class RateEstimator:
+
+    def __init__(self):
+
+	self.Samples = collections.deque ()
+	self.Reset ()
+
+
+    def Reset (self):
+
+	self.Samples.clear ()
+	self.Origin = None
+	self.SumT = 0.0
+	self.SumV = 0.0
+	self.SumTT = 0.0
+	self.SumTV = 0.0
+
+
+    def Add (self, now, value):
+
+	if self.Origin == None:
+		self.Origin = now
+	t = now - self.Origin
+	self.Samples.append ((t, value))
+	self.SumT += t
+	self.SumV += value
+	self.SumTT += t * t
+	self.SumTV += t * value
+	while t - self.Samples[0][0] > RateWindowInSeconds:
+		oldT, oldV = self.Samples.popleft ()
+		self.SumT -= oldT
+		self.SumV -= oldV
+		self.SumTT -= oldT * oldT
+		self.SumTV -= oldT * oldV
+
+
+# returns the slope of the fit in units per hour or None if there is not enough data
+
+    def Rate (self):
+
+	count = len (self.Samples)
+	if count < RateMinSamples or self.Samples[-1][0] - self.Samples[0][0] < RateMinSpanInSeconds:
+		return None
+	denominator = count * self.SumTT - self.SumT * self.SumT
+	if denominator <= 0:
+		return None
+	return (count * self.SumTV - self.SumT * self.SumV) / denominator * 3600
+
+
+# HistoryRing is one memory mapped ring file (see HistoryDirectory)
+# an existing file is reused if its header matches, otherwise it is recreated empty
+#
+# time stamps are wall clock time so they normally increase, but not if the system time is set back
+# Descents counts the neighbouring records whose time stamps go backwards
+# it is counted when the file is opened and kept up to date as records are added and dropped
+# Range finds its records by bisection while there are none, else by a linear scan
+
+class HistoryRing:
+
+    def __init__(self, fileName, capacity):
+
+	self.HeaderSize = struct.calcsize (HistoryHeaderFormat)
+	self.RecordSize = struct.calcsize (HistoryRecordFormat)
+	self.Capacity = capacity
+	self.Head = 0
+	self.Count = 0
+	self.Descents = 0
+	size = self.HeaderSize + capacity * self.RecordSize
+
+	fd = os.open (fileName, os.O_RDWR | os.O_CREAT, 0o644)
+	try:
+		valid = os.fstat (fd).st_size == size
+		if not valid:
+			os.ftruncate (fd, size)
+		self.Map = mmap.mmap (fd, size)
+	finally:
+		os.close (fd)
+
+	if valid:
+		magic, recordSize, fileCapacity, head, count = struct.unpack_from (HistoryHeaderFormat, self.Map, 0)
+		valid = magic == HistoryMagic and recordSize == self.RecordSize and fileCapacity == capacity \
+				and head < capacity and count <= capacity
+	if valid:
+		self.Head = head
+		self.Count = count
+		for index in range (1, count):
+			if self._time (index) < self._time (index - 1):
+				self.Descents += 1
+		if self.Descents > 0:
+			logging.info ("history file %s is not in time order", fileName)
+	else:
+		logging.info ("creating new history file %s", fileName)
+		self._writeHeader ()
+
+
+    def _writeHeader (self):
+
+	struct.pack_into (HistoryHeaderFormat, self.Map, 0, HistoryMagic, self.RecordSize, self.Capacity, self.Head, self.Count)
+
+
+# offset in the file of the index'th oldest record
+
+    def _offset (self, index):
+
+	return self.HeaderSize + ((self.Head - self.Count + index) % self.Capacity) * self.RecordSize
+
+
+    def _time (self, index):
+
+	return struct.unpack_from ('<I', self.Map, self._offset (index))[0]
+
+
+    def Append (self, timeStamp, level, capacity):
+
+# the oldest record is overwritten when the ring is full
+	if self.Count == self.Capacity and self.Count > 1 and self._time (1) < self._time (0):
+		self.Descents -= 1
+	if self.Count > 0 and self.Capacity > 1 and int (timeStamp) < self._time (self.Count - 1):
+		self.Descents += 1
+	struct.pack_into (HistoryRecordFormat, self.Map, self.HeaderSize + self.Head * self.RecordSize,
+			int (timeStamp), level, capacity)
+	self.Head = (self.Head + 1) % self.Capacity
+	self.Count = min (self.Count + 1, self.Capacity)
+	self._writeHeader ()
+
+
+# returns the packed records with start <= time <= end, oldest first
+
+    def Range (self, start, end):
+
+	if self.Descents > 0:
+		records = []
+		for index in range (self.Count):
+			if start <= self._time (index) <= end:
+				offset = self._offset (index)
+				records.append (self.Map[offset:offset + self.RecordSize])
+		return ''.join (records)
+
+	def search (limit):
+		low = 0
+		high = self.Count
+		while low < high:
+			middle = (low + high) // 2
+			if self._time (middle) < limit:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
+	first = search (start)
+	last = search (end + 1)
+	if first >= last:
+		return ''
+	firstOffset = self._offset (first)
+	lastOffset = self._offset (last - 1) + self.RecordSize
+	if firstOffset < lastOffset:
+		return self.Map[firstOffset:lastOffset]
+# the range wraps around the end of the file
+	return self.Map[firstOffset:] + self.Map[self.HeaderSize:lastOffset]
+
+
+# LevelHistory keeps the ring files of all tiers for one tank
+# and averages published values for the minute and hour tiers
+# a partly filled minute or hour is lost when the repeater restarts
+
+class LevelHistory:
+
+    def __init__(self, suffix):
+
+	self.Tiers = {}
+	self.Averages = []
+	for name, period, capacity in HistoryTiers:
+		ring = HistoryRing (os.path.join (HistoryDirectory, 'Tank%s.%s' % (suffix, name)), capacity)
+		self.Tiers[name] = ring
+		if period > 0:
+# [ ring, period, current period, level sum, capacity sum, sample count ]
+			self.Averages.append ([ ring, period, None, 0.0, 0.0, 0 ])
+
+
+    def Add (self, timeStamp, level, capacity):
+
+	self.Tiers['raw'].Append (timeStamp, level, capacity)
+	for average in self.Averages:
+		ring, period = average[0], average[1]
+		current = int (timeStamp) // period
+		if average[2] != current:
+			if average[5] > 0:
+				ring.Append (average[2] * period, average[3] / average[5], average[4] / average[5])
+			average[2:] = [ current, 0.0, 0.0, 0 ]
+		average[3] += level
+		average[4] += capacity
+		average[5] += 1
+
+
+    def Range (self, tier, start, end):
+
+	return self.Tiers[tier].Range (start, end)
+
+
+# HistoryExport makes a tank's history available on its repeater service at /History
+# GetHistory (tier, start, end) returns the records of that tier between start and end (seconds since the epoch)
+# as one packed byte array (see HistoryRecordFormat)
+
+class HistoryExport(dbus.service.Object):
+
+    def __init__(self, bus, history):
+
+	dbus.service.Object.__init__(self, bus, '/History')
+	self.History = history
+
+
+    @dbus.service.method(HistoryInterface, in_signature = 'suu', out_signature = 'ay')
+    def GetHistory (self, tier, start, end):
+
+	if tier not in self.History.Tiers:
+		raise dbus.exceptions.DBusException ("unknown history tier %s" % tier)
+	return dbus.ByteArray (self.History.Range (str (tier), start, end))
+
 
 class Repeater:
 
     global RepeaterServiceName
     global ProductName
-    global RepeaterTimeout
-    global RepeaterTimerPeriod
 
     DbusService = None
     StartupDelay = True
 
     DbusBus = None
     ServiceName = ""
+    Key = None
+    Source = ""
+    Suffix = ""
+    DeviceInstance = 0
 
 # local tank values
 # the dBus service is not created until messages are received
@@ -152,23 +687,77 @@ class Repeater:
     Capacity = 0
     UpdateReceived = False
 
-    TimeoutCount = 0
-
-
-    def __init__(self, tank):
-
+# values restored from TankStateFile that have not been replaced by a live update yet
+    Stale = False
+# publish on the next update whatever the publish filters say (restored values and the first live update)
+    PublishNow = False
+# time of the last live update (seconds since the epoch) saved in TankStateFile
+    UpdateTime = None
+    settings = None
+
+# smoothing and publish filters (see DefaultLevelDeadband)
+    Filter = None
+    LevelPublisher = None
+    CapacityPublisher = None
+
+# fill/drain rate (see RateWindowInSeconds)
+    Estimator = None
+
+# level history (see HistoryDirectory)
+    History = None
+    HistoryExport = None
+
+    LastUpdateTime = 0.0
+# time of the last report (not a poll refresh) - the report cadence statistics are built from these
+    LastReportTime = None
+# the level as last received, before smoothing
+    ReportedLevel = None
+    SettingsRequested = False
+    UpdateHandle = None
+    TimeoutHandle = None
+
+# report cadence statistics (see RepeaterTimeoutInSeconds)
+    IntervalCount = 0
+    IntervalMean = 0.0
+    IntervalJitter = 0.0
+
+
+    def __init__(self, key, source, suffix, tank, deviceInstance):
+
+	self.Key = key
+	self.Source = source
+	self.Suffix = suffix
 	self.Tank = tank
-	self.RepeaterTimeout = RepeaterTimeout
-	self.TimeoutCount = 0
+	self.DeviceInstance = deviceInstance
+	self.RepeaterTimeout = RepeaterTimeoutInSeconds
+	self.LastUpdateTime = None
+	self.LastReportTime = None
+	self.IntervalCount = 0
+	self.IntervalMean = 0.0
+	self.IntervalJitter = 0.0
+
+# defaults until the settings for this tank are read, before the dBus service is created
+	self.Filter = LevelFilter (DefaultFilterType, DefaultFilterLength)
+	self.LevelPublisher = PublishFilter (DefaultLevelDeadband, DefaultRelativeDeadband,
+			DefaultMinPublishInterval, DefaultMaxPublishInterval)
+	self.CapacityPublisher = PublishFilter (0, 0, 0, DefaultMaxPublishInterval)
+	self.Estimator = RateEstimator ()
 
 # set up unique dBus connection
 # The Repeater dBus service is not created until SeeLevel messages for that tank are received
 	self.DbusBus = dbusconnection()
 
-# gobject.timeout_add uses a 1 mS timer (1000 ticks per second)
-# _update is called periodically with the following call
+# _update is called through TheScheduler when an update is pending
+# _checkTimeout is called at the timeout deadline while the tank is connected
+	self.UpdateHandle = None
+	self.TimeoutHandle = None
+
+
+# schedule a call to _update delay seconds from now (unless one is already due earlier)
 
-	gobject.timeout_add(RepeaterTimerPeriod, self._update)
+    def _scheduleUpdate (self, delay):
+
+	self.UpdateHandle = TheScheduler.Reschedule (self.UpdateHandle, delay, self._update)
 
 
 # flag value change from external source
@@ -176,6 +765,7 @@ class Repeater:
     def _handlechangedvalue (self, path, value):
 
 	self.UpdateReceived = True
+	self._scheduleUpdate (0)
         return True 
 
 
@@ -183,18 +773,11 @@ class Repeater:
 
     def _createDbusService (self):
 
-# create a unique service name that puts tanks in the desired order (see note at top of this module)
-	self.ServiceName = RepeaterServiceName + "_%d" % self.Tank
+# create a unique service name that puts tanks in the desired order (see RepeaterRegistry)
+	self.ServiceName = RepeaterServiceName + "_" + self.Suffix
 
 # updated version of VeDbusService (in ext directory) -- see https://github.com/victronenergy/dbus-digitalinputs for new imports
-	self.DbusService = VeDbusService (self.ServiceName, bus = self.DbusBus)
-
-# make custom name non-volatile
-        settingsPath = '/Settings/Devices/TankRepeater/Tank%d' % self.Tank
-
-        SETTINGS = { 'customname': [settingsPath + '/CustomName', '', 0, 0] }
-
-        self.settings = SettingsDevice(self.DbusBus, SETTINGS, self.setting_changed)
+	self.DbusService = VeDbusService (self.ServiceName, bus = self.DbusBus, perpathsignals = RepeaterPerPathSignals)
 
 # Create the objects
 
@@ -202,7 +785,7 @@ class Repeater:
 	self.DbusService.add_path ('/Mgmt/ProcessVersion', '1.0')
         self.DbusService.add_path ('/Mgmt/Connection', 'dBus')
 
-        self.DbusService.add_path ('/DeviceInstance', self.Tank)
+        self.DbusService.add_path ('/DeviceInstance', self.DeviceInstance)
         self.DbusService.add_path ('/ProductName', ProductName % self.Tank)
         self.DbusService.add_path ('/ProductId', 0)
         self.DbusService.add_path ('/FirmwareVersion', 0)
@@ -210,6 +793,8 @@ class Repeater:
         self.DbusService.add_path ('/Serial', '')
 # use numeric values (1/0) not True/False for /Connected to make GUI display correct state
 	self.DbusService.add_path ('/Connected', 0)
+# 1 while the values are the last known ones from before a restart (see TankStateFile)
+	self.DbusService.add_path ('/Stale', 0)
  
 	self.DbusService.add_path ('/Level', 0, writeable = True, onchangecallback = self._handlechangedvalue)
 	self.DbusService.add_path ('/FluidType', self.Tank, writeable = True, onchangecallback = self._handlechangedvalue)
@@ -218,7 +803,26 @@ class Repeater:
 
 	self.DbusService.add_path ('/CustomName', self.get_customname(), writeable = True, onchangecallback = self.customname_changed)
 
-	self.TimeoutCount = 0;
+# fill/drain rate (m3/h) and time to empty/full (seconds) - invalid until enough samples are seen
+	self.DbusService.add_path ('/Rate', None)
+	self.DbusService.add_path ('/TimeToEmpty', None)
+	self.DbusService.add_path ('/TimeToFull', None)
+
+# report cadence statistics and the resulting timeout (in seconds)
+	self.DbusService.add_path ('/Statistics/ReportInterval', None)
+	self.DbusService.add_path ('/Statistics/ReportJitter', None)
+	self.DbusService.add_path ('/Statistics/Timeout', self.RepeaterTimeout)
+
+# history is optional - the repeater runs without it if the files can't be created
+	try:
+		if not os.path.isdir (HistoryDirectory):
+			os.makedirs (HistoryDirectory)
+		self.History = LevelHistory (self.Suffix)
+		self.HistoryExport = HistoryExport (self.DbusBus, self.History)
+	except (OSError, IOError, ValueError) as e:
+		logging.warning ("history for tank %s disabled: %s", self.Suffix, e)
+		self.History = None
+
 	self.StartupDelay = True
 
 	return
@@ -230,11 +834,42 @@ class Repeater:
     def set_customname (self, val):
 	self.settings['customname'] = val
 
+# non-volatile settings (custom name and publishing parameters) are held by TheTankSettings
+# the settings of a new tank are added without blocking, _settingsReady is called when they can be used
+
+    def _settingsReady (self, settings):
+	self.settings = settings
+	self._loadPublishSettings ()
+	self._loadFilterSettings ()
+	self._scheduleUpdate (0)
+
     def setting_changed (self, name, old, new):
         if name == 'customname':
-	    self.DbusService['/CustomName'] = new
+	    if self.DbusService != None:
+		self.DbusService['/CustomName'] = new
+	elif name in ('filterlength', 'filtertype'):
+	    self._loadFilterSettings ()
+	elif name in ('leveldeadband', 'relativedeadband', 'minpublishinterval', 'maxpublishinterval'):
+	    self._loadPublishSettings ()
+	    self._scheduleUpdate (0)
 	return
 
+# publish filter settings take effect on the next update
+# the published value and time are kept so the new limits apply from the last publish
+
+    def _loadPublishSettings (self):
+	self.LevelPublisher.Deadband = self.settings['leveldeadband']
+	self.LevelPublisher.RelativeDeadband = self.settings['relativedeadband']
+	self.LevelPublisher.MinInterval = self.settings['minpublishinterval']
+	self.LevelPublisher.MaxInterval = self.settings['maxpublishinterval']
+	self.CapacityPublisher.MaxInterval = self.settings['maxpublishinterval']
+
+# a new smoothing filter starts with the current level so the output does not jump
+
+    def _loadFilterSettings (self):
+	self.Filter = LevelFilter (self.settings['filtertype'], self.settings['filterlength'])
+	self.Filter.Add (self.Level)
+
     def customname_changed (self, path, val):
         self.set_customname (val)
         return True
@@ -244,75 +879,376 @@ class Repeater:
 # SeeLevel updates Repeater local variables
 # those values are passed to the dBus service as a background operation here
 # the dBus service is created here when the first update for this tank is received
-# the /Connected flag is managed here: True if updates are being received,
-# False if no updates have been received in the timeout period
+# the /Connected flag is set here when updates are being received
+# and cleared by _checkTimeout if no updates have been received in the timeout period
 
     def _update(self):
 
 # update has been received - create dBus service if not done previously
 # then update dBus values from local storage
+# the tank's settings must be available before the service is created
 	if self.UpdateReceived:
 		if self.DbusService == None:
+			if self.settings == None:
+				if not self.SettingsRequested:
+					self.SettingsRequested = True
+					TheTankSettings.Subscribe (self.Suffix, self.setting_changed, self._settingsReady)
+				return
 			self._createDbusService ()
 # do nothing this pass if just created dBus service
 # update flag isn't cleared so the update is processed next pass
-			return True
-
-# update servcie values from local storage
-		self.DbusService['/Level'] = self.Level
-		self.DbusService['/Capacity'] = self.Capacity
-		self.DbusService['/Remaining'] = self.Capacity * self.Level / 100
-		self.UpdateReceived = False
-		self.TimeoutCount = 0
+			self._scheduleUpdate (RepeaterStartupDelayInSeconds)
+			return
+
+# update service values from local storage if the publish filters allow it
+# all changes are sent together (see VeDbusService)
+# values held back by the publish filters are checked again when they become due
+# restored values and the first live values that replace them are always published
+		now = MonotonicTime ()
+		levelDue = self.LevelPublisher.Due (self.Level, now)
+		capacityDue = self.CapacityPublisher.Due (self.Capacity, now)
+		if self.PublishNow:
+			levelDue = 0
+			capacityDue = 0
+			self.PublishNow = False
+		if levelDue == 0 or capacityDue == 0:
+			if levelDue == 0:
+				self.LevelPublisher.Published (self.Level, now)
+			if capacityDue == 0:
+				self.CapacityPublisher.Published (self.Capacity, now)
+			level = self.LevelPublisher.Value
+			capacity = self.CapacityPublisher.Value
+			with self.DbusService as service:
+				service['/Level'] = level
+				service['/Capacity'] = capacity
+				service['/Remaining'] = capacity * level / 100
+				self._publishRate (service, capacity, capacity * level / 100)
+				if self.IntervalCount > 0:
+					service['/Statistics/ReportInterval'] = round (self.IntervalMean, 1)
+					service['/Statistics/ReportJitter'] = round (self.IntervalJitter, 1)
+				service['/Statistics/Timeout'] = round (self.RepeaterTimeout, 1)
+				service['/Stale'] = 1 if self.Stale else 0
+			ScheduleTankStateSave ()
+# restored values are not history
+			if self.History != None and not self.Stale:
+				self.History.Add (time.time (), level, capacity)
+		pending = [ due for due in (levelDue, capacityDue) if due ]
+		if len (pending) > 0:
+			self._scheduleUpdate (min (pending))
+		else:
+			self.UpdateReceived = False
 
 # skip timeout processing if dBus service does not exist
 	if self.DbusService == None:
-		return True
+		return
 
 # update connected flag
-	if self.TimeoutCount == 0:
+	if self.LastUpdateTime != None and MonotonicTime () - self.LastUpdateTime < self.RepeaterTimeout:
 		if self.DbusService['/Connected'] == 0:
 			self.DbusService['/Connected'] = 1
-			logging.info ("Tank %d is responding", self.Tank)
+			logging.info ("Tank %s is responding", self.Suffix)
+		if self.TimeoutHandle == None:
+			self.TimeoutHandle = TheScheduler.Schedule (self.LastUpdateTime + self.RepeaterTimeout - MonotonicTime (),
+					self._checkTimeout)
+
+
+# publish the rate and the time until the tank is empty or full at that rate
+
+    def _publishRate (self, service, capacity, remaining):
+
+	rate = self.Estimator.Rate ()
+	timeToEmpty = None
+	timeToFull = None
+	if rate != None and abs (rate) >= RateMinimum:
+		if rate < 0:
+			timeToEmpty = int (remaining / -rate * 3600)
+		else:
+			timeToFull = int (max (capacity - remaining, 0) / rate * 3600)
+		rate = round (rate, 3)
+	elif rate != None:
+		rate = 0.0
+	service['/Rate'] = rate
+	service['/TimeToEmpty'] = timeToEmpty
+	service['/TimeToFull'] = timeToFull
 
-	if self.TimeoutCount > self.RepeaterTimeout:
-		if self.DbusService['/Connected'] == 1:
-			self.DbusService['/Connected'] = 0
-			logging.warning ("Tank %d is NOT responding", self.Tank)
+
+# called at the timeout deadline
+# updates received since the deadline was set move it later rather than rescheduling on every update
+
+    def _checkTimeout (self):
+
+	self.TimeoutHandle = None
+	remaining = self.LastUpdateTime + self.RepeaterTimeout - MonotonicTime ()
+	if remaining > 0:
+		self.TimeoutHandle = TheScheduler.Schedule (remaining, self._checkTimeout)
+		return
+
+	if self.DbusService['/Connected'] == 1:
+		self.DbusService['/Connected'] = 0
+		logging.warning ("Tank %s is NOT responding (no update for %.1f seconds)",
+				self.Suffix, MonotonicTime () - self.LastUpdateTime)
+
+
+# update the report cadence statistics with the time since the previous update
+# and derive this tank's timeout from them
+# intervals are limited to the maximum timeout so a long outage doesn't distort the averages
+
+    def _updateTimeout (self, interval):
+
+	interval = min (interval, RepeaterMaxTimeoutInSeconds)
+	if self.IntervalCount == 0:
+		self.IntervalMean = interval
+		self.IntervalJitter = interval / 2
 	else:
-		self.TimeoutCount += 1
+		self.IntervalJitter += RepeaterJitterGain * (abs (interval - self.IntervalMean) - self.IntervalJitter)
+		self.IntervalMean += RepeaterIntervalGain * (interval - self.IntervalMean)
+	self.IntervalCount += 1
 
-	return True
+	if self.IntervalCount >= RepeaterIntervalSamples:
+		timeout = max (RepeaterTimeoutFactor * self.IntervalMean,
+				self.IntervalMean + RepeaterTimeoutDeviations * self.IntervalJitter)
+		self.RepeaterTimeout = min (max (timeout, RepeaterMinTimeoutInSeconds), RepeaterMaxTimeoutInSeconds)
+
+
+# set the last known values from before a restart (see TankStateFile)
+# the dBus service is created and the values published by _update after the same start-up delay as for a live update
+# the tank remains disconnected and stale until the first live update
+
+    def Restore (self, level, capacity, updateTime):
+
+	self.Level = level
+	self.Capacity = capacity
+	self.UpdateTime = updateTime
+	self.Stale = True
+	self.PublishNow = True
+	self.UpdateReceived = True
+	self._scheduleUpdate (0)
+	logging.info ("Tank %s restored: level %.1f capacity %.3f (stale)", self.Suffix, level, capacity)
 
 
 # method called from the SeeLevel processing to update repeater values
 
-    def UpdateRepeater (self, level, capacity):
+# poll is set for values read by polling the service (see CheckSeeLevel) rather than reported
+# a poll refresh shows the tank is still being reported, so it keeps the tank connected
+# but it is not a report of its own: it is kept out of the report cadence statistics
+# and its values are only used if they differ from the last ones received (signals were missed)
+
+    def UpdateRepeater (self, level, capacity, poll = False):
+
+	now = MonotonicTime ()
+	self.UpdateTime = time.time ()
+	self.LastUpdateTime = now
+	if poll:
+		if (level == -99 or level == self.ReportedLevel) and (capacity == -99 or capacity == self.Capacity):
+			self._scheduleUpdate (0)
+			return True
+	else:
+		if self.LastReportTime != None:
+			self._updateTimeout (now - self.LastReportTime)
+		self.LastReportTime = now
+
+# the smoothing filter was seeded with the restored level - start it over with live values
+	if self.Stale:
+		self.Filter = LevelFilter (self.Filter.FilterType, self.Filter.Samples.maxlen)
+		self.Stale = False
+		self.PublishNow = True
 
 	if level != -99:
-		self.Level = level
+		self.ReportedLevel = level
+		self.Level = self.Filter.Add (level)
+# a new capacity changes the meaning of the remaining volume so the rate estimate starts over
 	if capacity != -99:
+		if capacity != self.Capacity:
+			self.Estimator.Reset ()
 		self.Capacity = capacity
+	if level != -99:
+		self.Estimator.Add (now, self.Capacity * self.Level / 100.0)
 	self.UpdateReceived = True
+	self._scheduleUpdate (0)
 	return True
  
 
+# TankSettings holds the non-volatile settings of all tanks in the process's one SettingsDevice (NvSettings)
+# so a repeater needs no settings client of its own
+# the settings of each tank are stored under /Settings/Devices/TankRepeater/Tank<suffix> (see TankSettingsTemplate)
+# and are named <suffix>/<setting> in NvSettings
+#
+# the suffixes of the tanks seen so far are kept in /Settings/Devices/TankRepeater/KnownTanks
+# the settings of all known tanks are added in one batch when the repeater starts
+# so creating the repeater for a known tank costs no settings round trips
+# the settings of a new tank are added when its repeater subscribes
+# asynchronously (see SettingsDevice.addSettings) so the main loop is never blocked or re-entered
+#
+# Subscribe passes a TankSettingsView giving the repeater settings['customname'] etc. to its ready callback
+# at once for a known tank, else when the tank's settings have been added
+# setting changes are passed to the repeater's callback with the short setting name
+
+TankSettingsTemplate = {
+	'customname': ['/CustomName', '', 0, 0],
+	'leveldeadband': ['/LevelDeadband', DefaultLevelDeadband, 0.0, 100.0],
+	'relativedeadband': ['/RelativeDeadband', DefaultRelativeDeadband, 0.0, 100.0],
+	'minpublishinterval': ['/MinPublishInterval', DefaultMinPublishInterval, 0.0, 3600.0],
+	'maxpublishinterval': ['/MaxPublishInterval', DefaultMaxPublishInterval, 0.0, 3600.0],
+	'filterlength': ['/FilterLength', DefaultFilterLength, 1, MaxFilterLength],
+	'filtertype': ['/FilterType', DefaultFilterType, FilterNone, FilterEma]
+	}
+
+class TankSettingsView:
+
+    def __init__(self, manager, suffix):
+
+	self.Manager = manager
+	self.Suffix = suffix
+
+    def __getitem__ (self, name):
+	return self.Manager.Settings[self.Suffix + '/' + name]
+
+    def __setitem__ (self, name, value):
+	self.Manager.Settings[self.Suffix + '/' + name] = value
+
+
+class TankSettings:
+
+    def __init__(self, settings):
+
+	self.Settings = settings
+	self.Callbacks = {}
+	self.Known = set ()
+# ready callbacks of the tanks whose settings are being added
+	self.Pending = {}
+	for suffix in settings['knownTanksNv'].split (','):
+		if suffix != '':
+			self.Known.add (suffix)
+# this runs at start-up, before the main loop, so the settings of the known tanks are added in one blocking batch
+	if len (self.Known) > 0:
+		self.Settings.addSettings (self._tankSettings (self.Known))
+
+
+    def _tankSettings (self, suffixes):
+
+	newSettings = {}
+	for suffix in suffixes:
+		settingsPath = '/Settings/Devices/TankRepeater/Tank' + suffix
+		for name, options in TankSettingsTemplate.items ():
+			newSettings[suffix + '/' + name] = [ settingsPath + options[0] ] + options[1:]
+	return newSettings
+
+
+    def Subscribe (self, suffix, callback, readyCallback):
+
+	self.Callbacks[suffix] = callback
+	if suffix in self.Known:
+		readyCallback (TankSettingsView (self, suffix))
+		return
+	if suffix in self.Pending:
+		self.Pending[suffix].append (readyCallback)
+		return
+	logging.info ("adding settings for tank %s", suffix)
+	self.Pending[suffix] = [ readyCallback ]
+	self.Settings.addSettings (self._tankSettings ([ suffix ]), lambda: self._added (suffix))
+
+
+    def _added (self, suffix):
+
+	self.Known.add (suffix)
+	self.Settings['knownTanksNv'] = ",".join (sorted (self.Known))
+	view = TankSettingsView (self, suffix)
+	for readyCallback in self.Pending.pop (suffix):
+		readyCallback (view)
+
+
+# called from the NvSettings change handler
+# returns True if the setting belongs to a tank
+
+    def SettingChanged (self, name, old, new):
+
+	suffix, separator, setting = name.partition ('/')
+	if separator == '':
+		return False
+	callback = self.Callbacks.get (suffix)
+	if callback != None:
+		callback (setting, old, new)
+	return True
+
+
+# RepeaterRegistry creates repeaters on demand and keeps them in a dictionary
+# keyed by (source rank, fluid type, fluid instance) - the values the service name is built from
+# so several multiplexed sources and several tanks of the same fluid type can be handled
+# each bound source has its own rank, and a source that comes back under another service name
+# with the same rank (or tank state restored after a restart) finds the same repeaters
+#
+# repeater service names must be unique and sort in a stable order
+# the first source (rank 0) reporting fluid instance 0 keeps the original naming:
+#   com.victronenergy.tank.repeater_<fluid type>
+# other tanks add the source rank and fluid instance:
+#   com.victronenergy.tank.repeater_<fluid type>_<rank>_<instance>
+# so all tanks of one fluid type are listed together
+# the same suffix is used for the tank's settings path
+# and the device instance is built from the same three values (fluid type for the original naming)
+
+class RepeaterRegistry:
+
+	def __init__ (self):
+
+		self.Repeaters = {}
+		self.Suffixes = set ()
+		self.DeviceInstances = set ()
+
+
+# returns the repeater for a tank, creating it if necessary
+
+	def Get (self, sourceService, rank, fluidType, instance):
+
+		repeater = self.Repeaters.get ( (rank, fluidType, instance) )
+		if repeater == None:
+			repeater = self._create (sourceService, rank, fluidType, instance)
+		return repeater
+
+
+	def _create (self, sourceService, rank, fluidType, instance):
+
+		if rank == 0 and instance == 0:
+			suffix = "%d" % fluidType
+		else:
+			suffix = "%d_%d_%d" % (fluidType, rank, instance)
+
+# names and device instances follow from the key so they are unique already
+# should one be taken anyway, the name gets a numbered suffix and the device instance is that of the next free rank
+# so no two repeaters share a service name or a device instance
+		baseSuffix = suffix
+		count = 1
+		while suffix in self.Suffixes:
+			suffix = "%s_%d" % (baseSuffix, count)
+			count += 1
+		self.Suffixes.add (suffix)
+
+		key = (rank, fluidType, instance)
+		deviceInstance = ((rank * MaxFluidTypes) + instance) * MaxFluidTypes + fluidType
+		while deviceInstance in self.DeviceInstances:
+			deviceInstance += MaxFluidTypes * MaxFluidTypes
+		self.DeviceInstances.add (deviceInstance)
+		repeater = Repeater (key, sourceService, suffix, fluidType, deviceInstance)
+		self.Repeaters [key] = repeater
+		logging.info ("Tank %s repeater created for %s fluid type %d instance %d",
+				suffix, sourceService, fluidType, instance)
+		return repeater
+
+
 # CheckSeeLevel is the polling loop to extract SeeLevel information
 # it collects and validates information from SeeLevel and forwards it to the tank repeater objects if for whatever reason
 # the signal handlers are not called. This would be the case if there is only one tank, or level doesn't change between messages.
-# Data from SeeLevel is read as quickly as possible followed by a second read of the first parameter (tank number)
-# if that second read matches the first, we assume the intermediate reads are valid
+# Data from SeeLevel is read as a single snapshot of the whole service (GetValue on the root object)
+# so tank number, level and capacity always come from the same moment and no re-read of the tank number is needed
 #
 # this method runs even if a SeeLevel sensor system isn't attached to Venus. In this case, the SeeLevel service won't exist
 # Read attempts to that service will generate an exception which is trapped here to skip processing.
 # note also that if the GUI isn't running or crashes, the SeeLevel dBus object goes away
 #
-# This method runs once per second to manage SeeLevel service object pointers and to read /Capacity
+# This method runs once per second to manage SeeLevel service object pointers and to read a snapshot of the service
 # The SeeLevel service can switch to a different tank quickly and this polling loop will miss some tanks
-# /FluidType  and /Level signal handlers (below) are used for updates to minimize the chance of a missed tank
-# Only /Level is processed in the signal handler for speed.
-# FluidTLevelHandler will not be called when SeeLevel switches to a new tank if it has the same level as the previous tank
-# Values from the two handlers (tank and level) are saved in persistent storage so they can be processed together at the next /FluidType change
+# /FluidType, /Level and /Capacity signal handlers (below) are used for updates so no tank is missed
+# Values from the handlers are assembled into frames by TheAssembler (see FrameAssembler)
+# The snapshot seeds the assembler's current values and keeps a tank that never changes from timing out
 #
 # persistent storage for SeeLevel data are created
 # so objects don't have to be fetched each time this process runs
@@ -321,164 +1257,830 @@ class Repeater:
 # When the SeeLevel dBus service is again present, the connection to it is reset and tank info forwarding continues
 # During this time, a no response error will be displayed.
 
-SeeLevelTankObject = None
-SeeLevelFluidLevelObject = None
-SeeLevelCapacityObject = None
-SeeLevelUniqueName = ""
-LastTank = -99
-LastLevel = -99
-LastCapacity = -99
-SeeLevelDbusOK = False
-NoLevelCount = 0
-NoCapacityCount = 0
-AlreadyLogged = False
 NewSeeLevelProdId = True	# force immediate service reference updates
-SeeLevelSearchDelay = 0
+
+# bound SeeLevel services: service name -> SeeLevelSource
+SeeLevelSources = {}
+# the same sources by unique name (the sender of their signals)
+SourcesByOwner = {}
 
 # this is the dBus bus (system in this case)
 TheBus = None
 
-# RepeaterList provides persistent storage for a repeater instance so that it may be called from CheckSeeLevel 
-# This list is indexed by fluid type and needs to be expanded if additional fluid types are added in the future
+# the asynchronous request engine used for all SeeLevel service reads
+ThePoller = None
+
+# index of tank services and their product IDs
+TheIndex = None
+
+# assembles signals from the SeeLevel services into tank frames
+TheAssembler = None
+
+# TheRegistry provides persistent storage for repeater instances so that they may be found from the frame handler
+TheRegistry = None
+
+# all timed activity runs from TheScheduler
+TheScheduler = None
+SeeLevelCheckHandle = None
+
+# non-volatile settings of all tanks
+TheTankSettings = None
+
+# pending save of TankStateFile
+TankStateHandle = None
+
+
+# save the state of all tanks that have been updated in TankStateFile
+# called through TheScheduler at most every TankStateSaveIntervalInSeconds (see ScheduleTankStateSave)
+
+def SaveTankState ():
+	global TankStateHandle
 
-RepeaterList =  [None,  None, None, None, None, None ]
+	TankStateHandle = None
+	tanks = []
+	for repeater in TheRegistry.Repeaters.values ():
+		if repeater.UpdateTime == None:
+			continue
+		rank, fluidType, instance = repeater.Key
+		if repeater.settings != None:
+			customName = repeater.settings['customname']
+		else:
+			customName = ''
+# the registry key (see RepeaterRegistry) is saved so the same repeater is found again
+		tanks.append ( { 'source': repeater.Source,
+				'rank': rank,
+				'fluidType': fluidType,
+				'instance': instance,
+				'level': repeater.Level,
+				'capacity': repeater.Capacity,
+				'customName': customName,
+				'time': repeater.UpdateTime } )
+
+	tempFile = TankStateFile + '.tmp'
+	try:
+		with open (tempFile, 'w') as f:
+			json.dump (tanks, f)
+			f.flush ()
+			os.fsync (f.fileno ())
+		os.rename (tempFile, TankStateFile)
+	except (IOError, OSError) as e:
+		logging.warning ("could not save tank state: %s", e)
+
+
+def ScheduleTankStateSave ():
+	global TankStateHandle
+
+	if TankStateHandle == None:
+		TankStateHandle = TheScheduler.Schedule (TankStateSaveIntervalInSeconds, SaveTankState)
+
+
+# recreate the repeaters saved in TankStateFile
+# each is found by its registry key (rank, fluid type, instance), the source is only reported
+
+def RestoreTankState ():
+
+	try:
+		with open (TankStateFile) as f:
+			tanks = json.load (f)
+	except (IOError, OSError, ValueError) as e:
+		logging.info ("no tank state restored: %s", e)
+		return
+
+	now = time.time ()
+	for tank in tanks:
+		try:
+			if now - tank['time'] > TankStateMaxAgeInSeconds:
+				continue
+			repeater = TheRegistry.Get (str (tank['source']), tank['rank'], tank['fluidType'], tank['instance'])
+			repeater.Restore (tank['level'], tank['capacity'], tank['time'])
+		except (KeyError, TypeError) as e:
+			logging.warning ("invalid tank state entry %s: %s", tank, e)
+
+
+# AsyncPoller issues dBus method calls with reply and error callbacks instead of blocking the main loop
+# requests are queued and at most maxInFlight of them are outstanding at any one time
+# each request is given a deadline (dBus timeout) after which the error callback is called
+#
+# each request carries a key: a request whose key is already queued or in flight is dropped
+# so a slow producer can't cause requests to pile up
 
+class AsyncPoller:
 
-# check to see if SeeLevel dBus object exists
+	def __init__ (self, maxInFlight, timeout):
+
+		self.MaxInFlight = maxInFlight
+		self.Timeout = timeout
+		self.InFlight = 0
+		self.Queue = collections.deque ()
+		self.Keys = set ()
+
+		self.ReplyCount = 0
+		self.ErrorCount = 0
+		self.TimeoutCount = 0
+
+
+# queue a request - returns False if a request with the same key is already pending
+
+	def Submit (self, key, proxy, method, replyHandler, errorHandler, *args):
+
+		if key in self.Keys:
+			return False
+		self.Keys.add (key)
+		self.Queue.append ( (key, proxy, method, args, replyHandler, errorHandler) )
+		self._startRequests ()
+		return True
+
+
+# drop the request with this key if it has not yet been sent
+# a request already in flight completes normally, its callbacks must ignore a stale reply
+
+	def Flush (self, key):
+
+		if key not in self.Keys:
+			return
+		keep = collections.deque ()
+		for request in self.Queue:
+			if request[0] == key:
+				self.Keys.discard (key)
+			else:
+				keep.append (request)
+		self.Queue = keep
+
+
+	def _startRequests (self):
+
+		while self.InFlight < self.MaxInFlight and len (self.Queue) > 0:
+			key, proxy, method, args, replyHandler, errorHandler = self.Queue.popleft ()
+			self.InFlight += 1
+			try:
+				getattr (proxy, method) (*args,
+						reply_handler = self._replyCallback (key, replyHandler),
+						error_handler = self._errorCallback (key, errorHandler),
+						timeout = self.Timeout)
+# a request that can't be sent completes with an error at once so it is never left in flight
+			except Exception as error:
+				self._error (key, errorHandler, error)
+
+
+# closures are built here so each one captures its own key and handler
+
+	def _replyCallback (self, key, replyHandler):
+		return lambda *values: self._reply (key, replyHandler, values)
+
+	def _errorCallback (self, key, errorHandler):
+		return lambda error: self._error (key, errorHandler, error)
+
+
+	def _reply (self, key, replyHandler, values):
+
+		self._complete (key)
+		self.ReplyCount += 1
+		replyHandler (*values)
+
+
+	def _error (self, key, errorHandler, error):
+
+		self._complete (key)
+		self.ErrorCount += 1
+		if isinstance (error, dbus.DBusException) \
+				and error.get_dbus_name () == 'org.freedesktop.DBus.Error.NoReply':
+			self.TimeoutCount += 1
+		errorHandler (error)
+
+
+	def _complete (self, key):
+
+		self.InFlight -= 1
+		self.Keys.discard (key)
+		self._startRequests ()
+
+
+# TankServiceIndex keeps track of the tank services on the dBus and their product IDs
+# so the SeeLevel service can be found without scanning the bus
+# the index is filled from one list_names () call when it is created
+# then kept up to date from NameOwnerChanged signals
+# the /ProductId of each new tank service is requested once (asynchronously) and cached
+# the found callback is called with the service name and product ID each time a product ID arrives
+
+TankServicePrefix = 'com.victronenergy.tank'
+
+# a service that doesn't answer the /ProductId request is asked again after this delay
+TankServiceRetryPeriodInSeconds = 10.0
+
+class TankServiceIndex:
+
+	def __init__ (self, bus, poller, foundCallback):
+
+		self.Bus = bus
+		self.Poller = poller
+		self.FoundCallback = foundCallback
+		self.ProductIds = {}		# service name -> product ID (None until known)
+		self.Services = {}			# product ID -> set of service names
+
+		bus.add_signal_receiver (self._nameOwnerChanged, signal_name = 'NameOwnerChanged',
+				dbus_interface = 'org.freedesktop.DBus', path = '/org/freedesktop/DBus')
+
+		for service in bus.list_names ():
+			if self._isTankService (service):
+				self._add (service)
+
+
+# returns the services with the specified product ID in a stable order
+
+	def FindAll (self, productId):
+
+		return sorted (self.Services.get (productId, ()))
+
+
+	def _isTankService (self, service):
+
+		return service.startswith (TankServicePrefix) and not service.startswith (RepeaterServiceName)
+
+
+	def _nameOwnerChanged (self, name, oldOwner, newOwner):
+
+		if not self._isTankService (name):
+			return
+		self._remove (name)
+		if newOwner != "":
+			self._add (name)
+
+
+	def _add (self, service):
+
+		self.ProductIds [service] = None
+		self._requestProductId (service)
+
+
+	def _remove (self, service):
+
+		productId = self.ProductIds.pop (service, None)
+		services = self.Services.get (productId)
+		if services:
+			services.discard (service)
+			if len (services) == 0:
+				del self.Services [productId]
+
+
+	def _requestProductId (self, service):
+
+		self.Poller.Submit (('productId', service),
+				self.Bus.get_object (service, '/ProductId', introspect = False), 'GetValue',
+				lambda value: self._productIdReply (service, value),
+				lambda error: self._productIdError (service, error))
+
+
+	def _productIdReply (self, service, value):
+
+# ignore reply if the service has left the bus in the meantime
+		if service not in self.ProductIds:
+			return
+		productId = unwrap_dbus_value (value)
+		self.ProductIds [service] = productId
+		self.Services.setdefault (productId, set ()).add (service)
+		self.FoundCallback (service, productId)
+
+
+	def _productIdError (self, service, error):
+
+		logging.debug ("No /ProductId from %s: %s", service, error)
+		if service in self.ProductIds:
+			TheScheduler.Schedule (TankServiceRetryPeriodInSeconds, self._retry, service)
+
+
+	def _retry (self, service):
+
+		if service in self.ProductIds and self.ProductIds [service] == None:
+			self._requestProductId (service)
+
+
+# FrameAssembler groups the /FluidType, /Level and /Capacity signals from a multiplexed tank service
+# into one (fluid type, level, capacity) frame for each tank report
+# state is kept separately for each sender (unique dBus name)
+#
+# the producer publishes the fluid type of a tank followed by its level and capacity
+# PropertiesChanged is only sent when a value changes, so a level or capacity that isn't signalled
+# is the same as for the previous tank. The assembler therefore keeps the current value of each path
+# and a frame always contains the producer's current values.
+#
+# a frame is opened by a /FluidType signal (or a level or capacity signal if no frame is open)
+# and flushed when the next /FluidType signal arrives or if no signal is received for FrameTimeoutInSeconds
+# (the last tank of a burst or a system with only one tank)
+#
+# frames in which the level or capacity is signalled more than once are counted as mis-assembled:
+# the producer has moved on without a /FluidType signal, so one of the tank reports is lost
+
+FrameTimeoutInSeconds = 0.5
+
+class FrameSource:
+
+	def __init__ (self):
+
+		self.Tank = None
+		self.Level = None
+		self.Capacity = None
+		self.FrameOpen = False
+		self.LevelReceived = False
+		self.CapacityReceived = False
+		self.Sequence = 0
+
+
+class FrameAssembler:
+
+	def __init__ (self, frameCallback):
+
+		self.FrameCallback = frameCallback
+		self.Sources = {}
+
+		self.FrameCount = 0
+		self.TimeoutCount = 0
+		self.MisassembledCount = 0
+		self.OrphanCount = 0
+
+
+	def _source (self, sender):
+
+		source = self.Sources.get (sender)
+		if source == None:
+			source = FrameSource ()
+			self.Sources [sender] = source
+		return source
+
+
+# forget everything known about a sender (e.g., it has left the bus)
+
+	def Reset (self, sender):
+
+		self.Sources.pop (sender, None)
+
+
+	def FluidType (self, sender, tank):
+
+		source = self._source (sender)
+		if source.FrameOpen:
+			self._flush (source, sender)
+		source.Tank = tank
+		self._open (source, sender)
+
+
+	def Level (self, sender, level):
+
+		source = self._source (sender)
+		if source.LevelReceived:
+			self.MisassembledCount += 1
+			self._flush (source, sender)
+		source.Level = level
+		if not source.FrameOpen:
+			self._open (source, sender)
+		source.LevelReceived = True
+
+
+	def Capacity (self, sender, capacity):
+
+		source = self._source (sender)
+		if source.CapacityReceived:
+			self.MisassembledCount += 1
+			self._flush (source, sender)
+		source.Capacity = capacity
+		if not source.FrameOpen:
+			self._open (source, sender)
+		source.CapacityReceived = True
+
+
+# a snapshot is a complete frame read in one request
+# it updates the current values and is sent on unless signals are in the middle of a frame
+# marked as a poll refresh (see Repeater.UpdateRepeater)
+
+	def Snapshot (self, sender, tank, level, capacity):
+
+		source = self._source (sender)
+		if source.FrameOpen:
+			return
+		if tank != -99:
+			source.Tank = tank
+		if level != -99:
+			source.Level = level
+		if capacity != -99:
+			source.Capacity = capacity
+		self._send (source, sender, True)
+
+
+	def _open (self, source, sender):
+
+		source.FrameOpen = True
+		source.LevelReceived = False
+		source.CapacityReceived = False
+		source.Sequence += 1
+		TheScheduler.Schedule (FrameTimeoutInSeconds, self._timeout, sender, source.Sequence)
+
+
+	def _timeout (self, sender, sequence):
+
+		source = self.Sources.get (sender)
+		if source != None and source.FrameOpen and source.Sequence == sequence:
+			self.TimeoutCount += 1
+			self._flush (source, sender)
+
+
+	def _flush (self, source, sender):
+
+		source.FrameOpen = False
+		source.LevelReceived = False
+		source.CapacityReceived = False
+		if source.Tank == None:
+			self.OrphanCount += 1
+			return
+		self.FrameCount += 1
+		self._send (source, sender)
+
+
+	def _send (self, source, sender, poll = False):
+
+		if source.Tank == None:
+			return
+		self.FrameCallback (sender, source.Tank,
+				source.Level if source.Level != None else -99,
+				source.Capacity if source.Capacity != None else -99, poll)
+
+
+	def LogStatistics (self):
+
+		logging.info ("SeeLevel frames: %d assembled, %d by timeout, %d mis-assembled, %d without a tank",
+				self.FrameCount, self.TimeoutCount, self.MisassembledCount, self.OrphanCount)
+
+
+# a complete frame has been assembled - pass it to the repeater for that tank
+# the repeater is looked up (or created) in the registry from the source service, fluid type and instance
+# the multiplexed dBus service doesn't report a fluid instance, so instance 0 is used
+# poll is set for frames from a snapshot
+
+def SeeLevelFrame (sender, tank, level, capacity, poll):
+
+	source = SourcesByOwner.get (sender)
+	if source == None or tank < 0 or tank >= MaxFluidTypes:
+		return
+	TheRegistry.Get (source.Service, source.Rank, tank, 0).UpdateRepeater (level, capacity, poll)
+
+
+# unpack a snapshot of the SeeLevel service
+# GetValue on the root object returns every path of the service as a dictionary
+# (the same mechanism VeDbusTreeExport provides) so the values are consistent with each other
+# invalid values (empty arrays on the dBus) are returned as -99 so they are ignored by the repeater
+
+def UnpackSeeLevelSnapshot (value):
+
+	snapshot = unwrap_dbus_value (value)
+	if not isinstance (snapshot, dict):
+		return -99, -99, -99
+
+	tank = snapshot.get ('FluidType')
+	level = snapshot.get ('Level')
+	capacity = snapshot.get ('Capacity')
+
+	if tank == None:
+		tank = -99
+	if level == None:
+		level = -99
+	if capacity == None:
+		capacity = -99
+
+	return tank, level, capacity
+
+
+# SeeLevelSource holds the references for one bound multiplexed tank service
+#
+# PropertiesChanged match rules for /FluidType, /Level and /Capacity are scoped to the unique name
+# of the bound service so the bus daemon only forwards signals from that service
+# rather than from every tank (including the repeaters) and battery monitor on the bus
+# existing rules are removed first so they can be re-added when the service is rebound
+#
+# a NameOwnerChanged match rule for the service name marks the service lost when it leaves the bus
+# (e.g., the GUI process dies) and rebinds it as soon as a new owner appears
+# rather than waiting for the next search in CheckSeeLevel
+#
+# the bind count invalidates replies to requests made for a previous binding
+
+class SeeLevelSource:
+
+	def __init__ (self, service, productId, rank):
+
+		self.Service = service
+		self.ProductId = productId
+		self.Rank = rank
+		self.RootObject = None
+		self.UniqueName = ""
+		self.BindCount = 0
+		self.DbusOK = False
+		self.SignalMatches = []
+		self.OwnerMatch = TheBus.add_signal_receiver (self._ownerChanged, signal_name = 'NameOwnerChanged',
+				dbus_interface = 'org.freedesktop.DBus', path = '/org/freedesktop/DBus', arg0 = service)
+		self.LostTime = None		# MonotonicTime () when the service was lost
+		self.AlreadyLogged = False
+		self.SearchDelay = 0
+		self.SnapshotFailures = 0
+
+
+	def Bind (self):
+
+		self.RootObject = TheBus.get_object (self.Service, '/', introspect = False)
+		self._setUniqueName (TheBus.get_name_owner (self.Service))
+		self.BindCount += 1
+		self.DbusOK = True
+		self.AlreadyLogged = False
+		self.SnapshotFailures = 0
+		logging.info ("SeeLevel dBus connection established at:%s:" % self.Service) 
+
+# report how long the repeater was without the SeeLevel service
+		if self.LostTime != None:
+			logging.info ("SeeLevel %s reconnected %.1f ms after connection was lost",
+					self.Service, (MonotonicTime () - self.LostTime) * 1000)
+			self.LostTime = None
+
+# seed the frame assembler with the current values of the service
+		self.RequestSnapshot ()
+
+
+# the service is no longer wanted - remove all match rules
+
+	def Unbind (self):
+
+		self.DbusOK = False
+		self.BindCount += 1
+		ThePoller.Flush (('snapshot', self.Service))
+		self._setUniqueName ("")
+		if self.OwnerMatch != None:
+			self.OwnerMatch.remove ()
+			self.OwnerMatch = None
+
+
+	def _setUniqueName (self, uniqueName):
+
+		for match in self.SignalMatches:
+			match.remove ()
+		self.SignalMatches = []
+
+		if self.UniqueName != "":
+			TheAssembler.Reset (self.UniqueName)
+			SourcesByOwner.pop (self.UniqueName, None)
+		self.UniqueName = uniqueName
+		if uniqueName == "":
+			return
+		SourcesByOwner [uniqueName] = self
+
+		for handler, path in ( (FluidTypeHandler, '/FluidType'), (FluidLevelHandler, '/Level'),
+								(FluidCapacityHandler, '/Capacity') ):
+			self.SignalMatches.append (TheBus.add_signal_receiver (handler, path = path,
+					dbus_interface = 'com.victronenergy.BusItem', signal_name = 'PropertiesChanged',
+					bus_name = uniqueName, sender_keyword = "sender"))
+
+
+	def _ownerChanged (self, name, oldOwner, newOwner):
+
+		if newOwner == "":
+			self.DbusOK = False
+			ThePoller.Flush (('snapshot', self.Service))
+			if self.LostTime == None:
+				self.LostTime = MonotonicTime ()
+			logging.warning ("SeeLevel service %s left the dBus", name)
+			TheAssembler.LogStatistics ()
+			return
+
+		try:
+			self.Bind ()
+		except dbus.DBusException:
+			logging.warning ("SeeLevel service %s disappeared while reconnecting", name)
+
+
+# SeeLevel service is not responding
+
+	def Failed (self, error):
+
+		self.DbusOK = False
+		ThePoller.Flush (('snapshot', self.Service))
+		if self.LostTime == None:
+			self.LostTime = MonotonicTime ()
+		if self.AlreadyLogged == False:
+			logging.warning ("No response from SeeLevel at:%s: %s", self.Service, error)
+			TheAssembler.LogStatistics ()
+			self.AlreadyLogged = True
+
+
+# request a snapshot of the SeeLevel service
+# the reply is ignored if the service has been rebound in the meantime
+
+	def RequestSnapshot (self):
+
+		bindCount = self.BindCount
+		sender = self.UniqueName
+		ThePoller.Submit (('snapshot', self.Service), self.RootObject, 'GetValue',
+				lambda value: self._snapshotReply (bindCount, sender, value),
+				lambda error: self._snapshotError (bindCount, error))
+
+
+	def _snapshotReply (self, bindCount, sender, value):
+
+		if bindCount != self.BindCount or self.DbusOK == False:
+			return
+
+		self.SnapshotFailures = 0
+		tank, level, capacity = UnpackSeeLevelSnapshot (value)
+		TheAssembler.Snapshot (sender, tank, level, capacity)
+
+
+	def _snapshotError (self, bindCount, error):
+
+		if bindCount != self.BindCount or self.DbusOK == False:
+			return
+		self.SnapshotFailures += 1
+		if self.SnapshotFailures < SeeLevelMaxSnapshotFailures:
+			logging.info ("SeeLevel %s snapshot failed (%d in a row): %s", self.Service, self.SnapshotFailures, error)
+			return
+		self.Failed (error)
+
+
+# returns the list of product IDs to look for
+# the first entry is the original SeeLevelProductId setting, others come from the
+# comma separated SeeLevelProductIdList setting
+# an empty list is returned if the repeater is disabled (SeeLevelProductId == -1)
+
+def SeeLevelProductIds ():
+
+	productId = NvSettings['seeLevelProdIdNv']
+	if productId == -1:
+		return []
+
+	productIds = [ productId ]
+	for item in NvSettings['seeLevelProdIdListNv'].split (','):
+		try:
+			productId = int (item)
+		except ValueError:
+			continue
+		if productId not in productIds:
+			productIds.append (productId)
+	return productIds
+
+
+# the source rank of each SeeLevel service bound so far is kept
+# in /Settings/Devices/TankRepeater/SeeLevelServiceRanks (<service>:<rank> separated by commas)
+# so a service keeps its repeater names after a restart
+# whatever order the services are found in (e.g. two senders with the same product ID)
+
+def SeeLevelServiceRanks ():
+
+	ranks = {}
+	for entry in NvSettings['seeLevelRanksNv'].split (','):
+		service, separator, rank = entry.rpartition (':')
+		try:
+			ranks[service] = int (rank)
+		except ValueError:
+			pass
+	return ranks
+
+
+# bind a service found to match one of the product IDs
+# a service that has been bound before gets its saved rank back (unless a bound service has it)
+# otherwise the source rank (used to name repeater services) is the position of the product ID in the list
+# additional services with the same product ID get the next free rank after the list
+# ranks saved for other services are not given out
+
+def BindSeeLevel (service, productId, productIds):
+
+	savedRanks = SeeLevelServiceRanks ()
+	usedRanks = set (source.Rank for source in SeeLevelSources.values ())
+	rank = savedRanks.get (service)
+	if rank == None or rank in usedRanks:
+		usedRanks.update (savedRank for name, savedRank in savedRanks.items () if name != service)
+		rank = productIds.index (productId)
+		if rank in usedRanks:
+			rank = len (productIds)
+			while rank in usedRanks:
+				rank += 1
+	if savedRanks.get (service) != rank:
+		savedRanks[service] = rank
+		NvSettings['seeLevelRanksNv'] = ",".join ("%s:%d" % entry for entry in sorted (savedRanks.items ()))
+		logging.info ("SeeLevel service %s is source rank %d", service, rank)
+
+	source = SeeLevelSource (service, productId, rank)
+	SeeLevelSources [service] = source
+	try:
+		source.Bind ()
+	except dbus.DBusException:
+		logging.warning ("SeeLevel service %s disappeared while connecting", service)
+		source.Unbind ()
+		del SeeLevelSources [service]
+		return
+	UpdateSeeLevelNames ()
+
+
+def UnbindSeeLevel (service):
+
+	source = SeeLevelSources.pop (service)
+	source.Unbind ()
+	logging.info ("SeeLevel service %s no longer used", service)
+	UpdateSeeLevelNames ()
+
+
+# Nv copy of the service names which is used by the GUI to hide the SeeLevel tanks
+# multiple names are separated by commas
+
+def UpdateSeeLevelNames ():
+
+	NvSettings['seeLevelNameNv'] = ",".join (sorted (SeeLevelSources.keys ()))
+
+
+# a tank service's product ID is known - bind it if it is a SeeLevel service we're looking for
+# (a pending product ID change is handled by CheckSeeLevel)
+
+def TankServiceFound (service, productId):
+
+	if NewSeeLevelProdId or service in SeeLevelSources:
+		return
+	productIds = SeeLevelProductIds ()
+	if productId in productIds:
+		BindSeeLevel (service, productId, productIds)
+		ScheduleSeeLevelCheck (SeeLevelScanPeriodInSeconds)
+
+
+# check to see if SeeLevel dBus objects exist
 # innitialize object pointers if so
 # invalidate object pointers if not
 
 # signal handlers are the primary update for level and capacity unless there is only one tank
 # or values don't change between tanks, so we still need to poll for values here
 
-# dbus exceptions will occur if SeeLevel object doesn't exist (normal)
+# all reads from tank services are made through ThePoller so this routine never waits for a reply
+# the SeeLevel services are looked up in TheIndex so finding them doesn't require a bus scan
+# dbus errors will occur if SeeLevel object doesn't exist (normal)
 # or if the GUI isn't running (CanBus runs from GUI thread) (also expected)
 
 
-def CheckSeeLevel():
+# CheckSeeLevel is run through TheScheduler
+# it reschedules itself while there are SeeLevel services to poll or retry
+# and is scheduled immediately when the product ID settings change
 
-	global SeeLevelUniqueName
-	global SeeLevelDbusOK
-	global NvSettings
+def ScheduleSeeLevelCheck (delay):
 
-	global SeeLevelTankObject
-	global SeeLevelFluidLevelObject
-	global SeeLevelCapacityObject
+	global SeeLevelCheckHandle
+
+	SeeLevelCheckHandle = TheScheduler.Reschedule (SeeLevelCheckHandle, delay, CheckSeeLevel)
+
+
+def CheckSeeLevel():
 
 	global NewSeeLevelProdId
 
-	global RepeaterList
-	global LastTank
-	global LastLevel
-	global LastCapacity
-	global TheBus
-	global NoLevelCount
-	global NoCapacityCount
-	global AlreadyLogged
-	global SeeLevelSearchDelay
-
-	SeeLevelSearchDelay += 1
-	if SeeLevelSearchDelay > 10:
-		SeeLevelSearchDelay = 0
-	
 	try:
 
-# check for SeeLevel service present
-# done every 10 passes (seconds) if a service hasn't already been found
-# or immediately if a new product ID from non-volatile setting is pending
-# productId == -1 disables search for service - SeeLevel service name is cleared so GUI will not hide it in the tanks list
-		if (SeeLevelDbusOK == False and SeeLevelSearchDelay == 0) or NewSeeLevelProdId == True:
-			nvProductId = NvSettings['seeLevelProdIdNv']
-			if nvProductId == -1 and NewSeeLevelProdId == True:
-				logging.warning ("SeeLevel Repeater disabled")
-				NvSettings['seeLevelNameNv'] = ""
-
+# when the product IDs change, drop services that no longer match and bind new ones
+# services that appear later are bound as soon as TheIndex learns their product ID (see TankServiceFound)
+# productId == -1 disables search for services - SeeLevel service name is cleared so GUI will not hide it in the tanks list
+		if NewSeeLevelProdId == True:
 			NewSeeLevelProdId = False
-			SeeLevelDbusOK = False
-			SeeLevelSearchDelay = 0
-
-			for service in TheBus.list_names():
-# ignore repeater services
-				if service.startswith(RepeaterServiceName):
-					continue
-# found a match - stop looking
-				if service.startswith("com.victronenergy.tank") \
-						and TheBus.get_object(service, '/ProductId').GetValue() == nvProductId:
-					SeeLevelDbusOK = True
-					break
-
-# found a matching service - now set up SeeLevel references
-# including Nv copy of service name which is used by the GUI to hide the SeeLevel tank
-			if SeeLevelDbusOK:
-				SeeLevelTankObject = TheBus.get_object(service, '/FluidType')
-				SeeLevelFluidLevelObject = TheBus.get_object(service, '/Level')
-				SeeLevelCapacityObject = TheBus.get_object (service, '/Capacity')
-				SeeLevelUniqueName = TheBus.get_name_owner(service)
-				LastTank = -99
-				NoLevelCount = 0
-				NoCapacityCount = 0
-				AlreadyLogged = False
-				logging.info ("SeeLevel dBus connection established at:%s:" % service) 
-				NvSettings['seeLevelNameNv'] = service
-
-# skip processing if no SeeLevel service
-		if SeeLevelDbusOK == False:
-			return True
+			productIds = SeeLevelProductIds ()
+			if len (productIds) == 0:
+				logging.warning ("SeeLevel Repeater disabled")
 
-# do a background update to the associated repeater
-		tank = SeeLevelTankObject.GetValue()
-		level = SeeLevelFluidLevelObject.GetValue()
-		capacity = SeeLevelCapacityObject.GetValue ()
-		tank2 = SeeLevelTankObject.GetValue()
+			for service, source in SeeLevelSources.items ():
+				if source.ProductId not in productIds:
+					UnbindSeeLevel (service)
+			for productId in productIds:
+				for service in TheIndex.FindAll (productId):
+					if service not in SeeLevelSources:
+						BindSeeLevel (service, productId, productIds)
+			UpdateSeeLevelNames ()
+
+# retry a service that has stopped responding every 10 passes (seconds)
+		for source in SeeLevelSources.values ():
+			if source.DbusOK:
+				continue
+			source.SearchDelay += 1
+			if source.SearchDelay > 10 and TheIndex.ProductIds.get (source.Service) == source.ProductId:
+				source.SearchDelay = 0
+				try:
+					source.Bind ()
+				except dbus.DBusException:
+					pass
 
 	except dbus.DBusException:
-		SeeLevelDbusOK = False
-		if AlreadyLogged == False:
-			logging.warning ("No response from SeeLevel at:%s:", NvSettings['seeLevelNameNv'])
-			AlreadyLogged = True
-		return True
-
+		pass
 
-# update the repeater's level and capacity values from the poll
-# range check tank before using it as an array index
-	if tank >= 0 and tank < len(RepeaterList) and tank == tank2:
-		RepeaterList [tank].UpdateRepeater (level, capacity)
+# request a background update to the associated repeaters
+	for source in SeeLevelSources.values ():
+		if source.DbusOK:
+			source.RequestSnapshot ()
 
-# wait 10 passes before doing anything to give signals a chance to be received
-# if level signals are not being received but tank number signals ARE being received
-# the level of all tanks is probalby the same, so set LastLevel from the polled value
-	if (LastLevel == -99 and LastTank != -99 and level != -99):
-		NoLevelCount += 1					
-		if NoLevelCount > 10:
-			LastLevel = level
-			logging.info ("No /Level signals have been received - using polled data") 
-	else:
-		NoLevelCount = 0
-
-# ditto for capacity
-	if (LastCapacity == -99 and LastTank != -99 and capacity != -99):
-		NoCapacityCount += 1					
-		if NoCapacityCount > 10:
-			LastCapacity = capacity
-			logging.info ("No /Capacity signals have been received - using polled data") 
-	else:
-		NoCapacityCount = 0
-
-	return True
+	if len (SeeLevelSources) > 0:
+		ScheduleSeeLevelCheck (SeeLevelScanPeriodInSeconds)
 
 
 # signal handlers
+# signals are only delivered from bound SeeLevel services (see SeeLevelSource)
+# values are passed to the frame assembler which sends complete frames to the repeaters
 
 def FluidTypeHandler (changes, sender):
 
-	global SeeLevelUniqueName
-	global SeeLevelDbusOK
-	global LastTank
-	global LastLevel
-	global LastCapacity
-
-# ignore signal if it's not from the SeeLevel service
-	if SeeLevelDbusOK == False or sender != SeeLevelUniqueName:
+	source = SourcesByOwner.get (sender)
+	if source == None or source.DbusOK == False:
 		return
 
 # test value as text to identify an invaild value before extracting the actual value
@@ -488,59 +2090,134 @@ def FluidTypeHandler (changes, sender):
 	if changes.get ("Text") == "":
 		return
 
-	tank = int (changes.get ("Value"))
-
-# Update the repeater based on PREVIOUS tank, level and capacity before saving the current tank for next call
-# range check tank and level before processing
-	if LastTank >= 0 and LastTank < len(RepeaterList):
-		RepeaterList [LastTank].UpdateRepeater (LastLevel, LastCapacity)
-
-# save new fluid type for processing on next call to this handler
-	LastTank = tank
+	TheAssembler.FluidType (sender, int (changes.get ("Value")))
 
 	return
 
 
 def FluidLevelHandler (changes, sender):
 
-	global SeeLevelUniqueName
-	global SeeLevelDbusOK
-	global LastLevel
-
-# ignore signal if it's not from the SeeLevel service
-	if SeeLevelDbusOK == False or sender != SeeLevelUniqueName:
+	source = SourcesByOwner.get (sender)
+	if source == None or source.DbusOK == False:
 		return
 
-# save level for processing during next call of FluidTypeHandler
 # test value as text to identify an invaild value before extracting the actual value
 	if changes.get ("Text") != "":
-		LastLevel = float (changes.get ("Value"))
+		TheAssembler.Level (sender, float (changes.get ("Value")))
 
 	return
 
 
 def FluidCapacityHandler (changes, sender):
 
-	global SeeLevelUniqueName
-	global SeeLevelDbusOK
-	global LastCapacity
-
-# ignore signal if it's not from the SeeLevel service
-	if SeeLevelDbusOK == False or sender != SeeLevelUniqueName:
+	source = SourcesByOwner.get (sender)
+	if source == None or source.DbusOK == False:
 		return
 
-# save capacity for processing during next call of FluidTypeHandler
 # test value as text to identify an invaild value before extracting the actual value
 	if changes.get ("Text") != "":
-		LastCapacity = float (changes.get ("Value"))
+		TheAssembler.Capacity (sender, float (changes.get ("Value")))
 
 	return
 
+# N2K backend (--can or --candump)
+# instead of the SeeLevel dBus service, PGN 127505 Fluid Level frames are read from a SocketCAN interface
+# or replayed from a candump log file and decoded by TheDecoder (see n2kfluidlevel.py)
+# every frame is a complete report for one tank so it goes straight to the tank's repeater
+# without the frame assembler, the SeeLevel service polling or the GUI process
+# each sender (source address) is a separate source named <interface>.<source address>
+# senders are ranked in the order they are first heard and the rank of each source address is kept
+# in /Settings/Devices/TankRepeater/N2kSourceRanks (<address>:<rank> separated by commas)
+# so each sender keeps its repeater names whatever order the senders are heard in after a restart
+# candump files are replayed at the pace of their time stamps through TheScheduler
+
+TheDecoder = None
+TheCanReader = None
+N2kInterface = None
+CandumpFrames = None
+CandumpPending = None
+CandumpOffset = None
+
+# source address -> rank
+N2kRanks = {}
+
+
+def LoadN2kRanks ():
+
+	N2kRanks.clear ()
+	for entry in NvSettings['n2kSourceRanksNv'].split (','):
+		address, separator, rank = entry.partition (':')
+		try:
+			N2kRanks[int (address)] = int (rank)
+		except ValueError:
+			pass
+
+
+# returns the rank of a sender, giving a new sender the lowest free rank
+
+def N2kSourceRank (sourceAddress):
+
+	rank = N2kRanks.get (sourceAddress)
+	if rank == None:
+		usedRanks = set (N2kRanks.values ())
+		rank = 0
+		while rank in usedRanks:
+			rank += 1
+		N2kRanks[sourceAddress] = rank
+		NvSettings['n2kSourceRanksNv'] = ",".join ("%d:%d" % entry for entry in sorted (N2kRanks.items ()))
+		logging.info ("N2K sender %d is source rank %d", sourceAddress, rank)
+	return rank
+
+
+def N2kFluidLevel (sourceAddress, instance, fluidType, level, capacity):
+
+	source = "%s.%d" % (N2kInterface, sourceAddress)
+	TheRegistry.Get (source, N2kSourceRank (sourceAddress), fluidType, instance).UpdateRepeater (level, capacity)
+
+
+# called from the main loop when the CAN socket is readable
+
+def CanReadable (fd, condition):
+
+	try:
+		frame = TheCanReader.Read ()
+	except OSError as e:
+		logging.error ("CAN read from %s failed: %s", N2kInterface, e)
+		return True
+	if frame != None:
+		TheDecoder.Frame (frame[0], frame[1])
+	return True
+
+
+def ReplayCandump ():
+	global CandumpPending
+	global CandumpOffset
+
+	while True:
+		if CandumpPending == None:
+			try:
+				CandumpPending = next (CandumpFrames)
+			except StopIteration:
+				logging.info ("candump replay finished: %d frames, %d tank reports",
+						TheDecoder.FrameCount, TheDecoder.DecodedCount)
+				return
+		timeStamp, interface, canId, data = CandumpPending
+		if timeStamp != None:
+			if CandumpOffset == None:
+				CandumpOffset = MonotonicTime () - timeStamp
+			delay = timeStamp + CandumpOffset - MonotonicTime ()
+			if delay > 0:
+				TheScheduler.Schedule (delay, ReplayCandump)
+				return
+		CandumpPending = None
+		TheDecoder.Frame (canId, data)
+
+
 #declare a global for non-volatile settings
 NvSettings = ''
 
 
-# NV copy of SeeLevel service Product Id changed
+# NV copy of SeeLevel service Product Id (or list of additional product IDs) changed
 # set the flag - value change handled elsewnere
 # SeeLevel service name comes in here also
 # (This code only sets productId so ignore changes for service name)
@@ -548,8 +2225,15 @@ NvSettings = ''
 def SeeLevelSettingChanged (name, old, new):
 	global NewSeeLevelProdId
 
-	if name == 'seeLevelProdIdNv':
+	if TheTankSettings != None and TheTankSettings.SettingChanged (name, old, new):
+		return
+
+# the N2K backend doesn't use the SeeLevel services (there is no TheIndex to look them up in)
+	if name == 'seeLevelProdIdNv' or name == 'seeLevelProdIdListNv':
+		if TheIndex == None:
+			return
 		NewSeeLevelProdId = True
+		ScheduleSeeLevelCheck (0)
 
 #	elif name == 'seeLevelNameNv':
 		# do nothing
@@ -561,8 +2245,31 @@ def main():
 	from dbus.mainloop.glib import DBusGMainLoop
 
 	global TheBus
-	global SeeLevelServiceChanged
+	global ThePoller
+	global TheIndex
+	global TheAssembler
+	global TheRegistry
+	global TheScheduler
 	global NvSettings
+	global TheTankSettings
+	global TheDecoder
+	global TheCanReader
+	global N2kInterface
+	global CandumpFrames
+	global HistoryDirectory
+	global TankStateFile
+
+	parser = argparse.ArgumentParser (description = 'SeeLevel N2K tank repeater')
+	backend = parser.add_mutually_exclusive_group ()
+	backend.add_argument ('--can', metavar = 'INTERFACE',
+			help = 'read PGN 127505 frames from this SocketCAN interface (e.g. can0 or vcan0) instead of the SeeLevel dBus service')
+	backend.add_argument ('--candump', metavar = 'FILE',
+			help = 'replay PGN 127505 frames from a candump log file instead of reading the SeeLevel dBus service')
+	parser.add_argument ('--data', metavar = 'DIRECTORY', default = DataDirectory,
+			help = 'directory for the tank state and history files (default %s)' % DataDirectory)
+	args = parser.parse_args ()
+	HistoryDirectory = os.path.join (args.data, 'history')
+	TankStateFile = os.path.join (args.data, 'tankState.json')
 
 # set logging level to include info level entries
 	logging.basicConfig(level=logging.INFO)
@@ -572,37 +2279,75 @@ def main():
 
         logging.info (">>>>>>>>>>>>>>>> SeeLevel Repeater Starting <<<<<<<<<<<<<<<<")
 
-# create repeaters for all tanks
+# all timers run from a single scheduler
+	TheScheduler = DeadlineScheduler ()
+
+# repeaters are created by the registry as tanks are reported
 # dBus services are NOT created at this time to save GUI clutter
-	for tank in range (len(RepeaterList)):
-		RepeaterList [tank] = Repeater (tank)
-
-
-# install a signal handler for /FluidType and /Level
-	TheBus = dbus.SystemBus()
-	TheBus.add_signal_receiver (FluidTypeHandler, path = "/FluidType",
-                dbus_interface='com.victronenergy.BusItem', signal_name='PropertiesChanged',
-		sender_keyword="sender")
-	TheBus.add_signal_receiver (FluidLevelHandler, path = "/Level",
-                dbus_interface='com.victronenergy.BusItem', signal_name='PropertiesChanged',
-		sender_keyword="sender")
-	TheBus.add_signal_receiver (FluidCapacityHandler, path = "/Capacity",
-                dbus_interface='com.victronenergy.BusItem', signal_name='PropertiesChanged',
-		sender_keyword="sender")
+	TheRegistry = RepeaterRegistry ()
+
+# signal handlers for /FluidType, /Level and /Capacity are installed when a SeeLevel service is bound
+# the session bus is used if there is one (for testing off the Venus device), as for the repeater services
+	TheBus = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
 
 # create non-volatile setting for SeeLevel dBus service name and productId
 # installer will modify in productId via dbus-spy if necessary when setting things up - default is 41312
-# service name is set up by CheckSeeLevel above if service is found matching the productId
-# the GUI uses the service name to hide the SeeLevel dBus service
+# additional product IDs (e.g., a second multiplexed N2K tank sender) can be added to SeeLevelProductIdList
+# separated by commas
+# service names are set up by CheckSeeLevel above if services are found matching the productId
+# the GUI uses the service names to hide the SeeLevel dBus services
 # SettingsDevice could be called early in system boot so wait up to 10 seconds before giving up
 
 	SETTINGS = {	'seeLevelNameNv': ['/Settings/Devices/TankRepeater/SeeLevelService', '', 0, 0],
-			'seeLevelProdIdNv': ['/Settings/Devices/TankRepeater/SeeLevelProductId', 41312, -1, 999999] }
+			'seeLevelProdIdNv': ['/Settings/Devices/TankRepeater/SeeLevelProductId', 41312, -1, 999999],
+			'seeLevelProdIdListNv': ['/Settings/Devices/TankRepeater/SeeLevelProductIdList', '', 0, 0],
+			'knownTanksNv': ['/Settings/Devices/TankRepeater/KnownTanks', '', 0, 0],
+			'seeLevelRanksNv': ['/Settings/Devices/TankRepeater/SeeLevelServiceRanks', '', 0, 0],
+			'n2kSourceRanksNv': ['/Settings/Devices/TankRepeater/N2kSourceRanks', '', 0, 0] }
 
 	NvSettings = SettingsDevice(TheBus, SETTINGS, SeeLevelSettingChanged, timeout = 10)
 
-# periodically look for SeeLevel service
-	gobject.timeout_add(SeeLevelScanPeriod, CheckSeeLevel)
+# the settings of all tanks are held in NvSettings as well
+	TheTankSettings = TankSettings (NvSettings)
+
+# publish the last known tank values until the SeeLevel service is found
+	RestoreTankState ()
+
+# N2K backend: tank reports come from CAN frames instead of the SeeLevel dBus service
+	if args.can != None or args.candump != None:
+		LoadN2kRanks ()
+		TheDecoder = FluidLevelDecoder (N2kFluidLevel)
+		if args.can != None:
+			N2kInterface = args.can
+			TheCanReader = SocketCanReader (args.can)
+			gobject.io_add_watch (TheCanReader.Fd, gobject.IO_IN, CanReadable)
+			logging.info ("reading tank reports from %s", args.can)
+		else:
+			N2kInterface = 'candump'
+			try:
+				candumpFile = open (args.candump)
+			except IOError as e:
+				logging.error ("can't read candump file %s: %s", args.candump, e)
+				sys.exit (1)
+			CandumpFrames = ReadCandump (candumpFile)
+			TheScheduler.Schedule (0, ReplayCandump)
+			logging.info ("replaying tank reports from %s", args.candump)
+
+		mainloop = gobject.MainLoop()
+		mainloop.run()
+		return
+
+# all SeeLevel service reads are made asynchronously through the poller
+	ThePoller = AsyncPoller (SeeLevelMaxRequestsInFlight, SeeLevelRequestTimeoutInSeconds)
+
+# signals from the SeeLevel services are assembled into frames for the repeaters
+	TheAssembler = FrameAssembler (SeeLevelFrame)
+
+# build the tank service index - product IDs arrive asynchronously
+	TheIndex = TankServiceIndex (TheBus, ThePoller, TankServiceFound)
+
+# look for SeeLevel services now - CheckSeeLevel continues periodically once one is found
+	ScheduleSeeLevelCheck (0)
 
 	mainloop = gobject.MainLoop()
 	mainloop.run()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+# end to end benchmark of the repeater pipeline with a synthetic SeeLevel sender
+#
+# for each scenario the unmodified repeater (SeeLevelRepeater.py) is started on a private session bus
+# with stand-ins for localsettings and the SeeLevel service (SeeLevelEmulator)
+# once the repeater has bound the emulator's service, the emulator reports for --warmup seconds
+# (so the repeater services exist and their start-up delay is not measured)
+# then for --duration seconds while RepeaterMonitor matches every level sent with the repeater's /Level
+#
+# reported for each scenario:
+#	tank reports sent, level changes missed by the repeater (never published), latency from the emulator's write
+#	to the repeater's /Level (median, 90th percentile, maximum), /Connected timeouts,
+#	repeater CPU time per tank report and in %, and its resident memory at the end
+#
+# nothing but a dBus daemon is needed, no Venus device or CAN hardware:
+#	dbus-run-session -- python benchmarks/repeater_pipeline.py
+#	dbus-run-session -- python benchmarks/repeater_pipeline.py --scenarios burst,fast --duration 120 --per-tank
+# with --no-repeater the repeater is not started (start it yourself on the same bus, e.g. under a profiler,
+# with --data <directory> so it doesn't use the tank state and history in /data/TankRepeater)
+# each scenario's repeater keeps its tank state and history in a temporary directory that is removed when it stops
+
+import os
+import sys
+import time
+import logging
+import argparse
+import gobject
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../tools'))
+from seelevel_standin import StandInSettings, RepeaterMonitor, MeasurementSettings, RequireSessionBus, \
+		StartRepeater, StopRepeater, ProcessUsage, Percentile, PrintResults
+from seelevel_emulator import SeeLevelEmulator
+
+EmulatorService = 'com.victronenergy.tank.socketcan_vcan0_di0_uc41312'
+EmulatorProductId = 41312
+SeeLevelServiceSetting = '/Settings/Devices/TankRepeater/SeeLevelService'
+
+# emulator settings of each scenario (see SeeLevelEmulator)
+
+Scenarios = {
+	'rotation': { 'ReportInterval': 1.0 },
+	'burst': { 'Burst': True, 'ReportInterval': 0.02, 'BurstPeriod': 3.5 },
+	'identical': { 'Burst': True, 'ReportInterval': 0.02, 'BurstPeriod': 3.5, 'Identical': True },
+	'fast': { 'ReportInterval': 0.02 },
+	'dropout': { 'ReportInterval': 1.0, 'DropOutPeriod': 20.0, 'DropOutLength': 3.0 },
+	}
+ScenarioOrder = [ 'rotation', 'burst', 'identical', 'fast', 'dropout' ]
+
+
+class ScenarioRun:
+
+	def __init__ (self, bus, settings, name, args, mainloop):
+
+		self.Bus = bus
+		self.Name = name
+		self.Args = args
+		self.MainLoop = mainloop
+		self.Monitor = None
+		self.Repeater = None
+		self.Failed = False
+		self.Cpu = 0.0
+		self.Rss = 0
+		self.Frames = 0
+		self.Elapsed = 0.0
+
+		self.Emulator = SeeLevelEmulator (bus, EmulatorService, EmulatorProductId,
+				[ int (tank) for tank in args.tanks.split (',') ])
+		for attribute, value in Scenarios[name].items ():
+			setattr (self.Emulator, attribute, value)
+
+# the previous repeater's binding is forgotten so the new one is seen binding the emulator
+		if SeeLevelServiceSetting in settings:
+			settings[SeeLevelServiceSetting] = ''
+		settings.ChangedCallback = self._settingChanged
+
+		if not args.no_repeater:
+			self.Repeater = StartRepeater (args.repeater_log)
+		self.StartTimer = gobject.timeout_add (int (args.start_timeout * 1000), self._startTimeout)
+
+
+	def _settingChanged (self, path, value):
+
+		if path != SeeLevelServiceSetting or EmulatorService not in value.split (',') or self.Emulator.Running:
+			return
+		gobject.source_remove (self.StartTimer)
+		self.Emulator.Start ()
+		gobject.timeout_add (int (self.Args.warmup * 1000), self._measure)
+
+
+	def _startTimeout (self):
+
+		logging.error ("%s: the repeater did not bind the emulator within %.0f seconds", self.Name, self.Args.start_timeout)
+		self.Failed = True
+		self.MainLoop.quit ()
+		return False
+
+
+	def _measure (self):
+
+		self.Monitor = RepeaterMonitor (self.Bus)
+		self.Emulator.Monitor = self.Monitor
+		self.StartFrames = self.Emulator.Frames
+		self.StartTime = time.time ()
+		if self.Repeater != None:
+			self.Cpu = ProcessUsage (self.Repeater.pid)[0]
+		gobject.timeout_add (int (self.Args.duration * 1000), self._stop)
+		return False
+
+
+	def _stop (self):
+
+		self.Emulator.Monitor = None
+		self.Frames = self.Emulator.Frames - self.StartFrames
+		self.Elapsed = time.time () - self.StartTime
+		if self.Repeater != None:
+			cpu, self.Rss = ProcessUsage (self.Repeater.pid)
+			self.Cpu = cpu - self.Cpu
+		else:
+			self.Cpu = None
+		self.Emulator.Stop ()
+		gobject.timeout_add (int (self.Args.settle * 1000), self._finish)
+		return False
+
+
+	def _finish (self):
+
+		self.Monitor.Finish ()
+		self.Monitor.Close ()
+		self.MainLoop.quit ()
+		return False
+
+
+	def Close (self):
+
+		self.Emulator.Stop ()
+		if self.Repeater != None:
+			StopRepeater (self.Repeater)
+
+
+def Summary (run):
+
+	sent = sum (tank.Sent for tank in run.Monitor.Tanks.values ())
+	missed = sum (tank.Missed for tank in run.Monitor.Tanks.values ())
+	timeouts = sum (tank.Disconnects for tank in run.Monitor.Tanks.values ())
+	latencies = []
+	for tank in run.Monitor.Tanks.values ():
+		latencies.extend (tank.Latencies)
+	cpu = "%9.1f %7.2f" % (1e6 * run.Cpu / run.Frames if run.Frames > 0 else 0.0, 100.0 * run.Cpu / run.Elapsed) \
+			if run.Cpu != None else "%9s %7s" % ('-', '-')
+	print ("%-10s %8d %8d %8.2f %8.1f %8.1f %8.1f %8d %s %8d" % (run.Name, run.Frames, sent,
+			100.0 * missed / sent if sent > 0 else 0.0, Percentile (latencies, 0.5) * 1000,
+			Percentile (latencies, 0.9) * 1000, max (latencies) * 1000 if latencies else float ('nan'),
+			timeouts, cpu, run.Rss))
+
+
+def main ():
+
+	parser = argparse.ArgumentParser (description = 'SeeLevel repeater pipeline benchmark (emulated sender, private session bus)')
+	parser.add_argument ('--scenarios', default = ','.join (ScenarioOrder), help = 'comma separated, from: ' + ', '.join (ScenarioOrder))
+	parser.add_argument ('--tanks', default = '1,2,5', help = 'comma separated fluid types of the emulated tanks (default 1,2,5)')
+	parser.add_argument ('--duration', type = float, default = 60, help = 'seconds measured in each scenario (default 60)')
+	parser.add_argument ('--warmup', type = float, default = 5, help = 'seconds before measuring (default 5)')
+	parser.add_argument ('--settle', type = float, default = 2, help = 'seconds to wait for the repeater after the last report (default 2)')
+	parser.add_argument ('--start-timeout', type = float, default = 60, help = 'seconds to wait for the repeater to start (default 60)')
+	parser.add_argument ('--no-repeater', action = 'store_true', help = 'do not start the repeater')
+	parser.add_argument ('--repeater-log', default = 'repeater.log', help = 'file for the repeater output (default repeater.log)')
+	parser.add_argument ('--per-tank', action = 'store_true', help = 'also print the results of each tank')
+	args = parser.parse_args ()
+
+	names = args.scenarios.split (',')
+	for name in names:
+		if name not in Scenarios:
+			parser.error ("unknown scenario %s" % name)
+
+	logging.basicConfig (level = logging.WARNING)
+	RequireSessionBus ()
+	DBusGMainLoop (set_as_default = True)
+	bus = dbus.SessionBus ()
+	mainloop = gobject.MainLoop ()
+
+	overrides = dict (MeasurementSettings)
+	overrides['SeeLevelProductId'] = EmulatorProductId
+	settings = StandInSettings (bus, overrides)
+
+	runs = []
+	for name in names:
+		run = ScenarioRun (bus, settings, name, args, mainloop)
+		try:
+			mainloop.run ()
+		finally:
+			run.Close ()
+		if run.Failed:
+			break
+		runs.append (run)
+		if args.per_tank:
+			print ("%s:" % name)
+			PrintResults (run.Monitor, run.Frames, run.Cpu, run.Rss, run.Elapsed)
+			print ("")
+
+	print ("%-10s %8s %8s %8s %8s %8s %8s %8s %9s %7s %8s" % ('scenario', 'reports', 'changes', 'missed %',
+			'lat p50', 'lat p90', 'lat max', 'timeouts', 'us/report', 'cpu %', 'rss kB'))
+	for run in runs:
+		Summary (run)
+	print ("")
+	print ("changes: level changes sent, missed: changes the repeater never published")
+	print ("latency: emulator write to repeater /Level (ms), timeouts: times a repeater set /Connected to 0")
+	print ("us/report: repeater CPU time (user + system) per tank report, rss: repeater resident memory at the end")
+
+
+main ()
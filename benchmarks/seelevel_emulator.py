@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# synthetic SeeLevel tank sender for benchmarks/repeater_pipeline.py
+#
+# SeeLevelEmulator exports a multiplexed tank service (StandInTankService, a VeDbusService - see tools/seelevel_standin.py)
+# and reports its tanks one after the other, as the GUI's N2K driver does for a SeeLevel system:
+#	rotation: one tank report every ReportInterval seconds
+#	burst: all tanks ReportInterval apart, then silence until BurstPeriod seconds after the start of the burst
+#	(the mode described in the SeeLevelRepeater.py header)
+# each report changes the tank's level by LevelStep percent (down, wrapping from 0 to 100)
+# with Identical set all tanks report the same level, which changes once per rotation,
+# so no /Level signal is sent between the tanks of a rotation
+# with LevelStep 0 levels never change (as when all tanks are empty)
+# every DropOutPeriod seconds the service leaves the dBus for DropOutLength seconds (as when the GUI restarts)
+#
+# reports are made at deadlines so timer delays don't add up over a long run
+# each level sent is passed to the monitor (see RepeaterMonitor) just before it is written
+
+import time
+import gobject
+
+from seelevel_standin import StandInTankService
+
+
+class SeeLevelEmulator:
+
+	def __init__ (self, bus, service, productId, tanks, capacity = 0.2):
+
+		self.Bus = bus
+		self.ServiceName = service
+		self.ProductId = productId
+		self.Tanks = tanks
+		self.Capacity = capacity
+		self.ReportInterval = 1.0
+		self.Burst = False
+		self.BurstPeriod = 3.5
+		self.Identical = False
+		self.LevelStep = 0.5
+		self.DropOutPeriod = 0
+		self.DropOutLength = 3.0
+		self.Monitor = None
+
+		self.Service = StandInTankService (bus, service, productId)
+		self.Levels = [ 50.0 + 10 * i for i in range (len (tanks)) ]
+		self.Index = 0
+		self.Frames = 0
+		self.DropOuts = 0
+		self.Running = False
+		self.Deadline = None
+		self.BurstStart = None
+		self.Last = (None, None, None)
+
+
+	def Start (self):
+
+		self.Running = True
+		self.Deadline = time.time ()
+		self.BurstStart = self.Deadline
+		gobject.idle_add (self._report)
+		if self.DropOutPeriod > 0:
+			gobject.timeout_add (int (self.DropOutPeriod * 1000), self._dropOut)
+
+
+# stops reporting and removes the service from the dBus
+
+	def Stop (self):
+
+		self.Running = False
+		if self.Service != None:
+			self.Service.__del__ ()
+			self.Service = None
+
+
+	def _level (self):
+
+		if self.Identical:
+			index = 0
+			if self.Index == 0:
+				self.Levels[0] = self._step (self.Levels[0])
+		else:
+			index = self.Index
+			self.Levels[index] = self._step (self.Levels[index])
+		return self.Levels[index]
+
+
+	def _step (self, level):
+
+		level -= self.LevelStep
+		if level < 0:
+			level += 100
+		return round (level, 3)
+
+
+	def _report (self):
+
+		if not self.Running:
+			return False
+		fluidType = self.Tanks[self.Index]
+		level = self._level ()
+		self.Last = (fluidType, level, self.Capacity)
+		if self.Service != None:
+			if self.Monitor != None:
+				self.Monitor.Sent (fluidType, level)
+			self.Service.Report (*self.Last)
+			self.Frames += 1
+
+		self.Index = (self.Index + 1) % len (self.Tanks)
+		if self.Burst and self.Index == 0:
+			self.BurstStart += self.BurstPeriod
+			self.Deadline = self.BurstStart
+		else:
+			self.Deadline += self.ReportInterval
+		gobject.timeout_add (max (int ((self.Deadline - time.time ()) * 1000), 0), self._report)
+		return False
+
+
+	def _dropOut (self):
+
+		if not self.Running:
+			return False
+		if self.Service == None:
+			return True
+		self.DropOuts += 1
+		self.Service.__del__ ()
+		self.Service = None
+		gobject.timeout_add (int (self.DropOutLength * 1000), self._return)
+		return True
+
+
+# the service comes back with the values it had when it left
+
+	def _return (self):
+
+		if not self.Running:
+			return False
+		self.Service = StandInTankService (self.Bus, self.ServiceName, self.ProductId)
+		if self.Last[0] != None:
+			self.Service.Report (*self.Last)
+		return False
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# throughput of wrap_dbus_value and unwrap_dbus_value for each type of value
+#
+# legacyWrap and legacyUnwrap are the isinstance chains ve_utils used before the dispatch tables
+# each value is also checked to convert to the same result both ways
+# no bus is needed:
+#	python benchmarks/ve_utils_wrap.py
+
+import os
+import sys
+import time
+import argparse
+import dbus
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../ext/velib_python'))
+from ve_utils import wrap_dbus_value, unwrap_dbus_value, VEDBUS_INVALID, dbus_int_types
+
+
+def legacyWrap(value):
+	if value is None:
+		return VEDBUS_INVALID
+	if isinstance(value, float):
+		return dbus.Double(value, variant_level=1)
+	if isinstance(value, bool):
+		return dbus.Boolean(value, variant_level=1)
+	if isinstance(value, int):
+		return dbus.Int32(value, variant_level=1)
+	if isinstance(value, str):
+		return dbus.String(value, variant_level=1)
+	if isinstance(value, unicode):
+		return dbus.String(value, variant_level=1)
+	if isinstance(value, list):
+		if len(value) == 0:
+			return dbus.Array([], signature=dbus.Signature('u'), variant_level=1)
+		return dbus.Array([legacyWrap(x) for x in value], variant_level=1)
+	if isinstance(value, long):
+		return dbus.Int64(value, variant_level=1)
+	if isinstance(value, dict):
+		return dbus.Dictionary({(k, legacyWrap(v)) for k, v in value.items()}, variant_level=1)
+	return value
+
+
+def legacyUnwrap(val):
+	if isinstance(val, dbus_int_types):
+		return int(val)
+	if isinstance(val, dbus.Double):
+		return float(val)
+	if isinstance(val, dbus.Array):
+		v = [legacyUnwrap(x) for x in val]
+		return None if len(v) == 0 else v
+	if isinstance(val, (dbus.Signature, dbus.String)):
+		return unicode(val)
+	if isinstance(val, dbus.Byte):
+		return int(val)
+	if isinstance(val, dbus.ByteArray):
+		return "".join([str(x) for x in val])
+	if isinstance(val, (list, tuple)):
+		return [legacyUnwrap(x) for x in val]
+	if isinstance(val, (dbus.Dictionary, dict)):
+		return dict([(x, legacyUnwrap(y)) for x, y in val.items()])
+	if isinstance(val, dbus.Boolean):
+		return bool(val)
+	return val
+
+
+# values a repeater service and its clients exchange, plus containers
+
+wrapValues = [
+	('None', None),
+	('float', 42.5),
+	('bool', True),
+	('int', 17),
+	('long', 1L << 40),
+	('str', 'SeeLevel'),
+	('unicode', u'Fresh water'),
+	('list[10]', [ float (i) for i in range (10) ]),
+	('dict[10]', dict ([ ('Tank%d' % i, i * 0.5) for i in range (10) ])),
+]
+
+unwrapValues = [
+	('Int32', dbus.Int32(17, variant_level=1)),
+	('UInt32', dbus.UInt32(17, variant_level=1)),
+	('Byte', dbus.Byte(17, variant_level=1)),
+	('Double', dbus.Double(42.5, variant_level=1)),
+	('Boolean', dbus.Boolean(True, variant_level=1)),
+	('String', dbus.String(u'Fresh water', variant_level=1)),
+	('Array[10]', dbus.Array([ dbus.Double(i) for i in range (10) ], variant_level=1)),
+	('Dictionary[10]', dbus.Dictionary(dict ([ ('Tank%d' % i, dbus.Double(i)) for i in range (10) ]), variant_level=1)),
+	('invalid', VEDBUS_INVALID),
+	('int', 17),
+	('float', 42.5),
+	('unicode', u'Fresh water'),
+]
+
+
+def rate (function, value, repeat):
+	start = time.time ()
+	for i in xrange (repeat):
+		function (value)
+	return repeat / (time.time () - start)
+
+
+def compare (name, legacy, dispatch, values, repeat):
+	print ("%-8s %-16s %14s %14s %8s" % (name, 'type', 'legacy/s', 'dispatch/s', 'speedup'))
+	for typeName, value in values:
+		if legacy (value) != dispatch (value) or type (legacy (value)) != type (dispatch (value)):
+			print ("%-8s %-16s results differ: %r %r" % (name, typeName, legacy (value), dispatch (value)))
+			continue
+		old = rate (legacy, value, repeat)
+		new = rate (dispatch, value, repeat)
+		print ("%-8s %-16s %14.0f %14.0f %7.2fx" % (name, typeName, old, new, new / old))
+
+
+def main ():
+
+	parser = argparse.ArgumentParser (description = 'wrap_dbus_value/unwrap_dbus_value throughput')
+	parser.add_argument ('--repeat', type = int, default = 100000, help = 'conversions timed for each type')
+	args = parser.parse_args ()
+
+	compare ('wrap', legacyWrap, wrap_dbus_value, wrapValues, args.repeat)
+	print ("")
+	compare ('unwrap', legacyUnwrap, unwrap_dbus_value, unwrapValues, args.repeat)
+
+
+main ()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# microbenchmark for the tree export of VeDbusService
+#
+# times add_path, reads of '/' and of a sub node (GetValue and GetText),
+# reads after one value has changed and deletion of all paths
+# for services with 10, 100 and 1000 paths
+# the same steps are timed for LegacyService, which reads and deletes by scanning all paths
+# as VeDbusService did before the prefix index and tree cache were added
+#
+# the tree objects are called directly so D-Bus marshalling is not part of the times
+# a bus is still needed to export the objects:
+#	dbus-run-session -- python benchmarks/vedbus_tree.py
+# or run it on the Venus device, where the system bus is used
+
+import os
+import sys
+import time
+import logging
+import argparse
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../ext/velib_python'))
+from vedbus import VeDbusService, VeDbusItemExport
+from ve_utils import wrap_dbus_value
+
+
+# VeDbusService with the add_path, tree reads and deletion it had before the prefix index
+
+class LegacyService(VeDbusService):
+
+	def add_path(self, path, value, description="", writeable=False,
+					onchangecallback=None, gettextcallback=None):
+
+		if onchangecallback is not None:
+			self._onchangecallbacks[path] = onchangecallback
+
+		item = VeDbusItemExport(
+				self._dbusconn, path, value, description, writeable,
+				self._value_changed, gettextcallback, deletecallback=self._item_deleted)
+
+		spl = path.split('/')
+		for i in range(2, len(spl)):
+			subPath = '/'.join(spl[:i])
+			if subPath not in self._dbusnodes and subPath not in self._dbusobjects:
+				self._dbusnodes[subPath] = self._create_tree_export(self._dbusconn, subPath, self._get_tree_dict)
+		self._dbusobjects[path] = item
+		logging.debug('added %s with start value %s. Writeable is %s' % (path, value, writeable))
+
+	def _get_tree_dict(self, path, get_text=False):
+		logging.debug("_get_tree_dict called for %s" % path)
+		r = {}
+		px = path
+		if not px.endswith('/'):
+			px += '/'
+		for p, item in self._dbusobjects.items():
+			if p.startswith(px):
+				v = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
+				r[p[len(px):]] = v
+		logging.debug(r)
+		return r
+
+	def _item_deleted(self, path):
+		self._dbusobjects.pop(path)
+		for np in list(self._dbusnodes.keys()):
+			if np != '/':
+				for ip in self._dbusobjects:
+					if ip.startswith(np + '/'):
+						break
+				else:
+					self._dbusnodes[np].__del__()
+					self._dbusnodes.pop(np)
+
+
+# paths are spread over 10 nodes of 10 sub nodes, like the /Tank/<n>/... trees of a multi tank device
+
+def makePaths (count):
+	return [ '/Node%d/Sub%d/Value%d' % (i % 10, (i // 10) % 10, i) for i in range (count) ]
+
+
+def timed (function, repeat):
+	start = time.time ()
+	for i in range (repeat):
+		function ()
+	return (time.time () - start) / repeat * 1e6
+
+
+def run (serviceClass, bus, count, repeat, name):
+
+	paths = makePaths (count)
+	service = serviceClass (name, bus = bus)
+	results = {}
+
+	start = time.time ()
+	for i, path in enumerate (paths):
+		service.add_path (path, i)
+	results['add_path'] = (time.time () - start) / count * 1e6
+
+	root = service._dbusnodes['/']
+	node = service._dbusnodes['/Node0']
+	results['GetValue /'] = timed (root.GetValue, repeat)
+	results['GetText /'] = timed (root.GetText, repeat)
+	results['GetValue node'] = timed (node.GetValue, repeat)
+
+	values = [ 0 ]
+	def changeAndRead ():
+		values[0] += 1
+		service[paths[0]] = values[0]
+		root.GetValue ()
+	results['set + GetValue /'] = timed (changeAndRead, repeat)
+
+	start = time.time ()
+	for path in paths:
+		del service[path]
+	results['delete'] = (time.time () - start) / count * 1e6
+
+	service.__del__ ()
+	return results
+
+
+def main ():
+
+	parser = argparse.ArgumentParser (description = 'VeDbusService tree export microbenchmark')
+	parser.add_argument ('--repeat', type = int, default = 200, help = 'reads timed for each step')
+	parser.add_argument ('--sizes', default = '10,100,1000', help = 'comma separated numbers of paths')
+	args = parser.parse_args ()
+
+	DBusGMainLoop (set_as_default = True)
+	bus = dbus.SessionBus () if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus ()
+
+	steps = [ 'add_path', 'GetValue /', 'GetText /', 'GetValue node', 'set + GetValue /', 'delete' ]
+	print ("%-18s %7s %14s %14s" % ('step (us)', 'paths', 'legacy', 'indexed'))
+	for count in [ int (size) for size in args.sizes.split (',') ]:
+		legacy = run (LegacyService, bus, count, args.repeat, 'com.victronenergy.benchmark.legacy_%d_%d' % (os.getpid (), count))
+		indexed = run (VeDbusService, bus, count, args.repeat, 'com.victronenergy.benchmark.indexed_%d_%d' % (os.getpid (), count))
+		for step in steps:
+			print ("%-18s %7d %14.1f %14.1f" % (step, count, legacy[step], indexed[step]))
+
+
+main ()
@@ -1,9 +1,10 @@
 import dbus
+import gobject
 import logging
-import time
 
 # Local imports
 from vedbus import VeDbusItemImport
+from ve_utils import unwrap_dbus_value
 
 ## Indexes for the setting dictonary.
 PATH = 0
@@ -24,6 +25,14 @@ SILENT = 4
 # If there are settings in de supportSettings list which are not yet on the dbus, 
 # and therefore not yet in the xml file, they will be added through the dbus-addSetting
 # interface of com.victronenergy.settings.
+#
+# Initialisation does not block on each setting: the settings service is waited for on
+# NameOwnerChanged, all settings are probed with asynchronous GetValue and GetSilent calls,
+# missing settings are created with one AddSettings call (one AddSetting call per setting on
+# localsettings versions without AddSettings), and one PropertiesChanged match rule covers all
+# settings. The constructor waits in a nested main loop, so a D-Bus main loop must have been set up
+# (DBusGMainLoop) before creating a SettingsDevice. Settings added later with addSettings can be
+# added without blocking, see there.
 class SettingsDevice(object):
 	## The constructor processes the tree of dbus-items.
 	# @param bus the system-dbus object
@@ -39,66 +48,209 @@ class SettingsDevice(object):
 		self._bus = bus
 		self._dbus_name = name
 		self._eventCallback = eventCallback
-		self._supportedSettings = supportedSettings
+		self._supportedSettings = {}
 		self._values = {} # stored the values, used to pass the old value along on a setting change
 		self._settings = {}
+		self._paths = {} # setting name for each path, used to dispatch PropertiesChanged signals
 
-		count = 0
-		while True:
-			if 'com.victronenergy.settings' in self._bus.list_names():
-				break
-			if count == timeout:
-				raise Exception("The settings service com.victronenergy.settings does not exist!")
-			count += 1
-			logging.info('waiting for settings')
-			time.sleep(1)
-
-		# Add the items.
-		for setting, options in self._supportedSettings.items():
-			busitem = VeDbusItemImport(self._bus, self._dbus_name, options[PATH], self.handleChangedSetting)
-			silent = len(options) > SILENT and options[SILENT]
-			if busitem.exists and busitem._proxy.GetSilent() == silent:
-				logging.debug("Setting %s found" % options[PATH])
-			else:
-				logging.info("Setting %s does not exist yet or must be adjusted" % options[PATH])
-
-				# Prepare to add the setting.
-				path = options[PATH].replace('/Settings/', '', 1)
-				value = options[VALUE]
-				if type(value) == int or type(value) == dbus.Int16 or type(value) == dbus.Int32 or type(value) == dbus.Int64:
-					itemType = 'i'
-				elif type(value) == float or type(value) == dbus.Double:
-					itemType = 'f'
-				else:
-					itemType = 's'
+		self._wait_for_service(timeout)
+
+		# Subscribe before probing so no change is missed
+		self._match = self._bus.add_signal_receiver(self._properties_changed, 'PropertiesChanged',
+			'com.victronenergy.BusItem', self._dbus_name, path_keyword='path')
+
+		self.addSettings(supportedSettings)
+
+		logging.debug("===== Settings device init finished =====")
+
+	## Adds settings after construction, in the same way as the constructor does: existing settings
+	# are read, missing ones are created. eventCallback is also called for these settings.
+	# @param supportedSettings dictionary in the same format as for the constructor
+	# @param callback function without arguments, called when the settings can be used. All D-Bus calls
+	# are asynchronous, so addSettings returns at once and the main loop is not blocked. Without a
+	# callback a nested main loop runs until the settings can be used: only do that before the main
+	# loop runs, as the constructor does.
+	def addSettings(self, supportedSettings, callback=None):
+		self._supportedSettings.update(supportedSettings)
+		if callback is not None:
+			self._add(supportedSettings, callback)
+			return
+
+		loop = gobject.MainLoop()
+		done = []
+		def finished():
+			done.append(True)
+			loop.quit()
+		self._add(supportedSettings, finished)
+		if not done:
+			loop.run()
 
-				# Add the setting
-				# TODO, make an object that inherits VeDbusItemImport, and complete the D-Bus settingsitem interface
-				settings_item = VeDbusItemImport(self._bus, self._dbus_name, '/Settings', createsignal=False)
-				if silent:
-					settings_item._proxy.AddSilentSetting('', path, value, itemType, options[MINIMUM], options[MAXIMUM])
+	# Waits until the settings service has an owner, for at most timeout seconds.
+	def _wait_for_service(self, timeout):
+		if self._bus.name_has_owner(self._dbus_name):
+			return
+
+		owner = []
+		loop = gobject.MainLoop()
+		def owner_changed(name, old, new):
+			if new:
+				owner.append(new)
+				loop.quit()
+		match = self._bus.add_signal_receiver(owner_changed, 'NameOwnerChanged',
+			'org.freedesktop.DBus', 'org.freedesktop.DBus', arg0=self._dbus_name)
+		try:
+			# The service may have appeared before the match was added
+			if self._bus.name_has_owner(self._dbus_name):
+				return
+			if timeout > 0:
+				logging.info('waiting for settings')
+				# loop.quit returns None, so the timer does not repeat
+				timer = gobject.timeout_add(int(timeout * 1000), loop.quit)
+				loop.run()
+				if owner:
+					gobject.source_remove(timer)
+		finally:
+			match.remove()
+
+		if not owner:
+			raise Exception("The settings service com.victronenergy.settings does not exist!")
+
+	# Probes all settings, then adds the missing ones, reads their values and creates the items.
+	# Each step is started from the replies of the previous one, callback is called at the end.
+	def _add(self, supportedSettings, callback):
+		def probed(probes):
+			missing = []
+			for setting, options in supportedSettings.items():
+				exists, value, silent = probes[setting]
+				if exists and silent == (len(options) > SILENT and options[SILENT]):
+					logging.debug("Setting %s found" % options[PATH])
 				else:
-					settings_item._proxy.AddSetting('', path, value, itemType, options[MINIMUM], options[MAXIMUM])
+					logging.info("Setting %s does not exist yet or must be adjusted" % options[PATH])
+					missing.append(setting)
+			if not missing:
+				create(probes)
+				return
 
-				busitem = VeDbusItemImport(self._bus, self._dbus_name, options[PATH], self.handleChangedSetting)
+			def reprobed(result):
+				probes.update(result)
+				create(probes)
+			self._add_settings(missing, lambda: self._probe(missing, reprobed))
 
-			self._settings[setting] = busitem
-			self._values[setting] = busitem.get_value()
+		# Create the items, the values are known already. The proxies use the well-known name, so
+		# they keep working when localsettings restarts.
+		def create(probes):
+			for setting, options in supportedSettings.items():
+				busitem = VeDbusItemImport(self._bus, self._dbus_name, options[PATH], createsignal=False, getvalue=False)
+				busitem._cachedvalue = probes[setting][1]
+				self._settings[setting] = busitem
+				self._paths[options[PATH]] = setting
+				self._values[setting] = busitem.get_value()
+			callback()
 
-		logging.debug("===== Settings device init finished =====")
+		self._probe(list(supportedSettings.keys()), probed)
 
-	def handleChangedSetting(self, servicename, path, changes):
-		# TODO: yes yes, below loop is a bit stupid. But as it won't happen often, why would we
-		# TODO: keep a second dictionary just for this?
-		setting = None
-		for s, options in self._supportedSettings.items():
-			if options[PATH] == path:
-				setting = s
-				break
+	# Reads value and silent flag of the settings with asynchronous calls, which are all sent
+	# before the first reply is handled. callback is called with a dict with (exists, value, silent)
+	# for each setting once all replies are in.
+	def _probe(self, settings, callback):
+		result = dict((setting, [False, None, False]) for setting in settings)
+		pending = [2 * len(settings)]
+
+		def done(*args):
+			pending[0] -= 1
+			if pending[0] == 0:
+				callback(dict((setting, tuple(r)) for setting, r in result.items()))
+
+		if not settings:
+			callback({})
+			return
 
-		assert setting is not None
+		for setting in settings:
+			r = result[setting]
+			path = self._supportedSettings[setting][PATH]
+
+			def value_reply(v, r=r):
+				r[0] = True
+				r[1] = unwrap_dbus_value(v)
+				done()
+			def silent_reply(v, r=r):
+				r[2] = bool(v)
+				done()
+
+			self._bus.call_async(self._dbus_name, path, 'com.victronenergy.BusItem', 'GetValue', '', (),
+				value_reply, done)
+			self._bus.call_async(self._dbus_name, path, 'com.victronenergy.Settings', 'GetSilent', '', (),
+				silent_reply, done)
+
+	# Creates or adjusts the settings with one AddSettings call, or with one AddSetting call each if
+	# the settings service does not know AddSettings. callback is called when all calls have returned.
+	def _add_settings(self, settings, callback):
+		entries = []
+		for setting in settings:
+			options = self._supportedSettings[setting]
+			entries.append({
+				'path': options[PATH],
+				'default': options[VALUE],
+				'min': options[MINIMUM],
+				'max': options[MAXIMUM],
+				'silent': len(options) > SILENT and bool(options[SILENT])})
+
+		def reply(results):
+			for r in results:
+				if r.get('error', 0) != 0:
+					logging.error("Adding setting %s failed, error %s" % (r.get('path'), r.get('error')))
+			callback()
+
+		def error(e):
+			logging.info("AddSettings failed (%s), adding settings one by one" % e.get_dbus_name())
+			self._add_settings_one_by_one(settings, callback)
+
+		self._bus.call_async(self._dbus_name, '/', 'com.victronenergy.Settings', 'AddSettings',
+			'aa{sv}', [entries], reply, error)
+
+	def _add_settings_one_by_one(self, settings, callback):
+		pending = [len(settings)]
+
+		def done(*args):
+			pending[0] -= 1
+			if pending[0] == 0:
+				callback()
+
+		for setting in settings:
+			options = self._supportedSettings[setting]
+			path = options[PATH].replace('/Settings/', '', 1)
+			value = options[VALUE]
+			if type(value) == int or type(value) == dbus.Int16 or type(value) == dbus.Int32 or type(value) == dbus.Int64:
+				itemType = 'i'
+			elif type(value) == float or type(value) == dbus.Double:
+				itemType = 'f'
+			else:
+				itemType = 's'
+			method = 'AddSilentSetting' if len(options) > SILENT and options[SILENT] else 'AddSetting'
+
+			def error(e, path=options[PATH]):
+				logging.error("Adding setting %s failed: %s" % (path, e))
+				done()
+
+			self._bus.call_async(self._dbus_name, '/Settings', 'com.victronenergy.Settings', method, 'ssvsvv',
+				('', path, value, itemType, options[MINIMUM], options[MAXIMUM]), done, error)
+
+	def _properties_changed(self, changes, path=None):
+		setting = self._paths.get(path)
+		if setting is None or 'Value' not in changes:
+			return
+		changes['Value'] = unwrap_dbus_value(changes['Value'])
+		self._settings[setting]._cachedvalue = changes['Value']
+		self.handleChangedSetting(self._dbus_name, path, changes)
+
+	# The echo of a value written through __setitem__, or any other signal that does not change the
+	# value, does not call eventCallback.
+	def handleChangedSetting(self, servicename, path, changes):
+		setting = self._paths[path]
 
 		oldvalue = self._values[setting]
+		if changes['Value'] == oldvalue:
+			return
 		self._values[setting] = changes['Value']
 
 		if self._eventCallback is None:
@@ -109,8 +261,14 @@ class SettingsDevice(object):
 	def __getitem__(self, setting):
 		return self._settings[setting].get_value()
 
+	# Writing the value a setting already has is skipped, which saves the D-Bus call and the write
+	# to flash by localsettings.
 	def __setitem__(self, setting, newvalue):
-		result = self._settings[setting].set_value(newvalue)
+		busitem = self._settings[setting]
+		if busitem.get_value() == newvalue:
+			return
+		result = busitem.set_value(newvalue)
 		if result != 0:
 			# Trying to make some false change to our own settings? How dumb!
 			assert False
+		self._values[setting] = busitem.get_value()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Run from ext/velib_python on a session bus of its own, for example:
+#	dbus-run-session -- python -m unittest discover -s test
+
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+
+try:
+	import dbus
+	from vedbus import VeDbusService
+except ImportError:
+	dbus = None
+
+@unittest.skipIf(dbus is None or 'DBUS_SESSION_BUS_ADDRESS' not in os.environ, 'needs dbus-python and a session bus')
+class TestVeDbusService(unittest.TestCase):
+	def setUp(self):
+		self.bus = dbus.SessionBus()
+
+	def test_del_with_nested_paths(self):
+		service = VeDbusService('com.victronenergy.test.vedbus', bus=self.bus)
+		service.add_mandatory_paths(__file__, '1.0', 'test', 0, 0, 'test', 0, 0, 1)
+		service.add_path('/Tank/1/Level', 50.0)
+		service.add_path('/Tank/1/Capacity', 0.2)
+		service.add_path('/Tank/2/Level', 75.0)
+		self.assertEqual(service._get_tree_dict('/Tank'), {'1/Level': 50.0, '1/Capacity': 0.2, '2/Level': 75.0})
+
+		service.__del__()
+		self.assertEqual(len(service._dbusobjects), 0)
+		self.assertEqual(len(service._dbusnodes), 0)
+		self.assertEqual(service._dbusname, None)
+
+		# The name is free again, so the service can be created a second time
+		service = VeDbusService('com.victronenergy.test.vedbus', bus=self.bus)
+		service.add_path('/Tank/1/Level', 50.0)
+		service.__del__()
+
+	def test_del_item_removes_empty_nodes(self):
+		service = VeDbusService('com.victronenergy.test.vedbus', bus=self.bus)
+		service.add_path('/Tank/1/Level', 50.0)
+		service.add_path('/Tank/2/Level', 75.0)
+		del service['/Tank/1/Level']
+		self.assertNotIn('/Tank/1', service._dbusnodes)
+		self.assertIn('/Tank', service._dbusnodes)
+		self.assertEqual(service._get_tree_dict('/Tank'), {'2/Level': 75.0})
+		service.__del__()
+
+	def test_batch_sent_on_exception(self):
+		service = VeDbusService('com.victronenergy.test.vedbus', bus=self.bus)
+		service.add_path('/Tank/1/Level', 50.0)
+		sent = []
+		service._items_changed = sent.append
+		with self.assertRaises(ValueError):
+			with service as s:
+				s['/Tank/1/Level'] = 40.0
+				raise ValueError()
+		self.assertEqual(list(sent[0].keys()), ['/Tank/1/Level'])
+		self.assertEqual(service._get_tree_dict('/Tank'), {'1/Level': 40.0})
+		service.__del__()
+
+	def test_gettextcallback_not_cached(self):
+		unit = ['%']
+		service = VeDbusService('com.victronenergy.test.vedbus', bus=self.bus)
+		service.add_path('/Tank/1/Level', 50.0, gettextcallback=lambda path, value: '%.0f%s' % (value, unit[0]))
+		service.add_path('/Tank/1/Capacity', 0.2)
+		self.assertEqual(service._get_tree_dict('/Tank', True), {'1/Level': '50%', '1/Capacity': '0.2'})
+		unit[0] = ' percent'
+		self.assertEqual(service._dbusobjects['/Tank/1/Level'].GetText(), '50 percent')
+		self.assertEqual(service._get_tree_dict('/Tank', True), {'1/Level': '50 percent', '1/Capacity': '0.2'})
+		service.__del__()
+
+if __name__ == '__main__':
+	unittest.main()
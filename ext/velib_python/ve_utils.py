@@ -126,7 +126,42 @@ def read_file(path):
 	return content
 
 
+# wrap_dbus_value and unwrap_dbus_value look up the exact type of the value in a dispatch table first,
+# values of types not in the tables (subclasses, for example) are converted by the isinstance chains in
+# _wrap_dbus_value and _unwrap_dbus_value, which define the conversions.
 def wrap_dbus_value(value):
+	if value is None:
+		return VEDBUS_INVALID
+	t = type(value)
+	c = _wrap_scalar_types.get(t)
+	if c is not None:
+		return c(value, variant_level=1)
+	if t is list:
+		return _wrap_list(value)
+	if t is dict:
+		return _wrap_dict(value)
+	return _wrap_dbus_value(value)
+
+
+def _wrap_list(value):
+	if len(value) == 0:
+		# If the list is empty we cannot infer the type of the contents. So assume unsigned integer.
+		# A (signed) integer is dangerous, because an empty list of signed integers is used to encode
+		# an invalid value.
+		return dbus.Array([], signature=dbus.Signature('u'), variant_level=1)
+	return dbus.Array([wrap_dbus_value(x) for x in value], variant_level=1)
+
+
+def _wrap_dict(value):
+	# Wrapping the keys of the dictionary causes D-Bus errors like:
+	# 'arguments to dbus_message_iter_open_container() were incorrect,
+	# assertion "(type == DBUS_TYPE_ARRAY && contained_signature &&
+	# *contained_signature == DBUS_DICT_ENTRY_BEGIN_CHAR) || (contained_signature == NULL ||
+	# _dbus_check_is_valid_signature (contained_signature))" failed in file ...'
+	return dbus.Dictionary({k: wrap_dbus_value(v) for k, v in value.iteritems()}, variant_level=1)
+
+
+def _wrap_dbus_value(value):
 	if value is None:
 		return VEDBUS_INVALID
 	if isinstance(value, float):
@@ -140,49 +175,94 @@ def wrap_dbus_value(value):
 	if isinstance(value, unicode):
 		return dbus.String(value, variant_level=1)
 	if isinstance(value, list):
-		if len(value) == 0:
-			# If the list is empty we cannot infer the type of the contents. So assume unsigned integer.
-			# A (signed) integer is dangerous, because an empty list of signed integers is used to encode
-			# an invalid value.
-			return dbus.Array([], signature=dbus.Signature('u'), variant_level=1)
-		return dbus.Array([wrap_dbus_value(x) for x in value], variant_level=1)
+		return _wrap_list(value)
 	if isinstance(value, long):
 		return dbus.Int64(value, variant_level=1)
 	if isinstance(value, dict):
-		# Wrapping the keys of the dictionary causes D-Bus errors like:
-		# 'arguments to dbus_message_iter_open_container() were incorrect,
-		# assertion "(type == DBUS_TYPE_ARRAY && contained_signature &&
-		# *contained_signature == DBUS_DICT_ENTRY_BEGIN_CHAR) || (contained_signature == NULL ||
-		# _dbus_check_is_valid_signature (contained_signature))" failed in file ...'
-		return dbus.Dictionary({(k, wrap_dbus_value(v)) for k, v in value.items()}, variant_level=1)
+		return _wrap_dict(value)
 	return value
 
 
+_wrap_scalar_types = {
+	float: dbus.Double,
+	bool: dbus.Boolean,
+	int: dbus.Int32,
+	str: dbus.String,
+	unicode: dbus.String,
+	long: dbus.Int64,
+}
+
+
 dbus_int_types = (dbus.Int32, dbus.UInt32, dbus.Byte, dbus.Int16, dbus.UInt16, dbus.UInt32, dbus.Int64, dbus.UInt64)
 
 
 def unwrap_dbus_value(val):
 	"""Converts D-Bus values back to the original type. For example if val is of type DBus.Double,
 	a float will be returned."""
+	t = type(val)
+	f = _unwrap_types.get(t)
+	if f is not None:
+		return f(val)
+	if t in _unwrap_unchanged:
+		return val
+	return _unwrap_dbus_value(val)
+
+
+def _unwrap_array(val):
+	v = [unwrap_dbus_value(x) for x in val]
+	return None if len(v) == 0 else v
+
+
+def _unwrap_list(val):
+	return [unwrap_dbus_value(x) for x in val]
+
+
+def _unwrap_dict(val):
+	# Do not unwrap the keys, see comment in wrap_dbus_value
+	return {x: unwrap_dbus_value(y) for x, y in val.iteritems()}
+
+
+def _unwrap_byte_array(val):
+	return "".join([str(x) for x in val])
+
+
+def _unwrap_dbus_value(val):
 	if isinstance(val, dbus_int_types):
 		return int(val)
 	if isinstance(val, dbus.Double):
 		return float(val)
 	if isinstance(val, dbus.Array):
-		v = [unwrap_dbus_value(x) for x in val]
-		return None if len(v) == 0 else v
+		return _unwrap_array(val)
 	if isinstance(val, (dbus.Signature, dbus.String)):
 		return unicode(val)
 	# Python has no byte type, so we convert to an integer.
 	if isinstance(val, dbus.Byte):
 		return int(val)
 	if isinstance(val, dbus.ByteArray):
-		return "".join([str(x) for x in val])
+		return _unwrap_byte_array(val)
 	if isinstance(val, (list, tuple)):
-		return [unwrap_dbus_value(x) for x in val]
+		return _unwrap_list(val)
 	if isinstance(val, (dbus.Dictionary, dict)):
-		# Do not unwrap the keys, see comment in wrap_dbus_value
-		return dict([(x, unwrap_dbus_value(y)) for x, y in val.items()])
+		return _unwrap_dict(val)
 	if isinstance(val, dbus.Boolean):
 		return bool(val)
 	return val
+
+
+# Plain Python values are returned as they are.
+_unwrap_unchanged = frozenset([type(None), bool, int, long, float, str, unicode])
+
+_unwrap_types = dict([(t, int) for t in dbus_int_types])
+_unwrap_types.update({
+	dbus.Double: float,
+	dbus.Array: _unwrap_array,
+	dbus.Signature: unicode,
+	dbus.String: unicode,
+	dbus.ByteArray: _unwrap_byte_array,
+	list: _unwrap_list,
+	tuple: _unwrap_list,
+	dbus.Struct: _unwrap_list,
+	dbus.Dictionary: _unwrap_dict,
+	dict: _unwrap_dict,
+	dbus.Boolean: bool,
+})
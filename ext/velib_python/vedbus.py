@@ -56,15 +56,45 @@ from ve_utils import wrap_dbus_value, unwrap_dbus_value
 #   The signature of a variant is 'v'.
 
 # Export ourselves as a D-Bus service.
+#
+# Several values can be changed as one batch, which is sent as a single ItemsChanged signal
+# from the root object instead of a PropertiesChanged signal from every changed path:
+#
+#	with dbusservice as s:
+#		s['/Level'] = 50
+#		s['/Remaining'] = 0.1
+#
+# or dbusservice.update_many({'/Level': 50, '/Remaining': 0.1}).
+# Consumers that do not know ItemsChanged still need the PropertiesChanged signals. Set perpathsignals
+# to True (the default) to send those for a batch as well, False to send only ItemsChanged.
+#
+# GetValue and GetText on '/' or any other node return the items below that node. Each node keeps the
+# set of item paths below it, so reading a node only visits its own subtree, and the result is cached.
+# A value change updates the cached entry of the changed item in the cache of each node above it.
+# The text of a node is not cached when an item below it has a gettextcallback, as its text can change
+# without a value change.
 class VeDbusService(object):
-	def __init__(self, servicename, bus=None):
+	def __init__(self, servicename, bus=None, perpathsignals=True):
 		# dict containing the VeDbusItemExport objects, with their path as the key.
 		self._dbusobjects = {}
 		self._dbusnodes = {}
 
+		# prefix index: dict with the node path as the key and the set of item paths below it as the value
+		self._nodeitems = {'/': set()}
+
+		# cached tree dicts, with (node path, get_text) as the key
+		self._treecache = {}
+
+		# paths of the items that have a gettextcallback
+		self._textcallbacks = set()
+
 		# dict containing the onchange callbacks, for each object. Object path is the key
 		self._onchangecallbacks = {}
 
+		# stack of open batches, the outermost one is sent, see __enter__
+		self._batches = []
+		self._perpathsignals = perpathsignals
+
 		# Connect to session bus whenever present, else use the system bus
 		self._dbusconn = bus or (dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus())
 
@@ -75,32 +105,58 @@ class VeDbusService(object):
 		self._dbusname = dbus.service.BusName(servicename, self._dbusconn, do_not_queue=True)
 
 		# Add the root item that will return all items as a tree
-		self._dbusnodes['/'] = self._create_tree_export(self._dbusconn, '/', self._get_tree_dict)
+		self._dbusnodes['/'] = self._create_root_export(self._dbusconn, '/', self._get_tree_dict)
 
 		logging.info("registered ourselves on D-Bus as %s" % servicename)
 
+	# Returns the cached tree dict of a node. The dict is shared with later calls and must not be modified.
 	def _get_tree_dict(self, path, get_text=False):
-		logging.debug("_get_tree_dict called for %s" % path)
+		r = self._treecache.get((path, get_text))
+		if r is not None:
+			return r
+		logging.debug("_get_tree_dict building %s" % path)
 		r = {}
-		px = path
-		if not px.endswith('/'):
-			px += '/'
-		for p, item in self._dbusobjects.items():
-			if p.startswith(px):
-				v = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
-				r[p[len(px):]] = v
-		logging.debug(r)
+		n = len(path) if path == '/' else len(path) + 1
+		for p in self._nodeitems.get(path, ()):
+			item = self._dbusobjects[p]
+			r[p[n:]] = item.GetText() if get_text else item.GetValue()
+		if not get_text or self._textcallbacks.isdisjoint(self._nodeitems.get(path, ())):
+			self._treecache[(path, get_text)] = r
 		return r
 
+	# The nodes above an item path, '/' included, that have an entry in the prefix index.
+	def _item_nodes(self, path):
+		yield '/'
+		i = path.find('/', 1)
+		while i != -1:
+			if path[:i] in self._nodeitems:
+				yield path[:i]
+			i = path.find('/', i + 1)
+
+	# Called by an item when its value changed, updates the cached tree dicts of the nodes above it.
+	def _item_changed(self, path):
+		item = self._dbusobjects.get(path)
+		if item is None:
+			return
+		for np in self._item_nodes(path):
+			n = len(np) if np == '/' else len(np) + 1
+			r = self._treecache.get((np, False))
+			if r is not None:
+				r[path[n:]] = item.GetValue()
+			r = self._treecache.get((np, True))
+			if r is not None:
+				r[path[n:]] = item.GetText()
+
 	# To force immediate deregistering of this dbus service and all its object paths, explicitly
 	# call __del__().
+	# Items are removed first, their nodes are removed with the last item below them.
 	def __del__(self):
+		for item in list(self._dbusobjects.values()):
+			item.__del__()
+		self._dbusobjects.clear()
 		for node in self._dbusnodes.values():
 			node.__del__()
 		self._dbusnodes.clear()
-		for item in self._dbusobjects.values():
-			item.__del__()
-		self._dbusobjects.clear()
 		if self._dbusname:
 			self._dbusname.__del__()  # Forces call to self._bus.release_name(self._name), see source code
 		self._dbusname = None
@@ -113,17 +169,25 @@ class VeDbusService(object):
 
 		if onchangecallback is not None:
 			self._onchangecallbacks[path] = onchangecallback
+		if gettextcallback is not None:
+			self._textcallbacks.add(path)
 
 		item = VeDbusItemExport(
 				self._dbusconn, path, value, description, writeable,
-				self._value_changed, gettextcallback, deletecallback=self._item_deleted)
+				self._value_changed, gettextcallback, deletecallback=self._item_deleted,
+				itemchangedcallback=self._item_changed)
 
 		spl = path.split('/')
 		for i in range(2, len(spl)):
 			subPath = '/'.join(spl[:i])
 			if subPath not in self._dbusnodes and subPath not in self._dbusobjects:
 				self._dbusnodes[subPath] = self._create_tree_export(self._dbusconn, subPath, self._get_tree_dict)
+				self._nodeitems[subPath] = set()
 		self._dbusobjects[path] = item
+		for np in self._item_nodes(path):
+			self._nodeitems[np].add(path)
+			self._treecache.pop((np, False), None)
+			self._treecache.pop((np, True), None)
 		logging.debug('added %s with start value %s. Writeable is %s' % (path, value, writeable))
 
 	# Add the mandatory paths, as per victron dbus api doc
@@ -144,6 +208,9 @@ class VeDbusService(object):
 	def _create_tree_export(self, bus, objectPath, get_value_handler):
 		return VeDbusTreeExport(bus, objectPath, get_value_handler)
 
+	def _create_root_export(self, bus, objectPath, get_value_handler):
+		return VeDbusRootExport(bus, objectPath, get_value_handler)
+
 	# Callback function that is called from the VeDbusItemExport objects when a value changes. This function
 	# maps the change-request to the onchangecallback given to us for this specific path.
 	def _value_changed(self, path, newvalue):
@@ -153,15 +220,46 @@ class VeDbusService(object):
 		return self._onchangecallbacks[path](path, newvalue)
 
 	def _item_deleted(self, path):
+		for np in list(self._item_nodes(path)):
+			items = self._nodeitems[np]
+			items.discard(path)
+			self._treecache.pop((np, False), None)
+			self._treecache.pop((np, True), None)
+			if np != '/' and not items:
+				self._nodeitems.pop(np)
+				self._dbusnodes.pop(np).__del__()
 		self._dbusobjects.pop(path)
-		for np in self._dbusnodes.keys():
-			if np != '/':
-				for ip in self._dbusobjects:
-					if ip.startswith(np + '/'):
-						break
-				else:
-					self._dbusnodes[np].__del__()
-					self._dbusnodes.pop(np)
+		self._textcallbacks.discard(path)
+
+	# Sends the changes of a batch: one ItemsChanged signal from the root object, plus the
+	# PropertiesChanged signal of each path if perpathsignals is set.
+	def _items_changed(self, changes):
+		if self._perpathsignals:
+			for path, c in changes.items():
+				self._dbusobjects[path].PropertiesChanged(c)
+		self._dbusnodes['/'].ItemsChanged(changes)
+
+	# Open a batch. Values set through the returned ServiceContext are sent as one
+	# ItemsChanged signal when the with statement ends. A batch opened within another
+	# one is sent with the outer batch. The values set are in place as soon as they are set,
+	# so the batch is also sent when the with statement ends with an exception.
+	def __enter__(self):
+		batch = ServiceContext(self)
+		self._batches.append(batch)
+		return batch
+
+	def __exit__(self, *exc):
+		batch = self._batches.pop()
+		if self._batches:
+			self._batches[-1].changes.update(batch.changes)
+		else:
+			batch.flush()
+
+	# Set several values as one batch. values is a dict with the path as the key.
+	def update_many(self, values):
+		with self as s:
+			for path, value in values.items():
+				s[path] = value
 
 	def __getitem__(self, path):
 		return self._dbusobjects[path].local_get_value()
@@ -176,6 +274,28 @@ class VeDbusService(object):
 	def __contains__(self, path):
 		return path in self._dbusobjects
 
+# Collects the changes made within a 'with dbusservice' block, see VeDbusService
+class ServiceContext(object):
+	def __init__(self, parent):
+		self.parent = parent
+		self.changes = {}
+
+	def __contains__(self, path):
+		return path in self.parent
+
+	def __getitem__(self, path):
+		return self.parent[path]
+
+	def __setitem__(self, path, newvalue):
+		c = self.parent._dbusobjects[path]._local_set_value(newvalue)
+		if c is not None:
+			self.changes[path] = c
+
+	def flush(self):
+		if self.changes:
+			self.parent._items_changed(self.changes)
+			self.changes = {}
+
 """
 Importing basics:
 	- If when we power up, the D-Bus service does not exist, or it does exist and the path does not
@@ -207,7 +327,9 @@ class VeDbusItemImport(object):
 	# @param createSignal   only set this to False if you use this function to one time read a value. When
 	#						leaving it to True, make sure to also subscribe to the NameOwnerChanged signal
 	#						elsewhere. See also note some 15 lines up.
-	def __init__(self, bus, serviceName, path, eventCallback=None, createsignal=True):
+	# @param getvalue		set this to False to skip reading the initial value, if the caller knows it
+	#						already. get_value returns None until the value is set or changes.
+	def __init__(self, bus, serviceName, path, eventCallback=None, createsignal=True, getvalue=True):
 		# TODO: is it necessary to store _serviceName and _path? Isn't it
 		# stored in the bus_getobjectsomewhere?
 		self._serviceName = serviceName
@@ -225,6 +347,8 @@ class VeDbusItemImport(object):
 		# store the current value in _cachedvalue. When it doesn't exists set _cachedvalue to
 		# None, same as when a value is invalid
 		self._cachedvalue = None
+		if not getvalue:
+			return
 		try:
 			v = self._proxy.GetValue()
 		except dbus.exceptions.DBusException:
@@ -260,11 +384,13 @@ class VeDbusItemImport(object):
 
 	## Writes a new value to the dbus-item
 	def set_value(self, newvalue):
-		r = self._proxy.SetValue(wrap_dbus_value(newvalue))
+		v = wrap_dbus_value(newvalue)
+		r = self._proxy.SetValue(v)
 
-		# instead of just saving the value, go to the dbus and get it. So we have the right type etc.
+		# A successful SetValue stores the value as sent, so cache that instead of reading it back.
+		# Unwrapping what was sent gives the value the right type etc.
 		if r == 0:
-			self._refreshcachedvalue()
+			self._cachedvalue = unwrap_dbus_value(v)
 
 		return r
 
@@ -349,6 +475,16 @@ class VeDbusTreeExport(dbus.service.Object):
 		return self._get_value_handler(self.path)
 
 
+# The root object of a VeDbusService. Also sends the changes of a batch of values as one signal.
+class VeDbusRootExport(VeDbusTreeExport):
+	## The signal that indicates that one or more values have changed.
+	# The argument is a dict with the path as the key and a dict with 'Value' and 'Text'
+	# (as in PropertiesChanged) as the value.
+	@dbus.service.signal('com.victronenergy.BusItem', signature='a{sa{sv}}')
+	def ItemsChanged(self, changes):
+		pass
+
+
 class VeDbusItemExport(dbus.service.Object):
 	## Constructor of VeDbusItemExport
 	#
@@ -362,8 +498,15 @@ class VeDbusItemExport(dbus.service.Object):
 	# @param callback	  Function that will be called when someone else changes the value of this VeBusItem
 	#                     over the dbus. First parameter passed to callback will be our path, second the new
 	#					  value. This callback should return True to accept the change, False to reject it.
+	# @param itemchangedcallback	Function that will be called with our path after the value changed, by
+	#						  either local_set_value or SetValue.
+	#
+	# The wrapped value and the text are built once when the value changes, GetValue, GetText and the
+	# PropertiesChanged signal all use those. The text is not cached when there is a gettextcallback,
+	# as it may depend on more than the value: GetText then calls it each time.
 	def __init__(self, bus, objectPath, value=None, description=None, writeable=False,
-					onchangecallback=None, gettextcallback=None, deletecallback=None):
+					onchangecallback=None, gettextcallback=None, deletecallback=None,
+					itemchangedcallback=None):
 		dbus.service.Object.__init__(self, bus, objectPath)
 		self._onchangecallback = onchangecallback
 		self._gettextcallback = gettextcallback
@@ -371,6 +514,8 @@ class VeDbusItemExport(dbus.service.Object):
 		self._description = description
 		self._writeable = writeable
 		self._deletecallback = deletecallback
+		self._itemchangedcallback = itemchangedcallback
+		self._update_cache()
 
 	# To force immediate deregistering of this dbus object, explicitly call __del__().
 	def __del__(self):
@@ -395,15 +540,29 @@ class VeDbusItemExport(dbus.service.Object):
 	# is using this class to export values to the dbus.
 	# set value to None to indicate that it is Invalid
 	def local_set_value(self, newvalue):
+		changes = self._local_set_value(newvalue)
+		if changes is not None:
+			self.PropertiesChanged(changes)
+
+	## Sets the value without sending a signal. Returns the changes that a signal
+	# would have carried, or None if the value did not change.
+	def _local_set_value(self, newvalue):
 		if self._value == newvalue:
-			return
+			return None
 
 		self._value = newvalue
+		self._update_cache()
+		if self._itemchangedcallback is not None:
+			self._itemchangedcallback(self.__dbus_object_path__)
 
 		changes = {}
-		changes['Value'] = wrap_dbus_value(newvalue)
+		changes['Value'] = self._wrapped
 		changes['Text'] = self.GetText()
-		self.PropertiesChanged(changes)
+		return changes
+
+	def _update_cache(self):
+		self._wrapped = wrap_dbus_value(self._value)
+		self._text = self._get_text() if self._gettextcallback is None else None
 
 	def local_get_value(self):
 		return self._value
@@ -449,13 +608,16 @@ class VeDbusItemExport(dbus.service.Object):
 	# @return the value when valid, and otherwise an empty array
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='v')
 	def GetValue(self):
-		return wrap_dbus_value(self._value)
+		return self._wrapped
 
 	## Dbus exported method GetText
 	# Returns the value as string of the dbus-object-path.
 	# @return text A text-value. '---' when local value is invalid
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='s')
 	def GetText(self):
+		return self._text if self._text is not None else self._get_text()
+
+	def _get_text(self):
 		if self._value is None:
 			return '---'
 
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+# NMEA2000 PGN 127505 Fluid Level decoding and CAN frame sources
+#
+# This module lets the repeater read tank reports straight from the CAN bus
+# instead of from the multiplexed SeeLevel dBus service owned by the GUI process (see SeeLevelRepeater.py --can)
+# and lets the same frames be read from candump log files for testing (--candump)
+#
+# PGN 127505 is a single frame message (8 bytes):
+#	byte 0		fluid instance (low 4 bits) and fluid type (high 4 bits)
+#	bytes 1-2	level, signed 16 bits in 0.004 % units
+#	bytes 3-6	capacity, unsigned 32 bits in 0.1 litre units
+#	byte 7		reserved
+# NMEA2000 fluid types are the same as Victron's
+# so every frame is one complete report for one tank of one sender - there is nothing to reassemble across frames
+# level and capacity are converted to % and cubic meters (as used on dBus)
+# values the sender marks as not available are returned as -99 (as for the SeeLevel dBus values)
+#
+# the 29 bit CAN identifier holds the priority, PGN and source address:
+#	bits 26-28 priority, bit 25 reserved, bit 24 data page, bits 16-23 PDU format, bits 8-15 PDU specific, bits 0-7 source
+# for PDU format 240 and above (PDU2) the PDU specific byte is part of the PGN
+
+import os
+import struct
+import ctypes
+import ctypes.util
+
+FluidLevelPgn = 127505
+
+CanEffFlag = 0x80000000
+CanEffMask = 0x1FFFFFFF
+
+LevelNotAvailable = 0x7FFF
+CapacityNotAvailable = 0xFFFFFFFF
+
+
+def CanIdPgn (canId):
+
+	canId &= CanEffMask
+	pduFormat = (canId >> 16) & 0xFF
+	pgn = (canId >> 8) & 0x1FF00
+	if pduFormat >= 240:
+		pgn |= (canId >> 8) & 0xFF
+	return pgn
+
+
+def CanIdSource (canId):
+
+	return canId & 0xFF
+
+
+# returns (instance, fluid type, level, capacity) for a 127505 data field or None if it is too short
+
+def DecodeFluidLevel (data):
+
+	if len (data) < 7:
+		return None
+	typeInstance, rawLevel, rawCapacity = struct.unpack_from ('<BhI', data, 0)
+	if rawLevel == LevelNotAvailable:
+		level = -99
+	else:
+		level = rawLevel * 0.004
+	if rawCapacity == CapacityNotAvailable:
+		capacity = -99
+	else:
+		capacity = rawCapacity / 10000.0
+	return (typeInstance & 0x0F, typeInstance >> 4, level, capacity)
+
+
+# FluidLevelDecoder passes every 127505 frame to the callback:
+#	callback (source address, fluid instance, fluid type, level, capacity)
+# other PGNs are counted and ignored
+
+class FluidLevelDecoder:
+
+	def __init__ (self, callback):
+
+		self.Callback = callback
+		self.FrameCount = 0
+		self.DecodedCount = 0
+		self.IgnoredCount = 0
+
+
+	def Frame (self, canId, data):
+
+		self.FrameCount += 1
+		if CanIdPgn (canId) != FluidLevelPgn:
+			self.IgnoredCount += 1
+			return
+		report = DecodeFluidLevel (data)
+		if report == None:
+			self.IgnoredCount += 1
+			return
+		self.DecodedCount += 1
+		instance, fluidType, level, capacity = report
+		self.Callback (CanIdSource (canId), instance, fluidType, level, capacity)
+
+
+# candump log files
+# both the candump -l (log file) format:
+#	(1436509052.249713) can0 19F21101#0068108E30010000
+# and the default candump screen format (no time stamp, or with -ta):
+#	 (1436509052.249713)  can0  19F21101   [8]  00 68 10 8E 30 01 00 00
+# are accepted
+# returns (time stamp or None, interface, CAN id, data) or None for lines that are not frames
+# CAN ids of 8 hex digits are extended (29 bit) ids
+
+def ParseCandumpLine (line):
+
+	fields = line.split ()
+	if len (fields) == 0:
+		return None
+	timeStamp = None
+	if fields[0].startswith ('('):
+		try:
+			timeStamp = float (fields[0].strip ('()'))
+		except ValueError:
+			return None
+		fields = fields[1:]
+	if len (fields) < 2:
+		return None
+	interface = fields[0]
+	try:
+		if '#' in fields[1]:
+			canIdText, dataText = fields[1].split ('#', 1)
+			data = bytearray.fromhex (dataText)
+		else:
+			canIdText = fields[1]
+			if len (fields) < 3 or not fields[2].startswith ('['):
+				return None
+			data = bytearray ( [ int (byte, 16) for byte in fields[3:] ] )
+		canId = int (canIdText, 16)
+	except ValueError:
+		return None
+	if len (canIdText) == 8:
+		canId |= CanEffFlag
+	return (timeStamp, interface, canId, bytes (data))
+
+
+# generator for the frames of a candump log file
+# the file is opened by the caller, so a missing file is reported before the first frame is read
+# and closed when all frames have been read
+
+def ReadCandump (f):
+
+	with f:
+		for line in f:
+			frame = ParseCandumpLine (line)
+			if frame != None:
+				yield frame
+
+
+# SocketCanReader reads frames from a SocketCAN interface (can0, vcan0 ...)
+# python 2 has no AF_CAN sockets so the socket is created through libc
+# a kernel filter passes only 127505 frames so other N2K traffic never wakes this process
+# Read () returns (CAN id, data) for one frame and should be called when the file descriptor (Fd) is readable
+
+PfCan = 29
+CanRaw = 1
+SockRaw = 3
+SolCanRaw = 101
+CanRawFilter = 1
+CanFrameFormat = '<IB3x8s'
+CanFrameSize = struct.calcsize (CanFrameFormat)
+
+class SockaddrCan (ctypes.Structure):
+	_fields_ = [ ('can_family', ctypes.c_ushort), ('can_ifindex', ctypes.c_int),
+			('rx_id', ctypes.c_uint32), ('tx_id', ctypes.c_uint32) ]
+
+class CanFilter (ctypes.Structure):
+	_fields_ = [ ('can_id', ctypes.c_uint32), ('can_mask', ctypes.c_uint32) ]
+
+class SocketCanReader:
+
+	def __init__ (self, interface, pgn = FluidLevelPgn):
+
+		libc = ctypes.CDLL (ctypes.util.find_library ('c'), use_errno = True)
+		self.Interface = interface
+		self.Fd = libc.socket (PfCan, SockRaw, CanRaw)
+		if self.Fd < 0:
+			self._error ("socket")
+
+		try:
+# match the data page, PDU format and PDU specific bits of the PGN (any priority and source)
+			canFilter = CanFilter ((pgn << 8) | CanEffFlag, (0x1FFFF << 8) | CanEffFlag)
+			if libc.setsockopt (self.Fd, SolCanRaw, CanRawFilter, ctypes.byref (canFilter), ctypes.sizeof (canFilter)) != 0:
+				self._error ("setsockopt")
+
+			index = libc.if_nametoindex (interface.encode ())
+			if index == 0:
+				self._error ("if_nametoindex")
+			address = SockaddrCan (PfCan, index, 0, 0)
+			if libc.bind (self.Fd, ctypes.byref (address), ctypes.sizeof (address)) != 0:
+				self._error ("bind")
+		except:
+			os.close (self.Fd)
+			raise
+
+
+	def _error (self, call):
+
+		error = ctypes.get_errno ()
+		raise OSError (error, "%s on %s: %s" % (call, self.Interface, os.strerror (error)))
+
+
+	def Read (self):
+
+		frame = os.read (self.Fd, CanFrameSize)
+		if len (frame) < CanFrameSize:
+			return None
+		canId, length, data = struct.unpack (CanFrameFormat, frame)
+		return (canId, data[:length])
+
+
+	def Close (self):
+
+		os.close (self.Fd)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# unit tests for the PGN 127505 decoding and candump parsing of n2kfluidlevel.py
+# run from the repository root:
+#	python -m unittest discover -s test
+
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from n2kfluidlevel import CanIdPgn, CanIdSource, DecodeFluidLevel, ParseCandumpLine, ReadCandump, \
+		FluidLevelDecoder, FluidLevelPgn, CanEffFlag
+
+SamplePath = os.path.join(os.path.dirname(__file__), 'candump-sample.log')
+
+# fresh water (type 1) instance 1 from source 0x23: level 4000 * 0.004 = 16 %, capacity 1000000 * 0.1 l = 100 m3
+FreshWaterData = b'\x11\xa0\x0f\x40\x42\x0f\x00\xff'
+
+
+class TestCanId(unittest.TestCase):
+
+	def test_fluid_level(self):
+		self.assertEqual(CanIdPgn(0x19F21101 | CanEffFlag), FluidLevelPgn)
+		self.assertEqual(CanIdSource(0x19F21101 | CanEffFlag), 0x01)
+		self.assertEqual(CanIdSource(0x19F21123), 0x23)
+
+	def test_priority_ignored(self):
+		self.assertEqual(CanIdPgn(0x09F21101), FluidLevelPgn)
+
+	def test_pdu1_destination_not_in_pgn(self):
+		# PGN 59904 (ISO request, PDU format 234) to address 0x23 from 0x01
+		self.assertEqual(CanIdPgn(0x18EA2301), 59904)
+
+
+class TestDecodeFluidLevel(unittest.TestCase):
+
+	def test_values(self):
+		instance, fluidType, level, capacity = DecodeFluidLevel(FreshWaterData)
+		self.assertEqual((instance, fluidType), (1, 1))
+		self.assertAlmostEqual(level, 16.0)
+		self.assertAlmostEqual(capacity, 100.0)
+
+	def test_negative_level(self):
+		# -250 * 0.004 = -1 %
+		self.assertAlmostEqual(DecodeFluidLevel(b'\x00\x06\xff\x00\x00\x00\x00\xff')[2], -1.0)
+
+	def test_not_available(self):
+		self.assertEqual(DecodeFluidLevel(b'\x51\xff\x7f\xff\xff\xff\xff\xff'), (1, 5, -99, -99))
+
+	def test_too_short(self):
+		self.assertEqual(DecodeFluidLevel(b'\x11\xa0\x0f\x40\x42\x0f'), None)
+
+
+class TestParseCandumpLine(unittest.TestCase):
+
+	def test_log_format(self):
+		self.assertEqual(ParseCandumpLine('(1592990001.600000) can0 19F21123#11A00F40420F00FF\n'),
+				(1592990001.6, 'can0', 0x19F21123 | CanEffFlag, FreshWaterData))
+
+	def test_screen_format(self):
+		self.assertEqual(ParseCandumpLine('  can0  19F21123   [8]  11 A0 0F 40 42 0F 00 FF'),
+				(None, 'can0', 0x19F21123 | CanEffFlag, FreshWaterData))
+
+	def test_screen_format_with_time(self):
+		frame = ParseCandumpLine(' (1592990001.600000)  vcan0  19F21123   [8]  11 A0 0F 40 42 0F 00 FF')
+		self.assertEqual(frame[:2], (1592990001.6, 'vcan0'))
+		self.assertEqual(frame[3], FreshWaterData)
+
+	def test_standard_id(self):
+		self.assertEqual(ParseCandumpLine('(1.0) can0 123#DEADBEEF'), (1.0, 'can0', 0x123, b'\xde\xad\xbe\xef'))
+
+	def test_not_frames(self):
+		for line in ('', '\n', 'interface can0 down', '(1.0) can0', '(x) can0 19F21123#00', 'can0 19F21123 8 00'):
+			self.assertEqual(ParseCandumpLine(line), None)
+
+
+class TestReadCandump(unittest.TestCase):
+
+	def test_sample(self):
+		reports = []
+		decoder = FluidLevelDecoder(lambda *report: reports.append(report))
+		frames = list(ReadCandump(open(SamplePath)))
+		for timeStamp, interface, canId, data in frames:
+			decoder.Frame(canId, data)
+		self.assertEqual(len(frames), 5)
+		self.assertEqual(frames[0][0], 1592990000.1)
+		self.assertEqual((decoder.FrameCount, decoder.DecodedCount, decoder.IgnoredCount), (5, 3, 2))
+		self.assertEqual([report[:3] for report in reports], [(0x01, 0, 0), (0x01, 1, 5), (0x23, 1, 1)])
+		self.assertAlmostEqual(reports[0][3], 16.8)
+		self.assertAlmostEqual(reports[0][4], 7.7966)
+		self.assertEqual(reports[1][3:], (-99, -99))
+		self.assertAlmostEqual(reports[2][3], 16.0)
+
+
+if __name__ == '__main__':
+	unittest.main()
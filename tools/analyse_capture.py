@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+
+# offline analyser for CAN captures of N2K tank senders
+#
+# reads candump log files of any size (candump -l format or the default candump output with -ta time stamps)
+# in fixed size chunks so memory use does not depend on the file size
+# only PGN 127505 Fluid Level frames are extracted (by a regular expression on the chunk)
+# and they are decoded as NumPy arrays a chunk at a time (see n2kfluidlevel.py for the frame layout)
+#
+# reported for each tank (source address, fluid type, fluid instance):
+#	frames, time between reports (percentiles from a histogram), level mean/noise (RMS of frame to frame changes)
+#	and the number of reports a 1 Hz poll of the multiplexed SeeLevel service would have missed
+# and for each source address:
+#	bursts: groups of reports separated by more than --burst-gap seconds of silence
+#	(SeeLevel sends all tanks in a burst, then is silent - see the SeeLevelRepeater.py header)
+#
+# the poll simulation assumes the SeeLevel dBus service always holds the latest report of the source
+# and CheckSeeLevel reads it every --poll-period seconds: a report replaced before the next read is missed
+#
+# traces of the SeeLevel dBus service written by record_seelevel.py are recognised by their header
+# and analysed separately, a chunk of records at a time:
+# the /FluidType, /Level and /Capacity signals are grouped into tank reports as the repeater's frame assembler does
+# (a report starts with a fluid type signal, or any signal after --frame-timeout seconds without one)
+# and the same statistics are reported (source 0 is the traced service) together with
+# the number of reports the recorder's own polls read, invalid values and the time the service was off the dBus
+#
+# usage: python tools/analyse_capture.py capture.log [capture2.log ...] [seelevel.trace ...]
+
+import os
+import re
+import sys
+import time
+import binascii
+import argparse
+import numpy as np
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from n2kfluidlevel import FluidLevelPgn, LevelNotAvailable, CapacityNotAvailable
+from seelevel_trace import IsTrace, ReadTraceHeader, TraceRecordSize, TraceFluidType, TraceLevel, TraceCapacity, \
+		TraceSnapshot, TraceServiceLost, TraceServiceFound
+
+# 29 bit CAN ids of 127505: priority / data page in the first two hex digits, then F2 11, then the source address
+# the data page bit is checked after decoding
+PgnHex = ('%05X' % FluidLevelPgn)[1:].encode ()
+LogFrame = re.compile (br'\((\d+\.\d+)\)\s+\S+\s+([0-9A-Fa-f]{2}' + PgnHex + br'[0-9A-Fa-f]{2})#([0-9A-Fa-f]{16})\b', re.IGNORECASE)
+ScreenFrame = re.compile (br'\((\d+\.\d+)\)\s+\S+\s+([0-9A-Fa-f]{2}' + PgnHex + br'[0-9A-Fa-f]{2})\s+\[8\]\s+((?:[0-9A-Fa-f]{2}\s){7}[0-9A-Fa-f]{2})', re.IGNORECASE)
+
+# inter-arrival histogram bins (seconds), logarithmic from 10 mS to 1000 S
+IntervalBins = np.concatenate (( [ 0.0 ], np.logspace (-2, 3, 101), [ np.inf ] ))
+
+TraceRecord = np.dtype ([ ('time', '<f8'), ('kind', 'u1'), ('first', '<f4'), ('second', '<f4'), ('third', '<f4') ])
+assert TraceRecord.itemsize == TraceRecordSize
+
+
+# returns the 127505 frames of a chunk of candump text as arrays:
+# time stamp, source address, fluid type, fluid instance, level (%, NaN if not available), capacity (m3, NaN ditto)
+
+def DecodeChunk (chunk):
+
+	matches = LogFrame.findall (chunk)
+	if len (matches) == 0:
+		matches = [ (t, i, d.replace (b' ', b'').replace (b'\t', b'')) for t, i, d in ScreenFrame.findall (chunk) ]
+	if len (matches) == 0:
+		return None
+
+	timeStamps, ids, data = zip (*matches)
+	timeStamps = np.array (timeStamps).astype (np.float64)
+	ids = np.frombuffer (binascii.unhexlify (b''.join (ids)), dtype = '>u4')
+	raw = np.frombuffer (binascii.unhexlify (b''.join (data)), dtype = np.uint8).reshape (-1, 8)
+
+# keep data page 1 only (127505 rather than 62001)
+	keep = (ids >> 24) & 1 == 1
+	if not keep.all ():
+		timeStamps, ids, raw = timeStamps[keep], ids[keep], raw[keep]
+
+	source = (ids & 0xFF).astype (np.int32)
+	instance = (raw[:, 0] & 0x0F).astype (np.int32)
+	fluidType = (raw[:, 0] >> 4).astype (np.int32)
+	rawLevel = raw[:, 1:3].copy ().view ('<i2').ravel ()
+	rawCapacity = raw[:, 3:7].copy ().view ('<u4').ravel ()
+	level = np.where (rawLevel == LevelNotAvailable, np.nan, rawLevel * 0.004)
+	capacity = np.where (rawCapacity == CapacityNotAvailable, np.nan, rawCapacity / 10000.0)
+	return timeStamps, source, fluidType, instance, level, capacity
+
+
+# reads a file in chunks that end at a line boundary
+
+def ReadChunks (fileName, chunkSize):
+
+	remainder = b''
+	with open (fileName, 'rb') as f:
+		while True:
+			block = f.read (chunkSize)
+			if not block:
+				break
+			block = remainder + block
+			end = block.rfind (b'\n') + 1
+			if end == 0:
+				remainder = block
+				continue
+			remainder = block[end:]
+			yield block[:end]
+	if remainder:
+		yield remainder
+
+
+# running statistics for one tank
+
+class TankStatistics:
+
+	def __init__ (self):
+
+		self.Frames = 0
+		self.Intervals = np.zeros (len (IntervalBins) - 1, dtype = np.int64)
+		self.LastTime = None
+		self.LastLevel = np.nan
+		self.LevelCount = 0
+		self.LevelSum = 0.0
+		self.StepCount = 0
+		self.StepSquares = 0.0
+		self.StepMax = 0.0
+		self.Capacity = np.nan
+		self.Polled = 0
+
+
+	def Add (self, timeStamps, level, capacity):
+
+		self.Frames += len (timeStamps)
+		valid = level[~np.isnan (level)]
+		self.LevelCount += len (valid)
+		self.LevelSum += float (np.sum (valid))
+		if self.LastTime != None:
+			timeStamps = np.concatenate (( [ self.LastTime ], timeStamps ))
+			level = np.concatenate (( [ self.LastLevel ], level ))
+		self.Intervals += np.histogram (np.diff (timeStamps), IntervalBins)[0]
+		self.LastTime = timeStamps[-1]
+
+		steps = np.diff (level)
+		steps = steps[~np.isnan (steps)]
+		self.StepCount += len (steps)
+		self.StepSquares += float (np.sum (steps * steps))
+		if len (steps) > 0:
+			self.StepMax = max (self.StepMax, float (np.max (np.abs (steps))))
+		self.LastLevel = level[-1]
+		capacity = capacity[~np.isnan (capacity)]
+		if len (capacity) > 0:
+			self.Capacity = capacity[-1]
+
+
+	def Percentile (self, fraction):
+
+		total = self.Intervals.sum ()
+		if total == 0:
+			return np.nan
+		index = np.searchsorted (np.cumsum (self.Intervals), fraction * total)
+		return IntervalBins[min (index + 1, len (IntervalBins) - 2)]
+
+
+# running statistics for one source address: bursts and the poll simulation
+
+class SourceStatistics:
+
+	def __init__ (self, burstGap, pollPeriod):
+
+		self.BurstGap = burstGap
+		self.PollPeriod = pollPeriod
+		self.Frames = 0
+		self.Bursts = 0
+		self.SilenceSum = 0.0
+		self.LastTime = None
+		self.LastTank = None
+		self.LastRead = False
+		self.NextPoll = None
+
+
+# timeStamps are sorted, tanks are the tank keys of the frames
+# returns the tank keys of the frames a poll would have read
+
+	def Add (self, timeStamps, tanks):
+
+		self.Frames += len (timeStamps)
+		if self.LastTime == None:
+			self.Bursts = 1
+			self.NextPoll = timeStamps[0]
+			gaps = np.diff (timeStamps)
+		else:
+			gaps = np.diff (np.concatenate (( [ self.LastTime ], timeStamps )))
+		silences = gaps[gaps > self.BurstGap]
+		self.Bursts += len (silences)
+		self.SilenceSum += float (np.sum (silences))
+
+# poll times up to the last frame of this chunk, each reads the latest frame at that time
+# the last frame of the previous chunk is carried over so a poll before the first frame of this chunk reads it
+# (unless a poll of the previous chunk read it already)
+		polls = np.arange (self.NextPoll, timeStamps[-1] + 1e-9, self.PollPeriod)
+		if len (polls) > 0:
+			self.NextPoll = polls[-1] + self.PollPeriod
+		if self.LastTank != None:
+			pollTimes = np.concatenate (( [ self.LastTime ], timeStamps ))
+			pollTanks = np.concatenate (( [ self.LastTank ], tanks ))
+		else:
+			pollTimes = timeStamps
+			pollTanks = tanks
+		indexes = np.searchsorted (pollTimes, polls, side = 'right') - 1
+		indexes = np.unique (indexes[indexes >= 0])
+		last = len (pollTimes) - 1
+		lastRead = len (indexes) > 0 and indexes[-1] == last
+		if self.LastTank != None and self.LastRead and len (indexes) > 0 and indexes[0] == 0:
+			indexes = indexes[1:]
+		self.LastTime = timeStamps[-1]
+		self.LastTank = tanks[-1]
+		self.LastRead = lastRead
+		return pollTanks[indexes]
+
+
+def TankKey (source, fluidType, instance):
+
+	return (source << 8) | (fluidType << 4) | instance
+
+
+# adds the decoded frames of a chunk to the tank and source statistics
+
+def AddFrames (decoded, tanks, sources, burstGap, pollPeriod):
+
+	timeStamps, source, fluidType, instance, level, capacity = decoded
+	keys = TankKey (source, fluidType, instance)
+
+	for address in np.unique (source):
+		selected = source == address
+		statistics = sources.get (address)
+		if statistics == None:
+			statistics = sources[address] = SourceStatistics (burstGap, pollPeriod)
+		order = np.argsort (timeStamps[selected], kind = 'mergesort')
+		seen = statistics.Add (timeStamps[selected][order], keys[selected][order])
+		seenKeys, seenCounts = np.unique (seen, return_counts = True)
+		for key, count in zip (seenKeys, seenCounts):
+			tank = tanks.get (key)
+			if tank == None:
+				tank = tanks[key] = TankStatistics ()
+			tank.Polled += int (count)
+
+	for key in np.unique (keys):
+		selected = keys == key
+		tank = tanks.get (key)
+		if tank == None:
+			tank = tanks[key] = TankStatistics ()
+		order = np.argsort (timeStamps[selected], kind = 'mergesort')
+		tank.Add (timeStamps[selected][order], level[selected][order], capacity[selected][order])
+
+
+def Analyse (fileNames, chunkSize, burstGap, pollPeriod):
+
+	tanks = {}
+	sources = {}
+	byteCount = 0
+	start = time.time ()
+
+	for fileName in fileNames:
+		for chunk in ReadChunks (fileName, chunkSize):
+			byteCount += len (chunk)
+			decoded = DecodeChunk (chunk)
+			if decoded != None:
+				AddFrames (decoded, tanks, sources, burstGap, pollPeriod)
+
+	elapsed = time.time () - start
+	return tanks, sources, byteCount, elapsed
+
+
+# forward fill: the last value where mask is set at or before each index (initial before the first one)
+
+def Fill (values, mask, initial):
+
+	index = np.maximum.accumulate (np.where (mask, np.arange (len (values)), -1))
+	return np.where (index >= 0, values[np.maximum (index, 0)], initial)
+
+
+# TraceStatistics groups the signals of a trace into tank reports a chunk of records at a time
+# the records from the start of the last (possibly incomplete) report are kept in Tail and added to the next chunk
+# Tank, Level, Capacity and PreviousTime are the state of the service before Tail
+
+class TraceStatistics:
+
+	def __init__ (self, frameTimeout):
+
+		self.FrameTimeout = frameTimeout
+		self.Service = ""
+		self.ProductId = 0
+		self.Records = 0
+		self.Invalid = 0
+		self.Snapshots = 0
+		self.PollRead = {}
+		self.DropOuts = 0
+		self.OffBusTime = 0.0
+		self.LostTime = None
+		self.Tank = np.nan
+		self.Level = np.nan
+		self.Capacity = np.nan
+		self.PreviousTime = -np.inf
+		self.Tail = np.zeros (0, dtype = TraceRecord)
+
+
+# returns the complete reports as DecodeChunk does, or None
+# all reports are complete at the end of the trace (final)
+
+	def Add (self, records, final):
+
+		self.Records += len (records)
+		signal = records['kind'] <= TraceCapacity
+		self.Invalid += int (np.count_nonzero (signal & np.isnan (records['first'])))
+		records = np.concatenate (( self.Tail, records ))
+
+		indexes = np.nonzero (records['kind'] <= TraceCapacity)[0]
+		times = records['time'][indexes]
+		kinds = records['kind'][indexes]
+		values = records['first'][indexes].astype (np.float64)
+		valid = ~np.isnan (values)
+		fluidTypes = (kinds == TraceFluidType) & valid
+		gaps = np.diff (np.concatenate (( [ self.PreviousTime ], times )))
+		starts = np.nonzero (fluidTypes | (gaps > self.FrameTimeout))[0]
+		tank = Fill (values, fluidTypes, self.Tank)
+		level = Fill (values, (kinds == TraceLevel) & valid, self.Level)
+		capacity = Fill (values, (kinds == TraceCapacity) & valid, self.Capacity)
+
+# the last report is carried over unless this is the end of the trace
+		complete = len (starts) if final else max (len (starts) - 1, 0)
+		if complete < len (starts):
+			first = starts[complete]
+			cut = indexes[first]
+		else:
+			first = len (times)
+			cut = len (records)
+		if first > 0:
+			self.Tank = tank[first - 1]
+			self.Level = level[first - 1]
+			self.Capacity = capacity[first - 1]
+			self.PreviousTime = times[first - 1]
+		processed = records[:cut]
+		self.Tail = records[cut:].copy ()
+
+		for timeStamp, kind in zip (processed['time'], processed['kind']):
+			if kind == TraceServiceLost and self.LostTime == None:
+				self.DropOuts += 1
+				self.LostTime = timeStamp
+			elif kind == TraceServiceFound and self.LostTime != None:
+				self.OffBusTime += timeStamp - self.LostTime
+				self.LostTime = None
+
+		if complete == 0:
+			return None
+		last = np.append (starts[1:], len (times))[:complete] - 1
+		startTimes = times[starts[:complete]]
+		endTimes = np.append (times[starts[1:]], np.inf)[:complete]
+		reportTanks = tank[last]
+		keep = ~np.isnan (reportTanks)
+		startTimes, endTimes, reportTanks = startTimes[keep], endTimes[keep], reportTanks[keep].astype (np.int32)
+		if len (startTimes) == 0:
+			return None
+
+# a report was read by the recorder if one of its polls returned the report's tank before the next report started
+		snapshots = processed[processed['kind'] == TraceSnapshot]
+		self.Snapshots += len (snapshots)
+		for fluidType in np.unique (reportTanks):
+			selected = reportTanks == fluidType
+			pollTimes = np.sort (snapshots['time'][snapshots['first'] == fluidType])
+			read = np.searchsorted (pollTimes, endTimes[selected]) - np.searchsorted (pollTimes, startTimes[selected])
+			key = TankKey (0, fluidType, 0)
+			self.PollRead[key] = self.PollRead.get (key, 0) + int (np.count_nonzero (read))
+
+		zeros = np.zeros (len (startTimes), dtype = np.int32)
+		return startTimes, zeros, reportTanks, zeros, level[last][keep], capacity[last][keep]
+
+
+def AnalyseTrace (fileName, chunkSize, burstGap, pollPeriod, frameTimeout):
+
+	tanks = {}
+	sources = {}
+	statistics = TraceStatistics (frameTimeout)
+	byteCount = 0
+	start = time.time ()
+	readSize = max (chunkSize // TraceRecord.itemsize, 1) * TraceRecord.itemsize
+
+	with open (fileName, 'rb') as f:
+		statistics.Service, statistics.ProductId = ReadTraceHeader (f)
+		while True:
+			block = f.read (readSize)
+			byteCount += len (block)
+			final = len (block) < readSize
+			usable = len (block) // TraceRecord.itemsize * TraceRecord.itemsize
+			decoded = statistics.Add (np.frombuffer (block[:usable], dtype = TraceRecord), final)
+			if decoded != None:
+				AddFrames (decoded, tanks, sources, burstGap, pollPeriod)
+			if final:
+				break
+
+	elapsed = time.time () - start
+	return tanks, sources, statistics, byteCount, elapsed
+
+
+def Report (tanks, sources, byteCount, elapsed, pollPeriod):
+
+	print ("%.1f MB analysed in %.1f seconds" % (byteCount / 1e6, elapsed))
+	print ("")
+	print ("%-4s %-5s %-4s %8s %8s %8s %8s %8s %8s %8s %8s %8s" % ('src', 'type', 'inst', 'frames',
+			'int p10', 'int p50', 'int p90', 'level', 'noise', 'max step', 'missed', 'missed %'))
+	for key in sorted (tanks.keys ()):
+		tank = tanks[key]
+		if tank.Frames == 0:
+			continue
+		mean = tank.LevelSum / tank.LevelCount if tank.LevelCount > 0 else np.nan
+		noise = np.sqrt (tank.StepSquares / tank.StepCount) if tank.StepCount > 0 else np.nan
+		missed = tank.Frames - tank.Polled
+		print ("%-4d %-5d %-4d %8d %8.2f %8.2f %8.2f %8.2f %8.3f %8.2f %8d %8.1f" % (key >> 8, (key >> 4) & 0xF, key & 0xF,
+				tank.Frames, tank.Percentile (0.1), tank.Percentile (0.5), tank.Percentile (0.9),
+				mean, noise, tank.StepMax, missed, 100.0 * missed / tank.Frames))
+	print ("")
+	print ("time between reports: upper edge of the histogram bin (seconds), noise: RMS level change between reports (%)")
+	print ("missed: reports a %.1f second poll of the SeeLevel service would not have read" % pollPeriod)
+	print ("")
+	print ("%-4s %8s %8s %12s %12s" % ('src', 'frames', 'bursts', 'frames/burst', 'mean silence'))
+	for address in sorted (sources.keys ()):
+		source = sources[address]
+		silences = source.Bursts - 1
+		print ("%-4d %8d %8d %12.1f %12.2f" % (address, source.Frames, source.Bursts,
+				float (source.Frames) / source.Bursts, source.SilenceSum / silences if silences > 0 else 0.0))
+
+
+def ReportTrace (statistics, tanks):
+
+	print ("")
+	print ("trace of %s (product ID %d): %d records, %d polls, %d invalid values" % (statistics.Service,
+			statistics.ProductId, statistics.Records, statistics.Snapshots, statistics.Invalid))
+	print ("service left the dBus %d times for %.1f seconds in all" % (statistics.DropOuts, statistics.OffBusTime))
+	print ("")
+	print ("%-5s %8s %8s %8s" % ('type', 'reports', 'polled', 'polled %'))
+	for key in sorted (tanks.keys ()):
+		tank = tanks[key]
+		polled = statistics.PollRead.get (key, 0)
+		print ("%-5d %8d %8d %8.1f" % ((key >> 4) & 0xF, tank.Frames, polled, 100.0 * polled / tank.Frames if tank.Frames > 0 else 0.0))
+	print ("")
+	print ("polled: reports read by the recorder's own polls of the service")
+
+
+def main ():
+
+	parser = argparse.ArgumentParser (description = 'analyse N2K tank reports (PGN 127505) in candump captures and SeeLevel traces')
+	parser.add_argument ('files', nargs = '+', help = 'candump log files or traces written by record_seelevel.py')
+	parser.add_argument ('--chunk-size', type = float, default = 32, help = 'MB read at a time (default 32)')
+	parser.add_argument ('--burst-gap', type = float, default = 1.0, help = 'silence (seconds) that ends a burst (default 1)')
+	parser.add_argument ('--poll-period', type = float, default = 1.0, help = 'CheckSeeLevel poll period to simulate (default 1)')
+	parser.add_argument ('--frame-timeout', type = float, default = 0.5, help = 'silence (seconds) that ends a traced report (default 0.5)')
+	args = parser.parse_args ()
+
+	chunkSize = int (args.chunk_size * 1000000)
+	traces = [ fileName for fileName in args.files if IsTrace (fileName) ]
+	captures = [ fileName for fileName in args.files if fileName not in traces ]
+
+	if len (captures) > 0:
+		tanks, sources, byteCount, elapsed = Analyse (captures, chunkSize, args.burst_gap, args.poll_period)
+		Report (tanks, sources, byteCount, elapsed, args.poll_period)
+
+	for fileName in traces:
+		if fileName != args.files[0]:
+			print ("")
+		print ("%s:" % fileName)
+		tanks, sources, statistics, byteCount, elapsed = AnalyseTrace (fileName, chunkSize, args.burst_gap,
+				args.poll_period, args.frame_timeout)
+		Report (tanks, sources, byteCount, elapsed, args.poll_period)
+		ReportTrace (statistics, tanks)
+
+
+main ()
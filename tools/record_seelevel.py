@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# records the SeeLevel dBus service to a trace file (see seelevel_trace.py)
+#
+# run on the Venus device while the problem is happening, for example:
+#	python /data/SeeLevelRepeater/tools/record_seelevel.py /data/seelevel.trace
+# stop with Ctrl-C or give --duration
+#
+# the service is found by its product ID (41312 by default, as for the repeater) unless --service is given
+# the PropertiesChanged signals of /FluidType, /Level and /Capacity are recorded as they arrive
+# and the service is polled every --poll-period seconds with GetValue on / as CheckSeeLevel does
+# polls are made asynchronously so a stalled service does not hold up the recording of signals
+# the recorder only listens, so it can run alongside the repeater
+#
+# the trace can be replayed with replay_seelevel.py and analysed with analyse_capture.py
+
+import os
+import sys
+import time
+import logging
+import argparse
+import gobject
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../ext/velib_python'))
+from ve_utils import unwrap_dbus_value
+from seelevel_trace import TraceWriter, TraceFluidType, TraceLevel, TraceCapacity, TraceSnapshot, \
+		TraceServiceLost, TraceServiceFound, NaN
+
+TankServicePrefix = 'com.victronenergy.tank.'
+BusItemInterface = 'com.victronenergy.BusItem'
+
+TheBus = None
+TheWriter = None
+PollsPending = 0
+PollErrors = 0
+
+
+# returns the name of the first tank service with the product ID or None
+
+def FindService (productId):
+
+	for service in TheBus.list_names ():
+		if not service.startswith (TankServicePrefix):
+			continue
+		try:
+			value = TheBus.call_blocking (service, '/ProductId', BusItemInterface, 'GetValue', '', ())
+		except dbus.DBusException:
+			continue
+		if unwrap_dbus_value (value) == productId:
+			return service
+	return None
+
+
+# invalid values have an empty text - they are recorded as NaN
+
+def SignalValue (changes):
+
+	if changes.get ('Text') == "":
+		return NaN
+	try:
+		return float (changes.get ('Value'))
+	except TypeError:
+		return NaN
+
+
+def FluidTypeChanged (changes):
+	TheWriter.Write (time.time (), TraceFluidType, SignalValue (changes))
+
+def LevelChanged (changes):
+	TheWriter.Write (time.time (), TraceLevel, SignalValue (changes))
+
+def CapacityChanged (changes):
+	TheWriter.Write (time.time (), TraceCapacity, SignalValue (changes))
+
+
+def OwnerChanged (name, oldOwner, newOwner):
+
+	if newOwner == "":
+		TheWriter.Write (time.time (), TraceServiceLost)
+		logging.warning ("%s left the dBus", name)
+	else:
+		TheWriter.Write (time.time (), TraceServiceFound)
+		logging.info ("%s is back on the dBus", name)
+
+
+def SnapshotValue (snapshot, name):
+
+	value = snapshot.get (name)
+	if value == None:
+		return NaN
+	return float (value)
+
+
+def PollReply (value):
+	global PollsPending
+
+	PollsPending -= 1
+	snapshot = unwrap_dbus_value (value)
+	if not isinstance (snapshot, dict):
+		snapshot = {}
+	TheWriter.Write (time.time (), TraceSnapshot, SnapshotValue (snapshot, 'FluidType'),
+			SnapshotValue (snapshot, 'Level'), SnapshotValue (snapshot, 'Capacity'))
+
+
+def PollError (error):
+	global PollsPending
+	global PollErrors
+
+	PollsPending -= 1
+	PollErrors += 1
+
+
+# one poll at a time - a poll still waiting for its reply is not repeated
+
+def Poll (service):
+
+	global PollsPending
+
+	if PollsPending == 0:
+		PollsPending += 1
+		TheBus.call_async (service, '/', BusItemInterface, 'GetValue', '', (), PollReply, PollError)
+	return True
+
+
+def Flush ():
+
+	TheWriter.Flush ()
+	return True
+
+
+def main ():
+
+	global TheBus
+	global TheWriter
+
+	parser = argparse.ArgumentParser (description = 'record the SeeLevel dBus service to a trace file')
+	parser.add_argument ('trace', help = 'trace file to write')
+	parser.add_argument ('--service', help = 'dBus service name (default: found by product ID)')
+	parser.add_argument ('--product-id', type = int, default = 41312, help = 'product ID of the service (default 41312)')
+	parser.add_argument ('--poll-period', type = float, default = 1.0, help = 'seconds between polls, 0 for none (default 1)')
+	parser.add_argument ('--duration', type = float, default = 0, help = 'seconds to record (default: until Ctrl-C)')
+	args = parser.parse_args ()
+
+	logging.basicConfig (level = logging.INFO)
+	DBusGMainLoop (set_as_default = True)
+	TheBus = dbus.SessionBus () if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus ()
+
+	service = args.service
+	if service == None:
+		service = FindService (args.product_id)
+		if service == None:
+			logging.error ("no tank service with product ID %d", args.product_id)
+			sys.exit (1)
+	try:
+		productId = unwrap_dbus_value (TheBus.call_blocking (service, '/ProductId', BusItemInterface, 'GetValue', '', ()))
+	except dbus.DBusException:
+		productId = args.product_id
+
+	TheWriter = TraceWriter (args.trace, service, productId)
+
+# matching on the well-known name follows the service when it is restarted under a new unique name
+	for handler, path in ( (FluidTypeChanged, '/FluidType'), (LevelChanged, '/Level'), (CapacityChanged, '/Capacity') ):
+		TheBus.add_signal_receiver (handler, path = path, dbus_interface = BusItemInterface,
+				signal_name = 'PropertiesChanged', bus_name = service)
+	TheBus.add_signal_receiver (OwnerChanged, signal_name = 'NameOwnerChanged',
+			dbus_interface = 'org.freedesktop.DBus', path = '/org/freedesktop/DBus', arg0 = service)
+
+	if args.poll_period > 0:
+		gobject.timeout_add (int (args.poll_period * 1000), Poll, service)
+	gobject.timeout_add (1000, Flush)
+
+	mainloop = gobject.MainLoop ()
+	if args.duration > 0:
+		gobject.timeout_add (int (args.duration * 1000), mainloop.quit)
+
+	logging.info ("recording %s (product ID %d) to %s", service, productId, args.trace)
+	start = time.time ()
+	try:
+		mainloop.run ()
+	except KeyboardInterrupt:
+		pass
+	TheWriter.Close ()
+	logging.info ("%d records in %.0f seconds, %d polls failed", TheWriter.RecordCount, time.time () - start, PollErrors)
+
+
+main ()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# replays a trace of the SeeLevel dBus service (see record_seelevel.py) to the unmodified repeater
+#
+# must run on a private session bus so the real settings and tank services are never touched:
+#	dbus-run-session -- python tools/replay_seelevel.py seelevel.trace
+# the repeater (SeeLevelRepeater.py) is started on the same bus unless --no-repeater is given
+# (then start it yourself, e.g. under a profiler, once the replayer is waiting, with --data <directory>
+# so it doesn't use the tank state and history in /data/TankRepeater)
+# the repeater keeps its tank state and history in a temporary directory that is removed when it stops
+#
+# StandInSettings takes the place of localsettings and StandInTankService that of the SeeLevel service
+# (named and numbered as the recorded service) - see seelevel_standin.py
+# the replay starts when the repeater has bound the stand-in (it writes the service name to its settings)
+# records are replayed at the pace of their time stamps, --speed times faster
+#	/FluidType, /Level and /Capacity signals are re-sent by setting the stand-in's values
+#	invalid values are not replayed (VeDbusService doesn't send them with an empty text as the GUI does)
+#	the stand-in leaves the dBus and comes back where the service did
+#	recorded polls are compared with the stand-in's values, a difference means signals were lost in the recording
+#
+# the repeater's tank publish settings are set so every level change is published as soon as it is received
+# and each level change sent is matched with the repeater's /Level (see RepeaterMonitor)
+# the report gives the latency, missed level changes and the CPU time and memory of the repeater
+
+import time
+import math
+import logging
+import argparse
+import gobject
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+
+from seelevel_trace import ReadTraceHeader, ReadTraceRecords, TraceFluidType, TraceLevel, TraceCapacity, \
+		TraceSnapshot, TraceServiceLost, TraceServiceFound
+from seelevel_standin import StandInSettings, StandInTankService, RepeaterMonitor, MeasurementSettings, \
+		RequireSessionBus, StartRepeater, StopRepeater, ProcessUsage, PrintResults
+
+
+class Replay:
+
+	def __init__ (self, bus, tank, records, service, productId, monitor, speed, doneCallback):
+
+		self.Bus = bus
+		self.Records = records
+		self.Service = service
+		self.ProductId = productId
+		self.Monitor = monitor
+		self.Speed = speed
+		self.DoneCallback = doneCallback
+		self.Tank = tank
+		self.Values = [ None, None, None ]
+		self.Pending = None
+		self.TraceStart = None
+		self.WallStart = None
+		self.ReportType = None
+		self.ReportTime = None
+		self.ReportLevelSent = False
+		self.Frames = 0
+		self.Invalid = 0
+		self.Ignored = 0
+		self.Snapshots = 0
+		self.SnapshotDifferences = 0
+		self.DropOuts = 0
+
+
+	def Start (self):
+
+		self.WallStart = time.time ()
+		gobject.idle_add (self._next)
+
+
+	def _next (self):
+
+		while True:
+			if self.Pending == None:
+				try:
+					self.Pending = next (self.Records)
+				except StopIteration:
+					self._endReport ()
+					self.DoneCallback ()
+					return False
+			if self.TraceStart == None:
+				self.TraceStart = self.Pending[0]
+			delay = self.WallStart + (self.Pending[0] - self.TraceStart) / self.Speed - time.time ()
+			if delay > 0.001:
+				gobject.timeout_add (int (delay * 1000), self._next)
+				return False
+			record = self.Pending
+			self.Pending = None
+			self._replay (*record)
+
+
+# a report ends at the next fluid type
+# if its level was not signalled (the same as for the previous tank) the tank's level is the current level
+
+	def _endReport (self):
+
+		if self.ReportType != None and not self.ReportLevelSent:
+			self.Monitor.Sent (self.ReportType, self.Values[TraceLevel], self.ReportTime)
+
+
+	def _replay (self, timeStamp, kind, first, second, third):
+
+		now = time.time ()
+		if kind <= TraceCapacity:
+			if self.Tank == None:
+				self.Ignored += 1
+				return
+			if math.isnan (first):
+				self.Invalid += 1
+				return
+			if kind == TraceFluidType:
+				self._endReport ()
+				self.Frames += 1
+				self.ReportType = int (first)
+				self.ReportTime = now
+				self.ReportLevelSent = False
+				self.Values[kind] = int (first)
+				self.Tank['/FluidType'] = int (first)
+			elif kind == TraceLevel:
+				self.Values[kind] = first
+				self.Tank['/Level'] = first
+				if self.ReportType != None:
+					self.Monitor.Sent (self.ReportType, first, now)
+					self.ReportLevelSent = True
+			else:
+				self.Values[kind] = first
+				self.Tank['/Capacity'] = first
+
+		elif kind == TraceSnapshot:
+			self.Snapshots += 1
+			for recorded, value in zip ((first, second, third), self.Values):
+				if not math.isnan (recorded) and (value == None or abs (recorded - value) > 0.001):
+					self.SnapshotDifferences += 1
+					break
+
+		elif kind == TraceServiceLost and self.Tank != None:
+			self.DropOuts += 1
+			self.Tank.__del__ ()
+			self.Tank = None
+
+		elif kind == TraceServiceFound and self.Tank == None:
+			self.Tank = StandInTankService (self.Bus, self.Service, self.ProductId)
+			self.Tank.Report (*self.Values)
+
+
+def main ():
+
+	parser = argparse.ArgumentParser (description = 'replay a SeeLevel trace to the repeater on a private session bus')
+	parser.add_argument ('trace', help = 'trace file written by record_seelevel.py')
+	parser.add_argument ('--speed', type = float, default = 1.0, help = 'replay speed, 2 for twice as fast (default 1)')
+	parser.add_argument ('--no-repeater', action = 'store_true', help = 'do not start the repeater')
+	parser.add_argument ('--repeater-log', default = 'repeater.log', help = 'file for the repeater output (default repeater.log)')
+	parser.add_argument ('--start-timeout', type = float, default = 60, help = 'seconds to wait for the repeater (default 60)')
+	parser.add_argument ('--settle', type = float, default = 5, help = 'seconds to wait for the repeater after the last record (default 5)')
+	args = parser.parse_args ()
+
+	logging.basicConfig (level = logging.INFO)
+	RequireSessionBus ()
+	DBusGMainLoop (set_as_default = True)
+	bus = dbus.SessionBus ()
+	mainloop = gobject.MainLoop ()
+
+	traceFile = open (args.trace, 'rb')
+	service, productId = ReadTraceHeader (traceFile)
+	records = ReadTraceRecords (traceFile)
+
+	state = { 'replay': None, 'repeater': None, 'cpu': 0.0 }
+
+	def finish ():
+		replay = state['replay']
+		monitor.Finish ()
+		elapsed = time.time () - replay.WallStart
+		cpu = None
+		rss = 0
+		if state['repeater'] != None:
+			cpu, rss = ProcessUsage (state['repeater'].pid)
+			cpu -= state['cpu']
+		print ("")
+		PrintResults (monitor, replay.Frames, cpu, rss, elapsed)
+		print ("%d invalid values not replayed, %d values sent while the service was off the dBus, %d drop-outs"
+				% (replay.Invalid, replay.Ignored, replay.DropOuts))
+		print ("%d of %d recorded polls differ from the stand-in's values" % (replay.SnapshotDifferences, replay.Snapshots))
+		mainloop.quit ()
+
+	def replayDone ():
+		logging.info ("trace replayed, waiting %.0f seconds for the repeater", args.settle)
+		gobject.timeout_add (int (args.settle * 1000), finish)
+
+# the repeater writes the names of the services it has bound to its SeeLevelService setting
+	def settingChanged (path, value):
+		if state['replay'] != None or not path.endswith ('/SeeLevelService') or service not in value.split (','):
+			return
+		if state['repeater'] != None:
+			state['cpu'] = ProcessUsage (state['repeater'].pid)[0]
+		logging.info ("repeater has bound %s, replaying %s at %.1fx", service, args.trace, args.speed)
+		state['replay'] = Replay (bus, tank, records, service, productId, monitor, args.speed, replayDone)
+		state['replay'].Start ()
+
+	def startTimeout ():
+		if state['replay'] == None:
+			logging.error ("the repeater did not bind %s within %.0f seconds", service, args.start_timeout)
+			mainloop.quit ()
+		return False
+
+	overrides = dict (MeasurementSettings)
+	overrides['SeeLevelProductId'] = productId
+	settings = StandInSettings (bus, overrides, settingChanged)
+	monitor = RepeaterMonitor (bus)
+
+# the stand-in has no values until the first records are replayed
+	tank = StandInTankService (bus, service, productId)
+	if not args.no_repeater:
+		state['repeater'] = StartRepeater (args.repeater_log)
+		logging.info ("repeater started (pid %d), output in %s", state['repeater'].pid, args.repeater_log)
+	gobject.timeout_add (int (args.start_timeout * 1000), startTimeout)
+
+	try:
+		mainloop.run ()
+	finally:
+		if state['repeater'] != None:
+			StopRepeater (state['repeater'])
+
+
+main ()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+# stand-in services and measurements for running the unmodified repeater off the Venus device
+#
+# StandInSettings takes the place of localsettings (com.victronenergy.settings)
+# StandInTankService takes the place of the multiplexed SeeLevel tank service of the GUI process
+# RepeaterMonitor follows the /Level and /Connected changes of the repeater services
+# and matches each published level with the level the stand-in sent for that tank
+# ProcessUsage reads the CPU time and resident memory of a process from /proc
+#
+# used by replay_seelevel.py (traces recorded on a Venus device)
+# and benchmarks/repeater_pipeline.py (synthetic tank reports)
+# all of them must run on a private session bus, for example under dbus-run-session,
+# so they never meet the real settings or tank services
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+import collections
+import dbus
+import dbus.service
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../ext/velib_python'))
+from vedbus import VeDbusService, VeDbusRootExport
+from ve_utils import unwrap_dbus_value
+
+RepeaterPath = os.path.join (os.path.dirname (os.path.abspath (__file__)), '../SeeLevelRepeater.py')
+RepeaterServiceName = 'com.victronenergy.tank.repeater'
+BusItemInterface = 'com.victronenergy.BusItem'
+
+# settings that make the repeater publish every level change of every tank as soon as it is received
+# so each level the stand-in sends can be matched with a level the repeater publishes
+# keys are matched with the end of the setting path
+
+MeasurementSettings = {
+	'FilterType': 0,
+	'LevelDeadband': 0.0,
+	'RelativeDeadband': 0.0,
+	'MinPublishInterval': 0.0
+	}
+
+
+# stops with a message unless there is a session bus to run on
+
+def RequireSessionBus ():
+
+	if 'DBUS_SESSION_BUS_ADDRESS' not in os.environ:
+		logging.error ("no session bus - run under dbus-run-session so the real services are not touched")
+		sys.exit (1)
+
+
+# localsettings root object: AddSettings creates the settings that don't exist yet
+
+class SettingsRootExport(VeDbusRootExport):
+
+	def __init__(self, bus, objectPath, get_value_handler, addSettingsHandler):
+		VeDbusRootExport.__init__(self, bus, objectPath, get_value_handler)
+		self._addSettingsHandler = addSettingsHandler
+
+	@dbus.service.method('com.victronenergy.Settings', in_signature='aa{sv}', out_signature='aa{sv}')
+	def AddSettings(self, settings):
+		return self._addSettingsHandler(settings)
+
+
+# StandInSettings holds settings in memory only
+# a setting is created with the value in overrides whose key ends its path, or else its default
+# changedCallback (path, value) is called when a client writes a setting
+
+class StandInSettings(VeDbusService):
+
+	def __init__(self, bus, overrides = None, changedCallback = None):
+
+		self.Overrides = overrides if overrides != None else {}
+		self.ChangedCallback = changedCallback
+		VeDbusService.__init__(self, 'com.victronenergy.settings', bus = bus)
+
+
+	def _create_root_export(self, bus, objectPath, get_value_handler):
+
+		return SettingsRootExport(bus, objectPath, get_value_handler, self._addSettings)
+
+
+	def _addSettings (self, settings):
+
+		results = []
+		for setting in settings:
+			path = str (setting['path'])
+			if path not in self:
+				value = unwrap_dbus_value (setting['default'])
+				for key, override in self.Overrides.items ():
+					if path.endswith ('/' + key):
+						value = override
+				self.add_path (path, value, writeable = True, onchangecallback = self._changed)
+			results.append ({ 'path': path, 'error': 0 })
+		return results
+
+
+	def _changed (self, path, value):
+
+		if self.ChangedCallback != None:
+			self.ChangedCallback (path, value)
+		return True
+
+
+# StandInTankService exports /FluidType, /Level and /Capacity as the multiplexed SeeLevel service does
+# Report sets them in the producer's order, so a PropertiesChanged signal is sent for each value that changes
+# None sets a value invalid
+
+class StandInTankService(VeDbusService):
+
+	def __init__(self, bus, service, productId):
+
+		VeDbusService.__init__(self, service, bus = bus)
+		self.add_mandatory_paths (__file__, '1.0', 'stand-in', 0, productId, 'SeeLevel stand-in', 0, 0, 1)
+		self.add_path ('/FluidType', None)
+		self.add_path ('/Level', None)
+		self.add_path ('/Capacity', None)
+
+
+	def Report (self, fluidType, level, capacity):
+
+		self['/FluidType'] = fluidType
+		self['/Level'] = level
+		self['/Capacity'] = capacity
+
+
+# results for one tank (fluid type) in RepeaterMonitor
+
+class TankResult:
+
+	def __init__ (self):
+
+		self.Sent = 0
+		self.Published = 0
+		self.Missed = 0
+		self.Unmatched = 0
+		self.Disconnects = 0
+		self.Latencies = []
+		self.Pending = collections.deque ()
+		self.LastSent = None
+
+
+# RepeaterMonitor counts the level changes sent to each tank (Sent) and matches them with the repeater's /Level
+# a published level is matched with the oldest pending level it equals (within tolerance)
+# levels sent before the matched one were never published and are counted as missed
+# published levels that match nothing (e.g. restored values) are counted as unmatched
+# the repeater of each fluid type is found from its service name (see RepeaterRegistry in SeeLevelRepeater.py)
+# /Level is published in the ItemsChanged signal of each update (whether or not the repeater also sends
+# PropertiesChanged signals for each path), /Connected is set on its own so it comes as PropertiesChanged
+
+class RepeaterMonitor:
+
+	def __init__ (self, bus, tolerance = 0.001):
+
+		self.Bus = bus
+		self.Tolerance = tolerance
+		self.Tanks = {}
+		self.Owners = {}		# unique name -> fluid type of the repeater service
+
+		self.Matches = [
+			bus.add_signal_receiver (self._ownerChanged, signal_name = 'NameOwnerChanged',
+				dbus_interface = 'org.freedesktop.DBus', path = '/org/freedesktop/DBus'),
+			bus.add_signal_receiver (self._itemsChanged, path = '/', dbus_interface = BusItemInterface,
+				signal_name = 'ItemsChanged', sender_keyword = 'sender'),
+			bus.add_signal_receiver (self._connectedChanged, path = '/Connected', dbus_interface = BusItemInterface,
+				signal_name = 'PropertiesChanged', sender_keyword = 'sender') ]
+		for name in bus.list_names ():
+			if name.startswith (RepeaterServiceName):
+				self._ownerChanged (name, '', bus.get_name_owner (name))
+
+
+# removes the match rules - the monitor no longer counts anything
+
+	def Close (self):
+
+		for match in self.Matches:
+			match.remove ()
+		self.Matches = []
+
+
+	def Tank (self, fluidType):
+
+		tank = self.Tanks.get (fluidType)
+		if tank == None:
+			tank = self.Tanks[fluidType] = TankResult ()
+		return tank
+
+
+# called by the stand-in when it has sent a level for a tank
+
+	def Sent (self, fluidType, level, now = None):
+
+		tank = self.Tank (fluidType)
+		if level == None or level == tank.LastSent:
+			return
+		tank.LastSent = level
+		tank.Sent += 1
+		tank.Pending.append ((now if now != None else time.time (), level))
+
+
+# levels still pending when the measurement ends are missed
+
+	def Finish (self):
+
+		for tank in self.Tanks.values ():
+			tank.Missed += len (tank.Pending)
+			tank.Pending.clear ()
+
+
+	def _ownerChanged (self, name, oldOwner, newOwner):
+
+		if not name.startswith (RepeaterServiceName):
+			return
+		self.Owners.pop (oldOwner, None)
+		if newOwner != "":
+			try:
+				self.Owners[newOwner] = int (name[len (RepeaterServiceName) + 1:].split ('_')[0])
+			except ValueError:
+				pass
+
+
+	def _itemsChanged (self, items, sender = None):
+
+		if '/Level' in items:
+			self._levelChanged (items['/Level'], sender)
+
+
+	def _levelChanged (self, changes, sender = None):
+
+		fluidType = self.Owners.get (sender)
+		if fluidType == None:
+			return
+		now = time.time ()
+		tank = self.Tank (fluidType)
+		tank.Published += 1
+		level = unwrap_dbus_value (changes.get ('Value'))
+		if level == None:
+			return
+		for index, (sentTime, sentLevel) in enumerate (tank.Pending):
+			if abs (sentLevel - level) <= self.Tolerance:
+				break
+		else:
+			tank.Unmatched += 1
+			return
+		for i in range (index):
+			tank.Pending.popleft ()
+			tank.Missed += 1
+		sentTime, sentLevel = tank.Pending.popleft ()
+		tank.Latencies.append (now - sentTime)
+
+
+	def _connectedChanged (self, changes, sender = None):
+
+		fluidType = self.Owners.get (sender)
+		if fluidType != None and unwrap_dbus_value (changes.get ('Value')) == 0:
+			self.Tank (fluidType).Disconnects += 1
+
+
+# returns (CPU seconds (user + system), resident memory in kB) of a process
+
+def ProcessUsage (pid):
+
+	with open ('/proc/%d/stat' % pid) as f:
+		fields = f.read ().rsplit (')', 1)[1].split ()
+	cpu = (int (fields[11]) + int (fields[12])) / float (os.sysconf ('SC_CLK_TCK'))
+	rss = 0
+	with open ('/proc/%d/status' % pid) as f:
+		for line in f:
+			if line.startswith ('VmRSS:'):
+				rss = int (line.split ()[1])
+	return cpu, rss
+
+
+# starts SeeLevelRepeater.py with the same python and bus, its output goes to logFile
+# its tank state and history are kept in a new temporary directory (DataDirectory of the returned process)
+# so no run restores the tanks of an earlier one
+
+def StartRepeater (logFile):
+
+	log = open (logFile, 'w')
+	dataDirectory = tempfile.mkdtemp (prefix = 'TankRepeater')
+	repeater = subprocess.Popen ([ sys.executable, RepeaterPath, '--data', dataDirectory ],
+			stdout = log, stderr = subprocess.STDOUT)
+	repeater.DataDirectory = dataDirectory
+	return repeater
+
+
+# stops a repeater started by StartRepeater and removes its temporary directory
+
+def StopRepeater (repeater):
+
+	repeater.terminate ()
+	repeater.wait ()
+	shutil.rmtree (repeater.DataDirectory, ignore_errors = True)
+
+
+# percentile of a list of latencies (seconds), NaN if there are none
+
+def Percentile (values, fraction):
+
+	if len (values) == 0:
+		return float ('nan')
+	values = sorted (values)
+	return values[min (int (fraction * len (values)), len (values) - 1)]
+
+
+def PrintResults (monitor, frames, cpu, rss, elapsed):
+
+	print ("%-5s %8s %9s %9s %8s %8s %9s %9s %9s %9s" % ('type', 'sent', 'published', 'unmatched', 'missed', 'missed %',
+			'lat p50', 'lat p90', 'lat max', 'timeouts'))
+	totalSent = 0
+	totalMissed = 0
+	for fluidType in sorted (monitor.Tanks.keys ()):
+		tank = monitor.Tanks[fluidType]
+		totalSent += tank.Sent
+		totalMissed += tank.Missed
+		print ("%-5d %8d %9d %9d %8d %8.1f %9.1f %9.1f %9.1f %9d" % (fluidType, tank.Sent, tank.Published, tank.Unmatched, tank.Missed,
+				100.0 * tank.Missed / tank.Sent if tank.Sent > 0 else 0.0,
+				Percentile (tank.Latencies, 0.5) * 1000, Percentile (tank.Latencies, 0.9) * 1000,
+				max (tank.Latencies) * 1000 if tank.Latencies else float ('nan'), tank.Disconnects))
+	print ("")
+	print ("latency: stand-in write to repeater /Level (ms), missed: level changes the repeater never published")
+	print ("unmatched: published levels that were not sent (e.g. restored from the tank state file)")
+	print ("timeouts: times the repeater set /Connected to 0")
+	print ("")
+	print ("%d tank reports in %.1f seconds, %d of %d level changes missed (%.1f %%)" % (frames, elapsed,
+			totalMissed, totalSent, 100.0 * totalMissed / totalSent if totalSent > 0 else 0.0))
+	if cpu != None:
+		print ("repeater CPU %.3f s (%.1f %%), %.1f us per tank report, RSS %d kB" % (cpu, 100.0 * cpu / elapsed,
+				1e6 * cpu / frames if frames > 0 else 0.0, rss))
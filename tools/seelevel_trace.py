@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# trace files of the SeeLevel dBus service
+#
+# written by record_seelevel.py, read by replay_seelevel.py and analyse_capture.py
+# a trace holds what the repeater sees of a multiplexed tank service:
+# the PropertiesChanged signals of /FluidType, /Level and /Capacity
+# the results of polling the service (GetValue on /, as CheckSeeLevel does)
+# and the times the service left and re-joined the dBus
+#
+# the file starts with a header: magic, product ID of the service, length of the service name
+# followed by the service name (utf-8)
+# then fixed size records: time (seconds since the epoch), kind, then three values
+#	TraceFluidType, TraceLevel, TraceCapacity	the signalled value in the first value
+#	TraceSnapshot		fluid type, level and capacity read by the poll
+#	TraceServiceLost, TraceServiceFound		no values
+# values that are invalid on the dBus (empty text) are stored as NaN
+# records are written in the order they were received, so time stamps are (almost) sorted
+
+import struct
+
+TraceMagic = b'SLT1'
+TraceHeaderFormat = '<4siH'
+TraceHeaderSize = struct.calcsize (TraceHeaderFormat)
+TraceRecordFormat = '<dBfff'
+TraceRecordSize = struct.calcsize (TraceRecordFormat)
+
+TraceFluidType = 0
+TraceLevel = 1
+TraceCapacity = 2
+TraceSnapshot = 3
+TraceServiceLost = 4
+TraceServiceFound = 5
+
+TraceKindNames = { TraceFluidType: 'FluidType', TraceLevel: 'Level', TraceCapacity: 'Capacity',
+		TraceSnapshot: 'Snapshot', TraceServiceLost: 'ServiceLost', TraceServiceFound: 'ServiceFound' }
+
+NaN = float ('nan')
+
+
+class TraceWriter:
+
+	def __init__ (self, fileName, service, productId):
+
+		name = service.encode ('utf-8')
+		self.File = open (fileName, 'wb')
+		self.File.write (struct.pack (TraceHeaderFormat, TraceMagic, productId, len (name)) + name)
+		self.RecordCount = 0
+
+
+	def Write (self, timeStamp, kind, first = NaN, second = NaN, third = NaN):
+
+		self.File.write (struct.pack (TraceRecordFormat, timeStamp, kind, first, second, third))
+		self.RecordCount += 1
+
+
+	def Flush (self):
+
+		self.File.flush ()
+
+
+	def Close (self):
+
+		self.File.close ()
+
+
+# returns (service name, product ID) and leaves the file positioned at the first record
+# raises ValueError if the file is not a trace
+
+def ReadTraceHeader (f):
+
+	header = f.read (TraceHeaderSize)
+	if len (header) < TraceHeaderSize:
+		raise ValueError ("not a SeeLevel trace")
+	magic, productId, nameLength = struct.unpack (TraceHeaderFormat, header)
+	if magic != TraceMagic:
+		raise ValueError ("not a SeeLevel trace")
+	return f.read (nameLength).decode ('utf-8'), productId
+
+
+def IsTrace (fileName):
+
+	with open (fileName, 'rb') as f:
+		return f.read (len (TraceMagic)) == TraceMagic
+
+
+# generator for the records of a trace: (time, kind, first, second, third)
+# a partial record at the end (the recorder was killed while writing) is ignored
+
+def ReadTraceRecords (f, recordsPerRead = 4096):
+
+	while True:
+		block = f.read (TraceRecordSize * recordsPerRead)
+		for offset in range (0, len (block) - TraceRecordSize + 1, TraceRecordSize):
+			yield struct.unpack_from (TraceRecordFormat, block, offset)
+		if len (block) < TraceRecordSize * recordsPerRead:
+			return